@@ -0,0 +1,258 @@
+"""
+analytics.py - Training-load analytics over one user's whole history, vectorized with NumPy.
+
+load_history reads a user's activities into parallel arrays. They are stored
+packed in the ActivityColumns table (COLUMNS_DTYPE, about 21 bytes per activity),
+so a load is one blob read and np.frombuffer; the blob is rebuilt with one
+query after the user's activities change. The other functions work on those arrays without Python-level loops: per-day
+totals come from np.bincount and rolling windows from cumulative sums, so ten
+years of history takes a few milliseconds.
+
+    history = analytics.load_history(user_id)
+    load = analytics.training_load(history)
+    load['acwr'][-1]        # today's acute:chronic workload ratio
+"""
+import datetime
+
+import numpy as np
+
+import database
+
+ACUTE_DAYS = 7
+CHRONIC_DAYS = 28
+
+
+class History:
+    """One user's activities as parallel arrays, oldest first.
+
+    dates is datetime64[D]; distance is miles; moving_time is seconds;
+    elevation_gain is meters; heartrate is beats/min. Missing values are NaN.
+    """
+
+    def __init__(self, dates, distance, moving_time, elevation_gain, heartrate, is_run):
+        self.dates = dates
+        self.distance = distance
+        self.moving_time = moving_time
+        self.elevation_gain = elevation_gain
+        self.heartrate = heartrate
+        self.is_run = is_run
+
+    def __len__(self):
+        return len(self.dates)
+
+    def select(self, mask):
+        return History(self.dates[mask], self.distance[mask], self.moving_time[mask],
+                       self.elevation_gain[mask], self.heartrate[mask], self.is_run[mask])
+
+
+# Layout of a packed ActivityColumns blob, one record per activity.
+# day is days since 1970-01-01; NaN marks missing values.
+COLUMNS_DTYPE = np.dtype([
+    ('day', '<i4'),
+    ('distance', '<f4'),
+    ('moving_time', '<f4'),
+    ('elevation_gain', '<f4'),
+    ('heartrate', '<f4'),
+    ('is_run', '?'),
+])
+
+
+def pack_columns(rows):
+    """Pack database.get_activity_history rows into COLUMNS_DTYPE bytes."""
+    packed = np.empty(len(rows), dtype=COLUMNS_DTYPE)
+    if rows:
+        dates, distance, moving_time, elevation_gain, heartrate, is_run = zip(*rows)
+        packed['day'] = np.array(dates, dtype='datetime64[D]').astype(np.int32)
+        # None becomes NaN in a float array
+        packed['distance'] = np.array(distance, dtype=np.float64)
+        packed['moving_time'] = np.array(moving_time, dtype=np.float64)
+        packed['elevation_gain'] = np.array(elevation_gain, dtype=np.float64)
+        packed['heartrate'] = np.array(heartrate, dtype=np.float64)
+        packed['is_run'] = np.array(is_run, dtype=bool)
+    return packed.tobytes()
+
+
+def load_history(user_id, runs_only=True):
+    """Load a user's activities into a History. runs_only drops rides, swims, etc."""
+    packed = np.frombuffer(database.get_activity_columns(user_id, pack_columns), dtype=COLUMNS_DTYPE)
+    history = History(
+        packed['day'].astype('datetime64[D]'),
+        packed['distance'].astype(np.float64),
+        packed['moving_time'].astype(np.float64),
+        packed['elevation_gain'].astype(np.float64),
+        packed['heartrate'].astype(np.float64),
+        packed['is_run'].copy(),
+    )
+    return history.select(history.is_run) if runs_only else history
+
+
+def _day_range(history, start, end):
+    if start is None:
+        start = history.dates[0] if len(history) else np.datetime64(datetime.date.today(), 'D')
+    if end is None:
+        end = np.datetime64(datetime.date.today(), 'D')
+    start, end = np.datetime64(start, 'D'), np.datetime64(end, 'D')
+    return start, end, np.arange(start, end + 1)
+
+
+def daily_totals(history, values, start=None, end=None):
+    """Sum per-activity values into one total per day from start to end (inclusive).
+
+    Returns (days, totals). start defaults to the first activity and end to today.
+    """
+    start, end, days = _day_range(history, start, end)
+    in_range = (history.dates >= start) & (history.dates <= end)
+    offsets = (history.dates[in_range] - start).astype(np.int64)
+    totals = np.bincount(offsets, weights=np.nan_to_num(values[in_range]), minlength=len(days))
+    # bincount returns ints when nothing falls in the range
+    return days, totals.astype(np.float64, copy=False)
+
+
+def rolling_sum(values, window):
+    """Sum of each value and the window - 1 before it (shorter at the start)."""
+    sums = np.cumsum(values)
+    sums[window:] = sums[window:] - sums[:-window]
+    return sums
+
+
+def training_load(history, start=None, end=None, field='distance'):
+    """Rolling acute (7-day) and chronic (28-day) load and their ratio, per day.
+
+    field is 'distance' (miles) or 'moving_time' (seconds). chronic is the
+    28-day total divided by 4, i.e. the average week, so acute and chronic are
+    comparable and acwr is acute / chronic. acwr is NaN with no chronic load.
+    Windows reach back before start, so the first values aren't understated.
+    """
+    start, end, days = _day_range(history, start, end)
+    padded_start = start - (CHRONIC_DAYS - 1)
+    _, daily = daily_totals(history, getattr(history, field), padded_start, end)
+
+    acute = rolling_sum(daily, ACUTE_DAYS)[CHRONIC_DAYS - 1:]
+    chronic = rolling_sum(daily, CHRONIC_DAYS)[CHRONIC_DAYS - 1:] / (CHRONIC_DAYS / ACUTE_DAYS)
+    acwr = np.divide(acute, chronic, out=np.full_like(acute, np.nan), where=chronic > 0)
+    return {
+        'days': days,
+        'daily': daily[CHRONIC_DAYS - 1:],
+        'acute': acute,
+        'chronic': chronic,
+        'acwr': acwr,
+    }
+
+
+def pace_trend(history, window=CHRONIC_DAYS, start=None, end=None):
+    """Rolling average pace and its overall trend, in seconds per mile.
+
+    pace[i] is total moving time over total distance for the window days ending
+    on days[i] (NaN with no runs in the window), so long runs weigh more than
+    short ones. slope is the least-squares change in per-run pace per 30 days
+    (negative means getting faster), or None with fewer than two runs.
+    """
+    timed = history.select((history.distance > 0) & (history.moving_time > 0))
+    start, end, days = _day_range(timed if len(timed) else history, start, end)
+    padded_start = start - (window - 1)
+    _, daily_time = daily_totals(timed, timed.moving_time, padded_start, end)
+    _, daily_distance = daily_totals(timed, timed.distance, padded_start, end)
+
+    time_sums = rolling_sum(daily_time, window)[window - 1:]
+    distance_sums = rolling_sum(daily_distance, window)[window - 1:]
+    pace = np.divide(time_sums, distance_sums, out=np.full_like(time_sums, np.nan), where=distance_sums > 0)
+
+    slope = None
+    if len(timed) >= 2 and timed.dates[0] != timed.dates[-1]:
+        day_numbers = (timed.dates - timed.dates[0]).astype(np.float64)
+        per_run_pace = timed.moving_time / timed.distance
+        slope = float(np.polyfit(day_numbers, per_run_pace, 1)[0] * 30)
+    return {'days': days, 'pace': pace, 'slope_per_30_days': slope}
+
+
+ROLLING_WEEKS = 4
+
+
+def _longest_streak(flags):
+    # Length of the longest run of Trues, from where each run starts and ends
+    edges = np.diff(np.concatenate(([0], flags.astype(np.int8), [0])))
+    lengths = np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)
+    return int(lengths.max()) if len(lengths) else 0
+
+
+def _current_streak(flags):
+    # Length of the run of Trues at the end
+    misses = np.flatnonzero(~flags)
+    return int(len(flags) - (misses[-1] + 1 if len(misses) else 0))
+
+
+def _streaks(flags, counted):
+    # Periods that haven't finished (and haven't already succeeded) are left
+    # out, so an unfinished week or today doesn't break a streak. They are
+    # always at the end, so what remains is still contiguous.
+    flags = flags[counted]
+    return {'current': _current_streak(flags), 'longest': _longest_streak(flags)}
+
+
+def _hit_rate(flags, counted, goal):
+    if not goal or not counted.any():
+        return None
+    return round(float(flags[counted].mean()), 4)
+
+
+def weekly_trends(history, since, until, mileage_goal, long_run_goal, today=None):
+    """Monday-to-Sunday weekly trends from the week of since to the week of until.
+
+    Per week: total miles, the average of it and the ROLLING_WEEKS - 1 weeks
+    before, the longest run and the longest run so far (including runs before
+    since). Plus the share of weeks meeting each goal and streaks of goal weeks
+    and of consecutive running days. Weeks and days after today only count
+    once they meet their goal. Returns a dict ready for JSON.
+    """
+    today = np.datetime64(today or datetime.date.today(), 'D')
+    since, until = np.datetime64(since, 'D'), np.datetime64(until, 'D')
+    # datetime64 day 0 (1970-01-01) was a Thursday
+    start = since - (since.astype(np.int64) + 3) % 7
+    end = until + 6 - (until.astype(np.int64) + 3) % 7
+    padded_start = start - 7 * (ROLLING_WEEKS - 1)
+
+    days, daily = daily_totals(history, history.distance, padded_start, end)
+    weekly = daily.reshape(-1, 7).sum(axis=1)
+    rolling = (rolling_sum(weekly, ROLLING_WEEKS) / ROLLING_WEEKS)[ROLLING_WEEKS - 1:]
+    weekly = weekly[ROLLING_WEEKS - 1:]
+    daily = daily[7 * (ROLLING_WEEKS - 1):]
+    days = days[7 * (ROLLING_WEEKS - 1):]
+    week_starts = days[::7]
+
+    in_range = (history.dates >= start) & (history.dates <= end)
+    longest = np.zeros(len(week_starts))
+    np.maximum.at(longest, (history.dates[in_range] - start).astype(np.int64) // 7,
+                  np.nan_to_num(history.distance[in_range]))
+    before = history.distance[history.dates < start]
+    longest_before = np.nanmax(before) if len(before) and not np.isnan(before).all() else 0.0
+    longest_to_date = np.maximum.accumulate(np.maximum(longest, longest_before))
+
+    mileage_met = weekly >= mileage_goal if mileage_goal else np.zeros(len(weekly), dtype=bool)
+    long_run_met = longest >= long_run_goal if long_run_goal else np.zeros(len(weekly), dtype=bool)
+    week_over = week_starts + 6 < today
+    ran = daily > 0
+    day_over = days < today
+
+    return {
+        'since': str(start),
+        'until': str(end),
+        'mileage_goal': mileage_goal,
+        'long_run_goal': long_run_goal,
+        'weeks': [
+            {'week_start': str(week), 'total': total, 'rolling_average': average,
+             'longest_run': run, 'longest_to_date': best, 'mileage_goal_met': hit, 'long_run_goal_met': long_hit}
+            for week, total, average, run, best, hit, long_hit in zip(
+                week_starts.tolist(), np.round(weekly, 2).tolist(), np.round(rolling, 2).tolist(),
+                np.round(longest, 2).tolist(), np.round(longest_to_date, 2).tolist(),
+                mileage_met.tolist(), long_run_met.tolist())
+        ],
+        'goal_hit_rate': {
+            'mileage': _hit_rate(mileage_met, week_over | mileage_met, mileage_goal),
+            'long_run': _hit_rate(long_run_met, week_over | long_run_met, long_run_goal),
+        },
+        'streaks': {
+            'mileage_goal_weeks': _streaks(mileage_met, week_over | mileage_met),
+            'long_run_goal_weeks': _streaks(long_run_met, week_over | long_run_met),
+            'running_days': _streaks(ran, day_over | ran),
+        },
+    }
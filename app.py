@@ -1,12 +1,21 @@
 import os
+import datetime
 import threading
 import logging
 import time
-from flask import Flask, render_template, redirect, url_for, request, flash, jsonify
+import zipfile
+from flask import Flask, render_template, redirect, url_for, request, flash, jsonify, g, abort
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from dotenv import load_dotenv
+import analytics
+import cache
 import database
+import export
+import importer
+import metrics
+import passwords
 import collector
+import scheduler
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -17,25 +26,86 @@ load_dotenv()
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY')
 
+# METRICS
+
+if metrics.ENABLED:
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        started = g.get('request_started')
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            metrics.http_request_seconds.observe(time.perf_counter() - started, route, request.method)
+            metrics.http_requests.inc(1, route, request.method, str(response.status_code))
+        return response
+
+    metrics.gauge('user_cache_lookups_total', "Flask-Login user cache lookups, by result.", ['result'],
+                  lambda: {('hit',): cache.users.hits, ('miss',): cache.users.misses}, kind='counter')
+    metrics.gauge('user_cache_entries', "Users currently cached.", [],
+                  lambda: {(): cache.users.stats()['size']})
+    metrics.gauge('trends_cache_lookups_total', "/api/trends cache lookups, by result.", ['result'],
+                  lambda: {('hit',): cache.trends.hits, ('miss',): cache.trends.misses}, kind='counter')
+    metrics.gauge('trends_cache_bytes', "Bytes of /api/trends responses currently cached.", [],
+                  lambda: {(): cache.trends.size_bytes})
+    metrics.gauge('strava_sync_totals', "Totals across every incremental sync this process has run.", ['kind'],
+                  lambda: {(kind,): value for kind, value in collector.sync_totals.items()}, kind='counter')
+    metrics.gauge('strava_throttled_total', "Strava responses that were 429s.", [],
+                  lambda: {(): collector.client.rate_limiter.throttled}, kind='counter')
+    metrics.gauge('sync_queue_depth', "Sync jobs and webhook events waiting or running.", ['queue'],
+                  lambda: {(queue,): depth for queue, depth in database.get_queue_depths().items()})
+
+#Prometheus scrape target. Set METRICS_TOKEN to require "Authorization: Bearer <token>".
+@app.route('/metrics')
+def metrics_endpoint():
+    if not metrics.ENABLED:
+        abort(404)
+    token = os.getenv('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        abort(403)
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # FLASK LOGIN STUFF
 
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login_page'
 
+# Each gunicorn worker starts its own background sync scheduler on its first request
+@app.before_request
+def start_sync_scheduler():
+    scheduler.start()
+
+# With a pooled server database, request threads give their connection back when done
+@app.teardown_appcontext
+def release_db_connection(exception):
+    database.release_connection()
+
 class User(UserMixin):
-    def __init__(self, id, username, last_sync_time=0 ):
+    def __init__(self, id, username, last_sync_time=0, has_strava=False, mileage_goal=None, long_run_goal=None):
         self.id = id
         self.username = username
         self.last_sync_time = last_sync_time
+        self.has_strava = has_strava
+        self.mileage_goal = mileage_goal
+        self.long_run_goal = long_run_goal
         
 
+# Served from cache.users, so a warm authenticated request makes no queries here.
+# database.py invalidates the entry on token, goal and sync-time updates.
 @login_manager.user_loader
 def load_user(user_id):
-    user_row = database.get_user_by_id(user_id)
+    user_id = int(user_id)
+    user_row = cache.users.get(user_id)
+    if user_row is None:
+        user_row = database.get_user_summary(user_id)
+        if user_row:
+            cache.users.put(user_id, user_row)
     
     if user_row:
-        return User(id=user_row['id'], username=user_row['username'],last_sync_time=user_row['last_sync_time'])
+        return User(**user_row)
     return None
 
 # FRONTEND ROUTING
@@ -44,12 +114,12 @@ def load_user(user_id):
 @login_required
 def dashboard():
     current_time = time.time()
-    last_sync = current_user.last_sync_time
-    has_strava = database.user_has_strava(current_user.id)
+    last_sync = current_user.last_sync_time or 0
+    has_strava = current_user.has_strava
 
-    if current_time - last_sync > 900:
-        collector.fetch_and_save_user_data
-        database.update_last_sync_time(current_user.id)
+    # Never sync inline - queue it and let the page render with what we have
+    if has_strava and current_time - last_sync > scheduler.SYNC_INTERVAL_SECONDS:
+        scheduler.request_sync(current_user.id)
     
     
     return render_template('index.html', user=current_user, has_strava=has_strava)
@@ -67,16 +137,33 @@ def register_page():
 @app.route('/login', methods=['POST'])
 def login_action():
     username = request.form.get('username')
-    password = request.form.get('password')
+    password = request.form.get('password') or ''
+    started = time.perf_counter()
     
     # Check DB for username
     user_row = database.get_user_by_username(username)
-    is_valid_password = database.validate_password(username, password)
+    looked_up = time.perf_counter()
+    passwords.record('user_lookup', looked_up - started)
     
-    # Check Password Hash
-    if user_row and is_valid_password:
+    # Check Password Hash (on the hashing pool; unknown users are checked against a dummy hash)
+    try:
+        is_valid_password = passwords.verify(user_row['password_hash'] if user_row else None, password)
+    except passwords.HashingBusy:
+        flash("Too many people are logging in right now. Please try again.")
+        return render_template('login.html'), 503, {'Retry-After': '2'}
+    verified = time.perf_counter()
+    
+    if is_valid_password:
+        if passwords.needs_rehash(user_row['password_hash']):
+            user_id = user_row['id']
+            passwords.rehash_in_background(password, lambda new_hash: database.update_password_hash(user_id, new_hash))
+
         user_obj = User(id=user_row['id'], username=user_row['username'])
         login_user(user_obj)
+        passwords.record('session', time.perf_counter() - verified)
+        passwords.record('total', time.perf_counter() - started)
+        logger.info(f"Login for {username}: lookup {(looked_up - started) * 1000:.1f}ms, "
+                    f"password {(verified - looked_up) * 1000:.1f}ms, total {(time.perf_counter() - started) * 1000:.1f}ms")
 
         return redirect(url_for('dashboard'))
         
@@ -157,8 +244,7 @@ def strava_callback():
     
     try:
         collector.authorize_and_save_user(code, current_user.id)
-        collector.fetch_and_save_user_data(current_user.id)
-        database.update_last_sync_time(current_user.id)
+        scheduler.request_sync(current_user.id)
         
         flash("Connected! Syncing your runs now...")
         return redirect(url_for('dashboard'))
@@ -167,25 +253,226 @@ def strava_callback():
         return redirect(url_for('dashboard'))
 
 
-#Returns all activities, mileage goal, and long run goal for the current user as JSON.
+#Strava push subscription callback. GET is the one-time handshake Strava makes when the
+#subscription is created; POST delivers an event, which must be acknowledged within 2 seconds,
+#so it is only stored here and applied by the background scheduler.
+@app.route('/strava/webhook', methods=['GET'])
+def strava_webhook_handshake():
+    verify_token = os.getenv('STRAVA_WEBHOOK_VERIFY_TOKEN')
+    if (request.args.get('hub.mode') != 'subscribe' or not verify_token
+            or request.args.get('hub.verify_token') != verify_token):
+        return jsonify({'error': 'Verification failed'}), 403
+    return jsonify({'hub.challenge': request.args.get('hub.challenge')})
+
+@app.route('/strava/webhook', methods=['POST'])
+def strava_webhook_event():
+    event = request.get_json(silent=True) or {}
+    # Without a subscription ID to match there's no telling Strava's events from anyone else's
+    subscription_id = os.getenv('STRAVA_WEBHOOK_SUBSCRIPTION_ID')
+    if not subscription_id or str(event.get('subscription_id')) != subscription_id:
+        return jsonify({'error': 'Unknown subscription'}), 403
+    try:
+        database.enqueue_webhook_event(
+            str(event['object_type']), int(event['object_id']), str(event['aspect_type']),
+            int(event['owner_id']), int(event['event_time'])
+        )
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'Malformed event'}), 400
+
+    scheduler.notify()
+    return jsonify({'status': 'queued'})
+
+
+#Returns a page of activities (newest first), mileage goal, and long run goal for the current user as JSON.
+#Optional query args: since/until (YYYY-MM-DD), limit, and cursor (the next_cursor of the previous page).
+#Repeat requests that send back the ETag get an empty 304 unless something changed.
 @app.route('/api/activities')
 @login_required
 def get_activities_data():
-    activities = database.get_activities_for_user(current_user.id)
-    logger.info(f"API: Returning {len(activities)} activities for user: {current_user.username} (ID: {current_user.id})")
-    
-    athlete_row = database.get_row_from_athletes_table(current_user.id)
-    mileage_goal = athlete_row.get('mileage_goal', 0) if athlete_row else 0
-    long_run_goal = athlete_row.get('long_run_goal', 0) if athlete_row else 0
-    has_strava = database.user_has_strava(current_user.id)
+    try:
+        filters = _activity_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # The same version covers every page, so the query string is part of the ETag
+    version = database.get_activities_version(current_user.id)
+    etag = f"{version}:{request.query_string.decode()}" if version is not None else None
+    if etag is not None and request.if_none_match.contains(etag):
+        return _cache_headers(app.response_class(status=304), etag)
+
+    payload = database.get_activities_payload(current_user.id, **filters)
+    etag = f"{payload.pop('version')}:{request.query_string.decode()}"
+    logger.info(f"API: Returning {len(payload['activities'])} activities for user: {current_user.username} (ID: {current_user.id})")
     
+    return _cache_headers(jsonify(payload), etag)
+
+#Streams the current user's whole activity history as a download, newest first.
+#format is ndjson (default) or csv, gzip=1 compresses it, and since/until (YYYY-MM-DD) narrow it.
+@app.route('/api/activities/export')
+@login_required
+def export_activities():
+    format = request.args.get('format', 'ndjson')
+    if format not in export.FORMATS:
+        return jsonify({'error': f"format must be one of: {', '.join(export.FORMATS)}"}), 400
+    try:
+        filters = _date_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    rows = database.iter_activities(current_user.id, **filters)
+    body = export.encode(rows, format)
+    filename = f"activities.{format}"
+    mimetype = export.FORMATS[format]
+    if request.args.get('gzip') == '1':
+        body = export.gzip_chunks(body)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+
+    logger.info(f"API: Exporting activities as {filename} for user: {current_user.username} (ID: {current_user.id})")
+    response = app.response_class(body, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.headers['Cache-Control'] = 'private, no-store'
+    return response
+
+#Imports a Strava bulk export (the zip, or activities.csv from it) uploaded as the "archive" form field.
+#Lets users load years of history that the API sync's 30-day window never reaches.
+@app.route('/api/activities/import', methods=['POST'])
+@login_required
+def import_activities():
+    upload = request.files.get('archive')
+    if upload is None or not upload.filename:
+        return jsonify({'error': 'Upload a Strava export zip or activities.csv as "archive"'}), 400
+    try:
+        stats = importer.import_archive(current_user.id, upload.stream, upload.filename)
+    except (ValueError, zipfile.BadZipFile, UnicodeDecodeError) as e:
+        return jsonify({'error': f"Could not read the archive: {e}"}), 400
+
+    logger.info(f"API: Imported {stats['rows_written']} activities for user: {current_user.username} (ID: {current_user.id})")
+    return jsonify(stats)
+
+#Returns one week's per-day mileage, total, and progress against both goals.
+#start is any date in the week (YYYY-MM-DD); it defaults to the current week.
+@app.route('/api/weeks')
+@login_required
+def get_week_data():
+    start = request.args.get('start')
+    try:
+        day = datetime.date.fromisoformat(start) if start else datetime.date.today()
+    except ValueError:
+        return jsonify({'error': 'start must be a date in YYYY-MM-DD format'}), 400
+
+    week_start = day - datetime.timedelta(days=day.weekday())
+    return jsonify(database.get_week_summary(current_user.id, week_start))
+
+TREND_WEEKS = 26
+MAX_TREND_WEEKS = 1044
+
+#Weekly mileage, long run progression, goal hit rates and streaks between since and until (YYYY-MM-DD),
+#defaulting to the last TREND_WEEKS weeks. Responses are kept in cache.trends until the user's data changes.
+@app.route('/api/trends')
+@login_required
+def get_trends():
+    try:
+        filters = _date_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    until = datetime.date.fromisoformat(filters.get('until', datetime.date.today().isoformat()))
+    since = datetime.date.fromisoformat(filters['since']) if 'since' in filters else until - datetime.timedelta(weeks=TREND_WEEKS - 1)
+    if since > until:
+        return jsonify({'error': 'since must not be after until'}), 400
+    if (until - since).days > 7 * MAX_TREND_WEEKS:
+        return jsonify({'error': f'at most {MAX_TREND_WEEKS} weeks can be requested'}), 400
+
+    # Read before the history, so a write that lands while this request is
+    # computing leaves the entry with an old version instead of a stale one
+    state = database.get_trends_state(current_user.id)
+    etag = f"{state['version']}:{since}:{until}:{datetime.date.today()}"
+    if request.if_none_match.contains(etag):
+        return _cache_headers(app.response_class(status=304), etag)
+
+    key = (current_user.id, since, until, datetime.date.today())
+    entry = cache.trends.get(key)
+    if entry is None or entry[0] != state['version']:
+        trends = analytics.weekly_trends(analytics.load_history(current_user.id), since, until,
+                                         state['mileage_goal'], state['long_run_goal'])
+        body = app.json.dumps(trends).encode()
+        entry = (state['version'], body)
+        cache.trends.put(key, entry, len(body))
+
+    return _cache_headers(app.response_class(entry[1], mimetype='application/json'), etag)
+
+LEADERBOARD_SIZE = 10
+MAX_LEADERBOARD_SIZE = 100
+
+#Rankings across every user for the week or month containing date (default today), by total
+#distance or longest run. Returns the top `limit` users plus the current user's own rank.
+@app.route('/api/leaderboard')
+@login_required
+def get_leaderboard():
+    period = request.args.get('period', 'week')
+    metric = request.args.get('metric', 'distance')
+    if period not in database.LEADERBOARD_PERIODS:
+        return jsonify({'error': f"period must be one of: {', '.join(database.LEADERBOARD_PERIODS)}"}), 400
+    if metric not in database.LEADERBOARD_METRICS:
+        return jsonify({'error': f"metric must be one of: {', '.join(database.LEADERBOARD_METRICS)}"}), 400
+    try:
+        date = datetime.date.fromisoformat(request.args.get('date', datetime.date.today().isoformat()))
+    except ValueError:
+        return jsonify({'error': 'date must be a date in YYYY-MM-DD format'}), 400
+    try:
+        limit = int(request.args.get('limit', LEADERBOARD_SIZE))
+    except ValueError:
+        return jsonify({'error': 'limit must be a number'}), 400
+    if not 1 <= limit <= MAX_LEADERBOARD_SIZE:
+        return jsonify({'error': f'limit must be between 1 and {MAX_LEADERBOARD_SIZE}'}), 400
+
+    start, end = database.leaderboard_period_of(period, date)
     return jsonify({
-        'activities': activities,
-        'mileage_goal': mileage_goal,
-        'long_run_goal': long_run_goal,
-        'has_strava' : has_strava
+        'period': period,
+        'period_start': start,
+        'period_end': end,
+        'metric': metric,
+        'leaders': database.get_leaderboard(period, start, metric, limit),
+        'me': database.get_leaderboard_rank(current_user.id, period, start, metric),
     })
 
+ACTIVITY_PAGE_SIZE = 500
+MAX_ACTIVITY_PAGE_SIZE = 1000
+
+def _date_filters(args):
+    """Read the optional since/until date args. Raises ValueError on bad input."""
+    filters = {}
+    for name in ('since', 'until'):
+        if args.get(name):
+            try:
+                filters[name] = datetime.date.fromisoformat(args[name]).isoformat()
+            except ValueError:
+                raise ValueError(f"{name} must be a date in YYYY-MM-DD format")
+    return filters
+
+def _activity_filters(args):
+    """Read the /api/activities paging args. Raises ValueError on bad input."""
+    filters = _date_filters(args)
+
+    try:
+        limit = int(args.get('limit', ACTIVITY_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("limit must be a number")
+    if not 1 <= limit <= MAX_ACTIVITY_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_ACTIVITY_PAGE_SIZE}")
+    filters['limit'] = limit
+
+    if args.get('cursor'):
+        database.decode_cursor(args['cursor'])
+        filters['cursor'] = args['cursor']
+    return filters
+
+def _cache_headers(response, version):
+    # Browsers must revalidate every time, which they do by sending If-None-Match
+    response.set_etag(version)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 if __name__ == "__main__":
     database.init_db() 
     print("Database Started")
@@ -0,0 +1,130 @@
+"""
+asgi.py - Async serving mode.
+
+    uvicorn asgi:application --workers 2 --port 8000
+
+Under gunicorn's sync workers a request that waits on Strava holds a whole
+worker process for the length of the round trip. Here the Flask app is served
+by uvicorn through a2wsgi, which runs each request on a thread pool, so a slow
+request only holds one pool thread. /strava/callback, the only route that calls
+Strava while the user waits, is served natively on the event loop instead: the
+token exchange is awaited with httpx and only the short blocking parts go to a
+thread - loading the user and writing the response in a Flask request context
+(so Flask-Login, remember-me and the session cookie behave exactly as in the
+sync route) and the database writes. A few processes can then hold hundreds of
+connections open.
+
+The sync gunicorn setup in stravaapp.service keeps working unchanged.
+"""
+import asyncio
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from a2wsgi.wsgi import build_environ
+from flask import flash, redirect, session
+from flask_login import current_user
+
+import collector
+import scheduler
+from app import app
+
+# Threads for Flask requests (each holds one while it runs) and for the callback's database writes
+WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", "64"))
+DB_THREADS = int(os.getenv("ASGI_DB_THREADS", "16"))
+# Concurrent connections to Strava from one process
+HTTP_CONNECTIONS = 100
+
+
+class AsyncApp:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WSGIMiddleware(flask_app, workers=WSGI_THREADS)
+        self.executor = ThreadPoolExecutor(DB_THREADS, thread_name_prefix="asgi-db")
+        self.http = None
+        self.routes = {'/strava/callback': self.strava_callback}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        handler = self.routes.get(scope['path']) if scope['type'] == 'http' else None
+        if handler is not None and scope['method'] == 'GET':
+            return await handler(scope, send)
+        return await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.http = httpx.AsyncClient(
+                    timeout=httpx.Timeout(collector.StravaClient.READ_TIMEOUT,
+                                          connect=collector.StravaClient.CONNECT_TIMEOUT),
+                    limits=httpx.Limits(max_connections=HTTP_CONNECTIONS),
+                    transport=httpx.AsyncHTTPTransport(retries=collector.StravaClient.RETRIES),
+                )
+                await self.run_blocking(scheduler.start)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.http.aclose()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def run_blocking(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def strava_callback(self, scope, send):
+        """Async version of app.strava_callback."""
+        query = {key: values[0] for key, values in parse_qs(scope['query_string'].decode()).items()}
+        environ = build_environ(scope, io.BytesIO())
+        user_id, user_session = await self.run_blocking(self.load_user, environ)
+        if user_id is None:
+            return await self.send_response(send, redirect('/login'))
+
+        if query.get('error') == 'access_denied':
+            message = "Connection cancelled"
+        elif not query.get('code'):
+            message = "No code recieved"
+        else:
+            message = None
+            try:
+                data = await collector.exchange_code_for_tokens_async(self.http, query['code'])
+                await self.run_blocking(collector.save_authorization, user_id, data)
+                await self.run_blocking(scheduler.request_sync, user_id)
+                message = "Connected! Syncing your runs now..."
+            except Exception as e:
+                print(f"OAuth failed: {e}")
+        response = await self.run_blocking(self.finish_response, environ, user_session, message)
+        return await self.send_response(send, response)
+
+    # The blocking halves of the callback, each run in a Flask request context
+
+    def load_user(self, environ):
+        # Flask-Login loads the user (from the session or the remember cookie, with
+        # session protection). Returns (user id or None, the session to write back).
+        with self.flask_app.request_context(environ):
+            if not current_user.is_authenticated:
+                return None, None
+            return current_user.id, session._get_current_object()
+
+    def finish_response(self, environ, user_session, message):
+        # Redirects home, saving the session (and any remember cookie update) the
+        # same way Flask would, so its permanence and expiry are kept.
+        ctx = self.flask_app.request_context(environ)
+        ctx.session = user_session
+        with ctx:
+            if message:
+                flash(message)
+            return self.flask_app.process_response(redirect('/'))
+
+    async def send_response(self, send, response):
+        headers = [(key.lower().encode('latin-1'), value.encode('latin-1'))
+                   for key, value in response.headers.items()]
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': response.get_data()})
+
+
+application = AsyncApp(app)
@@ -0,0 +1,88 @@
+"""
+bench_analytics.py - Time to load one user's history and compute training load,
+pace trend and weekly trends (/api/trends) with analytics.py, for ten years of data.
+
+Usage: python benchmarks/bench_analytics.py [--years 10] [--per-week 9] [--repeat 50]
+"""
+import argparse
+import datetime
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from cryptography.fernet import Fernet
+
+os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
+
+import analytics
+import database
+
+
+def make_history(user_id, years, per_week):
+    start = datetime.date.today() - datetime.timedelta(days=365 * years)
+    count = int(years * 52 * per_week)
+    for i in range(count):
+        miles = 3.0 + (i % 12)
+        yield {
+            'user_id': user_id,
+            'activity_id': i + 1,
+            'date': (start + datetime.timedelta(days=i * 7 // per_week)).isoformat(),
+            'distance': miles,
+            'moving_time': int(miles * (480 + i % 90)),
+            'elapsed_time': int(miles * (500 + i % 90)),
+            'elevation_gain': float(i % 120),
+            'average_heartrate': 140.0 + i % 25,
+            'activity_type': 'Ride' if i % 10 == 0 else 'Run',
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--years', type=int, default=10)
+    parser.add_argument('--per-week', type=int, default=9)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_NAME = os.path.join(tmp, 'analytics.db')
+        database.init_db()
+        user_id = database.create_user('bench', 'benchpassword')
+        count = database.create_activities_bulk(make_history(user_id, args.years, args.per_week))
+
+        # The first load after an ingest rebuilds the packed columns from DailyMileage
+        started = time.perf_counter()
+        analytics.load_history(user_id)
+        cold = time.perf_counter() - started
+
+        since = datetime.date.today() - datetime.timedelta(days=365 * args.years)
+        stages = {'load_history': [], 'training_load': [], 'pace_trend': [], 'weekly_trends': [], 'total': []}
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            history = analytics.load_history(user_id)
+            loaded = time.perf_counter()
+            analytics.training_load(history)
+            load_done = time.perf_counter()
+            analytics.pace_trend(history)
+            pace_done = time.perf_counter()
+            analytics.weekly_trends(history, since, datetime.date.today(), 30, 12)
+            finished = time.perf_counter()
+            stages['load_history'].append(loaded - started)
+            stages['training_load'].append(load_done - loaded)
+            stages['pace_trend'].append(pace_done - load_done)
+            stages['weekly_trends'].append(finished - pace_done)
+            stages['total'].append(finished - started)
+
+        print(f"{count} activities over {args.years} years")
+        print(f"  first load after ingest: {cold * 1000:6.2f} ms")
+        print(f"  median of {args.repeat} runs:")
+        for stage, timings in stages.items():
+            print(f"  {stage:>14}: {statistics.median(timings) * 1000:6.2f} ms")
+        database.close_connection()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+bench_asgi.py - Load test of the sync (gunicorn) and async (uvicorn asgi:application)
+serving modes against a local fake Strava that takes --latency seconds per call.
+
+Each of --concurrency clients logs in as its own user and repeatedly hits
+/strava/callback (one Strava round trip) and /api/weeks (database only).
+
+Usage: python benchmarks/bench_asgi.py [--concurrency 200] [--rounds 3] [--latency 0.25]
+                                       [--modes sync asgi]
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, REPO)
+sys.path.insert(0, os.path.join(REPO, 'tests'))
+
+import requests
+from requests.adapters import HTTPAdapter
+from cryptography.fernet import Fernet
+
+os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
+os.environ.setdefault("FLASK_SECRET_KEY", "bench-secret")
+os.environ["SYNC_SCHEDULER_ENABLED"] = "0"
+
+import database
+from app import app
+from fake_strava import FakeStrava
+
+SERVERS = {
+    # The production command from stravaapp.service
+    'sync': ['gunicorn', '--workers', '4', '--timeout', '120', '--pythonpath', REPO,
+             '--bind', '127.0.0.1:{port}', 'app:app'],
+    'asgi': ['uvicorn', 'asgi:application', '--app-dir', REPO, '--workers', '2',
+             '--host', '127.0.0.1', '--port', '{port}', '--log-level', 'warning'],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode, workdir, strava_url):
+    port = free_port()
+    command = [part.format(port=port) for part in SERVERS[mode]]
+    env = dict(os.environ, STRAVA_URL=strava_url)
+    # Relative DB_NAME, so the server uses the database in workdir
+    process = subprocess.Popen(command, cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.get(f"{url}/login", timeout=1)
+            return process, url
+        except requests.RequestException:
+            # Refused before it listens, or a read timeout while workers are still booting
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"{mode} server did not start")
+
+
+def make_session(user_id, size):
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_maxsize=size))
+    cookie = app.session_interface.get_signing_serializer(app).dumps({'_user_id': str(user_id)})
+    session.cookies.set('session', cookie)
+    return session
+
+
+def run_client(url, user_id, athlete_id, rounds):
+    session = make_session(user_id, 2)
+    timings = {'callback': [], 'weeks': []}
+    errors = 0
+    for _ in range(rounds):
+        for name, path in (('callback', f"/strava/callback?code=code-{athlete_id}"),
+                           ('weeks', "/api/weeks?start=2025-03-03")):
+            started = time.perf_counter()
+            try:
+                response = session.get(url + path, allow_redirects=False, timeout=120)
+                errors += response.status_code >= 400
+            except requests.RequestException:
+                errors += 1
+            timings[name].append(time.perf_counter() - started)
+    return timings, errors
+
+
+def load_test(mode, workdir, strava, users, rounds):
+    process, url = start_server(mode, workdir, strava.url)
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(len(users)) as pool:
+            results = list(pool.map(lambda user: run_client(url, user[0], user[1], rounds), users))
+        elapsed = time.perf_counter() - started
+    finally:
+        process.terminate()
+        process.wait()
+
+    total = sum(len(timings[name]) for timings, _ in results for name in timings)
+    print(f"{mode:>5}: {total / elapsed:7.1f} req/s  ({total} requests in {elapsed:.1f}s, "
+          f"{sum(errors for _, errors in results)} errors)")
+    for name in ('callback', 'weeks'):
+        latencies = sorted(t for timings, _ in results for t in timings[name])
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+        print(f"       {name:>8}: p50 {statistics.median(latencies) * 1000:7.0f} ms   p95 {p95 * 1000:7.0f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.25, help="fake Strava seconds per call")
+    parser.add_argument('--modes', nargs='+', choices=list(SERVERS), default=list(SERVERS))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir, FakeStrava(latency=args.latency) as strava:
+        database.DB_NAME = os.path.join(workdir, database.DB_NAME)
+        database.init_db()
+        users = []
+        for athlete_id in range(1, args.concurrency + 1):
+            users.append((database.create_user(f"runner{athlete_id}", 'password'), athlete_id))
+        database.close_connection()
+
+        print(f"{args.concurrency} concurrent clients, {args.rounds} rounds, "
+              f"Strava latency {args.latency * 1000:.0f} ms")
+        for mode in args.modes:
+            load_test(mode, workdir, strava, users, args.rounds)
+
+
+if __name__ == '__main__':
+    main()
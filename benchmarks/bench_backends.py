@@ -0,0 +1,102 @@
+"""
+bench_backends.py - Write-heavy ingest throughput with --workers processes
+writing at once, each bulk-inserting runs for its own users, on whichever
+backend DATABASE_URL selects (SQLite when unset).
+
+Run it once as-is and once with DATABASE_URL=postgresql://... to compare. A
+PostgreSQL database is emptied first, so point it at a scratch database.
+
+Usage: python benchmarks/bench_backends.py [--workers 1,2,4,8] [--users 50] [--runs 200]
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from cryptography.fernet import Fernet
+
+os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
+
+import database
+
+
+def make_runs(user_ids, runs, first_activity_id):
+    rng = random.Random(first_activity_id)
+    activity_id = first_activity_id
+    for user_id in user_ids:
+        for run in range(runs):
+            activity_id += 1
+            yield {
+                'user_id': user_id,
+                'activity_id': activity_id,
+                'date': f"{2020 + run % 5}-{1 + run % 12:02d}-{1 + run % 28:02d}",
+                'distance': round(rng.uniform(2.0, 22.0), 2),
+            }
+
+
+def ingest(db_name, user_ids, runs, first_activity_id, start):
+    # Runs in a worker process; waits for the others so the writes overlap
+    database.DB_NAME = db_name
+    start.wait()
+    # Small chunks, like webhook-driven syncs, so writers interleave
+    rows = database.create_activities_bulk(make_runs(user_ids, runs, first_activity_id), chunk_size=50)
+    database.release_connection()
+    return rows
+
+
+def reset(db_name):
+    database.DB_NAME = db_name
+    if database.backend.pooled:
+        conn = database.get_connection()
+        conn.execute("DROP SCHEMA public CASCADE")
+        conn.execute("CREATE SCHEMA public")
+    elif os.path.exists(db_name):
+        database.close_connection()
+        os.remove(db_name)
+    database.init_db()
+
+
+def run(db_name, workers, users, runs):
+    reset(db_name)
+    conn = database.get_connection()
+    with conn:
+        conn.executemany("INSERT INTO Users (id, username, password_hash) VALUES (?, ?, 'x')",
+                         ((i, f"runner{i}") for i in range(1, workers * users + 1)))
+    database.release_connection()
+
+    context = multiprocessing.get_context('spawn')
+    with context.Manager() as manager, context.Pool(workers) as pool:
+        start = manager.Barrier(workers + 1)
+        results = [
+            pool.apply_async(ingest, (db_name, range(w * users + 1, (w + 1) * users + 1),
+                                      runs, w * users * runs, start))
+            for w in range(workers)
+        ]
+        start.wait()
+        started = time.perf_counter()
+        rows = sum(result.get() for result in results)
+        return rows, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default='1,2,4,8', help="comma-separated process counts")
+    parser.add_argument('--users', type=int, default=50, help="users per worker")
+    parser.add_argument('--runs', type=int, default=200, help="runs per user")
+    args = parser.parse_args()
+
+    print(f"backend: {database.backend.name}")
+    with tempfile.TemporaryDirectory() as tmp:
+        db_name = os.path.join(tmp, 'backends.db')
+        for workers in (int(w) for w in args.workers.split(',')):
+            rows, seconds = run(db_name, workers, args.users, args.runs)
+            print(f"  {workers:>2} writers: {rows:>7} rows in {seconds:6.2f} s ({rows / seconds:9,.0f} rows/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+bench_connections.py - Requests/sec for GET /api/activities with and without
+the pooled connection in database.get_connection.
+
+Usage: python benchmarks/bench_connections.py [--requests 2000] [--activities 200]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from cryptography.fernet import Fernet
+
+os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
+os.environ.setdefault("FLASK_SECRET_KEY", "bench")
+
+import database
+from app import app
+
+
+def unpooled_connection():
+    """The old behaviour: a brand new connection for every helper call."""
+    conn = sqlite3.connect(database.DB_NAME)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def seed(activity_count):
+    database.init_db()
+    user_id = database.create_user('bench', 'benchpassword')
+    database.create_athlete_with_goals(user_id, 30, 10)
+    for i in range(activity_count):
+        database.create_activity(user_id, f"2024-{1 + i % 12:02d}-{1 + i % 28:02d}", 5.0, i + 1)
+    return user_id
+
+
+def run(client, request_count):
+    start = time.perf_counter()
+    for _ in range(request_count):
+        response = client.get('/api/activities')
+        assert response.status_code == 200
+    return request_count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--activities', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_NAME = os.path.join(tmp, 'bench.db')
+        user_id = seed(args.activities)
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+
+        pooled_get_connection = database.get_connection
+        database.get_connection = unpooled_connection
+        before = run(client, args.requests)
+
+        database.get_connection = pooled_get_connection
+        after = run(client, args.requests)
+        database.close_connection()
+
+    print(f"unpooled: {before:8.1f} req/s")
+    print(f"pooled:   {after:8.1f} req/s  ({after / before:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
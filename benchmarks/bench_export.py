@@ -0,0 +1,67 @@
+"""
+bench_export.py - Time to first byte, throughput and peak Python memory for
+GET /api/activities/export over a large activity history.
+
+Usage: python benchmarks/bench_export.py [--rows 1000000] [--format ndjson|csv] [--gzip]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from cryptography.fernet import Fernet
+
+os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
+os.environ.setdefault("FLASK_SECRET_KEY", "bench-secret")
+os.environ.setdefault("SYNC_SCHEDULER_ENABLED", "0")
+
+import database
+from app import app
+from bench_ingest import make_activities
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--format', choices=['ndjson', 'csv'], default='ndjson')
+    parser.add_argument('--gzip', action='store_true')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_NAME = os.path.join(tmp, 'export.db')
+        database.init_db()
+        user_id = database.create_user('bench', 'benchpassword')
+        database.create_activities_bulk(make_activities(user_id, args.rows))
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+
+        url = f"/api/activities/export?format={args.format}" + ("&gzip=1" if args.gzip else "")
+        tracemalloc.start()
+        start = time.perf_counter()
+        response = client.get(url, buffered=False)
+        first_byte = None
+        size = 0
+        for chunk in response.response:
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            size += len(chunk)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        response.close()
+
+        print(f"{args.rows} rows as {url}")
+        print(f"  first byte: {first_byte * 1000:.1f} ms")
+        print(f"  total:      {elapsed:.1f} s ({args.rows / elapsed:.0f} rows/s, {size / 1e6:.1f} MB)")
+        print(f"  peak Python memory: {peak / 1e6:.1f} MB")
+        database.close_connection()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+bench_import.py - Rows/sec for importing a Strava bulk export with importer.py,
+using a synthetic activities.csv (optionally zipped, as Strava ships it).
+
+Usage: python benchmarks/bench_import.py [--activities 50000] [--zip]
+"""
+import argparse
+import csv
+import datetime
+import os
+import sys
+import tempfile
+import zipfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from cryptography.fernet import Fernet
+
+os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
+
+import database
+import importer
+
+HEADER = ['Activity ID', 'Activity Date', 'Activity Name', 'Activity Type', 'Activity Description',
+          'Elapsed Time', 'Distance', 'Max Heart Rate', 'Relative Effort', 'Commute',
+          'Elapsed Time', 'Moving Time', 'Distance', 'Max Speed', 'Average Speed', 'Elevation Gain']
+
+
+def write_archive(path, count):
+    """Write a synthetic activities.csv with count activities, two per day going back from 2025."""
+    start = datetime.datetime(2025, 1, 1, 7, 0, 0)
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(HEADER)
+        for i in range(count):
+            started = start - datetime.timedelta(hours=12 * i)
+            meters = 3000.0 + (i % 20) * 750
+            writer.writerow([
+                10_000_000 + i, started.strftime(importer.ARCHIVE_DATE_FORMAT), f"Run {i}", 'Run', '',
+                1800, f"{meters / 1000:.2f}", 170, 40, 'false',
+                1800, 1750, f"{meters:.1f}", 4.5, 3.2, 25.0,
+            ])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--activities', type=int, default=50000)
+    parser.add_argument('--zip', action='store_true', help="import from a zipped export")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        archive = os.path.join(tmp, 'activities.csv')
+        write_archive(archive, args.activities)
+        if args.zip:
+            with zipfile.ZipFile(os.path.join(tmp, 'export.zip'), 'w', zipfile.ZIP_DEFLATED) as export:
+                export.write(archive, 'export/activities.csv')
+            archive = os.path.join(tmp, 'export.zip')
+
+        database.DB_NAME = os.path.join(tmp, 'import.db')
+        database.init_db()
+        user_id = database.create_user('bench', 'benchpassword')
+
+        stats = importer.import_archive(user_id, archive)
+        assert stats['rows_written'] == args.activities
+        print(f"{args.activities} activities from {os.path.basename(archive)}: "
+              f"{stats['seconds']:.2f}s ({stats['rows_written'] / stats['seconds']:.0f} rows/s)")
+
+        repeat = importer.import_archive(user_id, archive)
+        print(f"re-import (all duplicates): {repeat['seconds']:.2f}s "
+              f"({repeat['rows_read'] / repeat['seconds']:.0f} rows/s, {repeat['rows_written']} written)")
+        database.close_connection()
+
+
+if __name__ == '__main__':
+    main()
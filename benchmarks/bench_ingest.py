@@ -0,0 +1,75 @@
+"""
+bench_ingest.py - Rows/sec for activity imports, one create_activity call per
+row versus database.create_activities_bulk.
+
+Usage: python benchmarks/bench_ingest.py [--sizes 10000 100000] [--skip-single]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from cryptography.fernet import Fernet
+
+os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
+
+import database
+
+
+def make_activities(user_id, count):
+    for i in range(count):
+        yield {
+            'user_id': user_id,
+            'date': f"{2000 + i // 366:04d}-{1 + i % 12:02d}-{1 + i % 28:02d}",
+            'distance': 3.1 + (i % 10),
+            'activity_id': i + 1,
+        }
+
+
+def fresh_database(tmp, name):
+    database.close_connection()
+    database.DB_NAME = os.path.join(tmp, name)
+    database.init_db()
+    return database.create_user('bench', 'benchpassword')
+
+
+def time_single(tmp, count):
+    user_id = fresh_database(tmp, f'single_{count}.db')
+    start = time.perf_counter()
+    for activity in make_activities(user_id, count):
+        database.create_activity(**activity)
+    return count / (time.perf_counter() - start)
+
+
+def time_bulk(tmp, count):
+    user_id = fresh_database(tmp, f'bulk_{count}.db')
+    start = time.perf_counter()
+    inserted = database.create_activities_bulk(make_activities(user_id, count))
+    elapsed = time.perf_counter() - start
+    assert inserted == count
+    return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--skip-single', action='store_true',
+                        help="only time the bulk path (the per-row path is slow at 100k)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in args.sizes:
+            bulk = time_bulk(tmp, count)
+            line = f"{count:>7} rows  bulk: {bulk:10.0f} rows/s"
+            if not args.skip_single:
+                single = time_single(tmp, count)
+                line += f"  per-row: {single:8.0f} rows/s  ({bulk / single:.1f}x)"
+            print(line)
+        database.close_connection()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+bench_leaderboard.py - Leaderboard cost with --users users: ingesting a month of
+runs with the rankings kept current, a full rebuild, and top-K and "my rank"
+lookups against the Fenwick tree versus a COUNT(*) over the ranking index.
+
+Usage: python benchmarks/bench_leaderboard.py [--users 100000] [--runs 3] [--lookups 1000]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from cryptography.fernet import Fernet
+
+os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
+
+import database
+
+WEEK = '2025-03-03'
+MONTH = '2025-03-01'
+
+
+def make_runs(users, runs):
+    activity_id = 0
+    for user_id in range(1, users + 1):
+        for run in range(runs):
+            activity_id += 1
+            yield {
+                'user_id': user_id,
+                'activity_id': activity_id,
+                'date': f"2025-03-{3 + run * 2:02d}",
+                'distance': round(random.uniform(2.0, 22.0), 2),
+            }
+
+
+def naive_rank(user_id):
+    conn = database.get_connection()
+    value = conn.execute(
+        """SELECT value FROM LeaderboardEntries
+           WHERE period = 'week' AND period_start = ? AND metric = 'distance' AND user_id = ?""",
+        (WEEK, user_id)
+    ).fetchone()['value']
+    # Smallest value that rounds into a higher bucket, so ties match the tree's
+    above = (round(value / database.LEADERBOARD_RESOLUTION) + 0.5) * database.LEADERBOARD_RESOLUTION
+    return conn.execute(
+        """SELECT COUNT(*) + 1 FROM LeaderboardEntries
+           WHERE period = 'week' AND period_start = ? AND metric = 'distance' AND value >= ?""",
+        (WEEK, above)
+    ).fetchone()[0]
+
+
+def median_ms(function, args_list):
+    timings = []
+    for args in args_list:
+        started = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000, max(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--runs', type=int, default=3, help="runs per user in the benchmark week")
+    parser.add_argument('--lookups', type=int, default=1000)
+    args = parser.parse_args()
+    random.seed(1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_NAME = os.path.join(tmp, 'leaderboard.db')
+        database.init_db()
+        # Straight inserts: create_user's password hashing would take hours at this scale
+        conn = database.get_connection()
+        with conn:
+            conn.executemany("INSERT INTO Users (id, username, password_hash) VALUES (?, ?, 'x')",
+                             ((i, f"runner{i}") for i in range(1, args.users + 1)))
+
+        started = time.perf_counter()
+        rows = database.create_activities_bulk(make_runs(args.users, args.runs))
+        ingest = time.perf_counter() - started
+        print(f"{args.users} users, {rows} runs")
+        print(f"  ingest with rankings kept current: {ingest:6.2f} s ({rows / ingest:,.0f} rows/s)")
+
+        started = time.perf_counter()
+        database.rebuild_leaderboards()
+        print(f"  full rebuild:                      {time.perf_counter() - started:6.2f} s")
+
+        sample = [(random.randint(1, args.users),) for _ in range(args.lookups)]
+        for name, function, calls in (
+            ('top 10', lambda: database.get_leaderboard('week', WEEK, 'distance', 10), [()] * args.lookups),
+            ('my rank (tree)', lambda user_id: database.get_leaderboard_rank(user_id, 'week', WEEK, 'distance'), sample),
+            ('my rank (COUNT)', naive_rank, sample),
+        ):
+            median, worst = median_ms(function, calls)
+            print(f"  {name:>16}: median {median:7.3f} ms   max {worst:7.3f} ms")
+
+        mismatches = sum(
+            database.get_leaderboard_rank(user_id, 'week', WEEK, 'distance')['rank'] != naive_rank(user_id)
+            for user_id, in sample[:100]
+        )
+        print(f"  rank mismatches in 100 checks: {mismatches}")
+        database.close_connection()
+
+
+if __name__ == '__main__':
+    main()
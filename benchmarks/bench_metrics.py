@@ -0,0 +1,60 @@
+"""
+bench_metrics.py - Per-call cost of the /metrics instrumentation on a hot database
+function and on a full Flask request.
+
+Usage: python benchmarks/bench_metrics.py [--calls 20000]
+
+Run again with METRICS_ENABLED=0 to compare; functions are then left unwrapped.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from cryptography.fernet import Fernet
+
+os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
+os.environ.setdefault("FLASK_SECRET_KEY", "bench-secret")
+os.environ.setdefault("SYNC_SCHEDULER_ENABLED", "0")
+
+import database
+import metrics
+from app import app
+
+
+def per_call(function, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        function()
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_NAME = os.path.join(tmp, 'metrics.db')
+        database.init_db()
+        user_id = database.create_user('bench', 'benchpassword')
+        database.create_athlete_with_goals(user_id, 30, 10)
+
+        summary = database.get_user_summary
+        raw = getattr(summary, '__wrapped__', summary)
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+
+        print(f"metrics {'enabled' if metrics.ENABLED else 'disabled'}")
+        print(f"  get_user_summary:     {per_call(lambda: summary(user_id), args.calls):7.2f} us/call")
+        print(f"    (unwrapped):        {per_call(lambda: raw(user_id), args.calls):7.2f} us/call")
+        print(f"  GET /api/weeks:       {per_call(lambda: client.get('/api/weeks'), args.calls // 10):7.1f} us/request")
+        database.close_connection()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+bench_sync.py - Users synced per minute by scheduler.sync_all_users against the
+local fake Strava, sequentially and with a thread pool.
+
+Usage: python benchmarks/bench_sync.py [--users 100] [--latency 0.05] [--workers 1 8 16]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+from cryptography.fernet import Fernet
+
+os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
+
+import collector
+import database
+import scheduler
+from fake_strava import FakeStrava
+
+
+def seed(user_count):
+    database.init_db()
+    conn = database.get_connection()
+    # Skip create_user's password hashing; it isn't what is being measured
+    with conn:
+        conn.executemany(
+            "INSERT INTO Users (id, username, password_hash) VALUES (?, ?, 'x')",
+            [(athlete_id, f'runner{athlete_id}') for athlete_id in range(1, user_count + 1)]
+        )
+    for athlete_id in range(1, user_count + 1):
+        database.save_user_tokens_and_info(
+            athlete_id, f'athlete-{athlete_id}', f'refresh-{athlete_id}', int(time.time()) + 3600, athlete_id
+        )
+        database.update_last_activity_time(athlete_id, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--activities', type=int, default=365)
+    parser.add_argument('--latency', type=float, default=0.05, help="simulated Strava latency per request (s)")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 8, 16])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp, \
+         FakeStrava(activities_per_athlete=args.activities, latency=args.latency) as strava:
+        for workers in args.workers:
+            database.close_connection()
+            database.DB_NAME = os.path.join(tmp, f'sync_{workers}.db')
+            collector.client = collector.StravaClient(base_url=strava.url)
+            # The collector prints a line per user; keep the report readable
+            with contextlib.redirect_stdout(io.StringIO()):
+                seed(args.users)
+                summary = scheduler.sync_all_users(max_workers=workers)
+            per_minute = summary['synced'] / summary['seconds'] * 60
+            print(f"workers={workers:<3} {per_minute:8.0f} users/min  "
+                  f"({summary['api_calls']} API calls, {summary['throttled']} throttled)")
+        print(f"fake Strava rejected {strava.rejected} requests")
+
+
+if __name__ == '__main__':
+    main()
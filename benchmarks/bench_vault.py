@@ -0,0 +1,93 @@
+"""
+bench_vault.py - Strava token decrypts per second: the old path (both tokens
+through one Fernet per user), lazy per-field decrypts, the bulk read a batch
+sync uses, decrypting mid-rotation against MultiFernet, and a full
+re-encryption pass.
+
+Usage: python benchmarks/bench_vault.py [--users 5000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from cryptography.fernet import Fernet, MultiFernet
+
+os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
+
+import database
+import vault
+
+
+def seed(users):
+    database.init_db()
+    expires_at = int(time.time()) + 3600
+    conn = database.get_connection()
+    with conn:
+        conn.executemany(
+            """INSERT INTO Users (id, username, password_hash, strava_access_token, strava_refresh_token, token_expiration)
+               VALUES (?, ?, 'x', ?, ?, ?)""",
+            ((i, f"runner{i}", database.encrypt_token(f"access-{i}"), database.encrypt_token(f"refresh-{i}"), expires_at)
+             for i in range(1, users + 1))
+        )
+    return list(range(1, users + 1))
+
+
+def report(name, tokens, seconds):
+    print(f"  {name:<34} {tokens / seconds:>10,.0f} tokens/s")
+
+
+def timed(function):
+    started = time.perf_counter()
+    function()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_NAME = os.path.join(tmp, 'vault.db')
+        user_ids = seed(args.users)
+        access = [row[0] for row in database.get_connection().execute("SELECT strava_access_token FROM Users")]
+        print(f"{args.users} users")
+
+        # Rates are per access token actually used
+        def both_tokens():
+            for user_id in user_ids:
+                tokens = database.get_user_tokens(user_id)
+                tokens['strava_access_token'], tokens['strava_refresh_token']
+        seconds = timed(both_tokens)
+        report("both tokens, per user (old)", len(user_ids), seconds)
+        seconds = timed(lambda: [database.get_user_tokens(i)['strava_access_token'] for i in user_ids])
+        report("access only, per user (lazy)", len(user_ids), seconds)
+        seconds = timed(lambda: database.get_access_tokens(user_ids))
+        report("access only, bulk read", len(user_ids), seconds)
+
+        # Mid-rotation: every stored token still uses the old key
+        keys = [Fernet.generate_key(), os.environ["ENCRYPTION_KEY"]]
+        multi = MultiFernet([Fernet(key) for key in keys])
+        seconds = timed(lambda: [multi.decrypt(token.encode()) for token in access])
+        report("old key, MultiFernet", len(access), seconds)
+        rotating = vault.Vault(keys)
+        seconds = timed(lambda: [rotating.decrypt(token) for token in access])
+        report("old key, Vault", len(access), seconds)
+
+        database.token_vault = rotating
+
+        def rotate_all():
+            after = 0
+            while after is not None:
+                after, _ = database.rotate_token_keys(after)
+        seconds = timed(rotate_all)
+        report("re-encryption pass (2 per user)", 2 * args.users, seconds)
+        database.close_connection()
+
+
+if __name__ == '__main__':
+    main()
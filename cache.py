@@ -0,0 +1,191 @@
+"""
+cache.py - In-process caches shared by the app, collector and database modules.
+
+Each gunicorn worker has its own copy. database.py invalidates entries whenever
+it writes the data they were built from.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Access tokens are treated as expired this many seconds early, matching the refresh check
+TOKEN_EXPIRY_MARGIN = 300
+# Refresh locks shared out between users. Users on the same stripe only wait on
+# each other while one of them is actually refreshing.
+TOKEN_LOCK_STRIPES = 64
+
+
+class TokenCache:
+    """Decrypted Strava access tokens, keyed by user ID, kept until just before they expire.
+
+    lock_for(user_id) gives the user's lock from a fixed set of striped locks,
+    so only one refresh per user runs at a time (single flight) without keeping
+    a lock for every user ever seen. Every invalidation bumps a per-user generation. A
+    put() for a generation that has since been invalidated is dropped, so a
+    slow reader can't cache tokens that were replaced while it was busy.
+    """
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._entries = {}
+        self._generations = {}
+        self._user_locks = [threading.Lock() for _ in range(TOKEN_LOCK_STRIPES)]
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        access_token, expires_at = entry
+        if self._clock() >= expires_at - TOKEN_EXPIRY_MARGIN:
+            return None
+        return access_token
+
+    def generation(self, user_id):
+        return self._generations.get(user_id, 0)
+
+    def put(self, user_id, access_token, expires_at, generation):
+        with self._lock:
+            if self._generations.get(user_id, 0) == generation:
+                self._entries[user_id] = (access_token, expires_at)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            for user_id in list(self._entries):
+                self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            self._entries.clear()
+
+    def lock_for(self, user_id):
+        return self._user_locks[hash(user_id) % len(self._user_locks)]
+
+
+class TTLCache:
+    """A small thread-safe cache whose entries expire after ttl seconds.
+
+    hits and misses are counted so the hit rate can be monitored. When
+    max_entries is reached, the entry closest to expiring is evicted.
+    """
+
+    def __init__(self, ttl, max_entries=10000, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] > self._clock():
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.max_entries:
+                oldest = min(self._entries, key=lambda k: self._entries[k][1])
+                del self._entries[oldest]
+            self._entries[key] = (value, self._clock() + self.ttl)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+class LRUCache:
+    """A thread-safe cache that keeps its entries under a total size budget.
+
+    Each put() says how many bytes its value takes; once the total passes
+    max_bytes the least recently used entries are evicted. Keys are tuples whose
+    first item is a group (e.g. a user ID), so invalidate_group can drop all of
+    one user's entries at once.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size_bytes = 0
+        self._entries = OrderedDict()
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, size)
+            self._groups.setdefault(key[0], set()).add(key)
+            self.size_bytes += size
+            while self.size_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate_group(self, group):
+        with self._lock:
+            for key in list(self._groups.get(group, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._groups.clear()
+            self.size_bytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'size': len(self._entries), 'size_bytes': self.size_bytes}
+
+    def _remove(self, key):
+        # Caller holds self._lock
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.size_bytes -= entry[1]
+        keys = self._groups[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._groups[key[0]]
+
+
+tokens = TokenCache()
+
+# Rows for Flask-Login's user_loader. Other workers' writes only show up once
+# an entry expires, so the TTL is kept short.
+USER_CACHE_TTL = 30
+users = TTLCache(USER_CACHE_TTL)
+
+# Encoded /api/trends responses, keyed by (user_id, since, until). Each entry
+# also carries the data version it was built from, so another worker's writes
+# are noticed on the next request.
+TRENDS_CACHE_BYTES = int(os.getenv("TRENDS_CACHE_BYTES", str(16 * 1024 * 1024)))
+trends = LRUCache(TRENDS_CACHE_BYTES)
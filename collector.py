@@ -1,35 +1,164 @@
+import asyncio
 import os
 from dotenv import load_dotenv
 import datetime
 import time
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import cache
 import database
+import metrics
+import ratelimit
 
 #info about the athlete is stored in the database, so no need to store it here
 
 load_dotenv()
 
-def exchange_code_for_tokens(code):
-    client_id = os.getenv("STRAVA_CLIENT_ID")
-    client_secret = os.getenv("STRAVA_CLIENT_SECRET")
+class StravaClient:
+    """Every call this app makes to Strava goes through one of these.
 
-    payload = {
-        'client_id': client_id,
-        'client_secret': client_secret,
+    It owns a pooled requests.Session (connections are kept alive and shared
+    across threads), retries GETs that hit a 5xx with exponential backoff, sets
+    connect/read timeouts, paces requests with a StravaRateLimiter and records
+    latency per endpoint.
+    """
+
+    CONNECT_TIMEOUT = 3.05
+    READ_TIMEOUT = 15
+    POOL_SIZE = 32
+    RETRIES = 3
+    BACKOFF_FACTOR = 0.5
+    # 429 is left to the rate limiter, which waits for Strava's window to reset
+    RETRY_STATUSES = (500, 502, 503, 504)
+
+    def __init__(self, base_url=None, rate_limiter=None):
+        # Overridable so tests and benchmarks can point at a local fake Strava
+        self.base_url = base_url or os.getenv("STRAVA_URL", "https://www.strava.com")
+        self.rate_limiter = rate_limiter or ratelimit.StravaRateLimiter()
+        self.session = requests.Session()
+        retry = Retry(
+            total=self.RETRIES,
+            backoff_factor=self.BACKOFF_FACTOR,
+            status_forcelist=self.RETRY_STATUSES,
+            # POSTs aren't idempotent: a resent token exchange can fail with
+            # invalid_grant after Strava already rotated the tokens
+            allowed_methods=frozenset({"GET"}),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.POOL_SIZE, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._latency = {}
+        self._lock = threading.Lock()
+
+    def request(self, method, path, endpoint, **kwargs):
+        """Make a paced, timed request. endpoint names the latency bucket it is recorded under."""
+        kwargs.setdefault("timeout", (self.CONNECT_TIMEOUT, self.READ_TIMEOUT))
+        self.rate_limiter.acquire()
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, **kwargs)
+        except requests.RequestException:
+            self._record(endpoint, time.perf_counter() - started, status='error')
+            raise
+        self._record(endpoint, time.perf_counter() - started, status=response.status_code)
+        self.rate_limiter.update(response)
+        return response
+
+    async def request_async(self, http, method, path, endpoint, **kwargs):
+        """request() for an httpx.AsyncClient, sharing this client's pacing and latency stats.
+
+        The caller's client supplies the timeouts. Only failed connections are
+        retried (by its transport), not 429/5xx responses.
+        """
+        # Normally returns at once; in a thread so a throttled wait never blocks the event loop
+        await asyncio.to_thread(self.rate_limiter.acquire)
+        started = time.perf_counter()
+        try:
+            response = await http.request(method, self.base_url + path, **kwargs)
+        except Exception:
+            self._record(endpoint, time.perf_counter() - started, status='error')
+            raise
+        self._record(endpoint, time.perf_counter() - started, status=response.status_code)
+        self.rate_limiter.update(response)
+        return response
+
+    def _record(self, endpoint, seconds, status):
+        error = status == 'error' or status >= 400
+        metrics.strava_request_seconds.observe(seconds, endpoint)
+        metrics.strava_requests.inc(1, endpoint, str(status))
+        with self._lock:
+            stats = self._latency.setdefault(
+                endpoint, {'count': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0}
+            )
+            stats['count'] += 1
+            stats['errors'] += int(error)
+            stats['total_seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    def latency_stats(self):
+        """Per-endpoint call counts, error counts and average/max latency in seconds."""
+        with self._lock:
+            return {
+                endpoint: dict(stats, avg_seconds=stats['total_seconds'] / stats['count'])
+                for endpoint, stats in self._latency.items()
+            }
+
+    def post_token(self, payload):
+        return self.request("POST", "/oauth/token", "oauth_token", data=payload)
+
+    def list_activities(self, token, params):
+        return self.request(
+            "GET", "/api/v3/athlete/activities", "athlete_activities",
+            headers={"Authorization": f"Bearer {token}"}, params=params
+        )
+
+    def get_activity(self, token, activity_id):
+        return self.request(
+            "GET", f"/api/v3/activities/{activity_id}", "activity",
+            headers={"Authorization": f"Bearer {token}"}
+        )
+
+    def create_push_subscription(self, payload):
+        return self.request("POST", "/api/v3/push_subscriptions", "push_subscriptions", data=payload)
+
+
+client = StravaClient()
+
+def _authorization_payload(code):
+    return {
+        'client_id': os.getenv("STRAVA_CLIENT_ID"),
+        'client_secret': os.getenv("STRAVA_CLIENT_SECRET"),
         'code': code,
         'grant_type': 'authorization_code'
     }
-    response = requests.post("https://www.strava.com/oauth/token", data=payload)
 
+def _token_response(response):
     if response.status_code != 200:
         print(f"Error exchanging code: {response.text}")
         response.raise_for_status()
 
     return response.json()
 
+def exchange_code_for_tokens(code):
+    response = client.post_token(_authorization_payload(code))
+    return _token_response(response)
+
+async def exchange_code_for_tokens_async(http, code):
+    """exchange_code_for_tokens for the ASGI app. http is an httpx.AsyncClient."""
+    response = await client.request_async(
+        http, "POST", "/oauth/token", "oauth_token", data=_authorization_payload(code)
+    )
+    return _token_response(response)
+
 def authorize_and_save_user(code, user_id):
-    data = exchange_code_for_tokens(code)
+    save_authorization(user_id, exchange_code_for_tokens(code))
 
+def save_authorization(user_id, data):
+    """Save the tokens and athlete ID from a successful code exchange."""
     access_token = data.get('access_token')
     refresh_token = data.get('refresh_token')
     expires_at = data.get('expires_at')
@@ -50,28 +179,59 @@ def authorize_and_save_user(code, user_id):
     )
 
 def get_valid_access_token(user_id):
-    tokens = database.get_user_tokens(user_id)
+    """Get a usable access token, refreshing it if it is within 5 minutes of expiring.
+
+    Tokens are served from cache.tokens when possible. Only one thread per user
+    refreshes at a time; the others wait and then use the refreshed token.
+    """
+    access_token = cache.tokens.get(user_id)
+    if access_token:
+        return access_token
+
+    with cache.tokens.lock_for(user_id):
+        # Someone else may have refreshed while we waited for the lock
+        access_token = cache.tokens.get(user_id)
+        if access_token:
+            return access_token
+
+        generation = cache.tokens.generation(user_id)
+        tokens = database.get_user_tokens(user_id)
+
+        if not tokens:
+            print(f"No tokens found for User: {user_id}")
+            return None
+        
+        access_token = tokens['strava_access_token']
+        refresh_token = tokens['strava_refresh_token']
+        token_expiration = tokens['token_expiration']
+        
+        if token_expiration is None or time.time() > (token_expiration - 300):
+            print(f"DEBUG: Refreshing token for User {user_id}")
+            return refresh_access_token(user_id, refresh_token)
+
+        cache.tokens.put(user_id, access_token, token_expiration, generation)
+        return access_token
 
-    if not tokens:
-        print(f"No tokens found for User: {user_id}")
-        return None
-    
-    access_token = tokens['strava_access_token']
-    refresh_token = tokens['strava_refresh_token']
-    token_expiration = tokens['token_expiration']
-    
-    if token_expiration is None or time.time() > (token_expiration - 300):
-        print(f"DEBUG: Refreshing token for User {user_id}")
-        return refresh_access_token(user_id, refresh_token)
 
-    return access_token
+def prime_access_tokens(user_ids):
+    """Cache many users' access tokens at once before a batch sync.
+
+    They are read in batched queries rather than one per user, so each user's
+    sync finds its token in cache.tokens. Expired or soon-to-expire tokens aren't
+    served from the cache, so those users still refresh as usual.
+    """
+    generations = {user_id: cache.tokens.generation(user_id) for user_id in user_ids}
+    access_tokens = database.get_access_tokens(user_ids)
+    for user_id, (access_token, expires_at) in access_tokens.items():
+        if expires_at is not None:
+            cache.tokens.put(user_id, access_token, expires_at, generations[user_id])
+    return len(access_tokens)
 
 
 def refresh_access_token(user_id, refresh_token):
     client_id = os.getenv('STRAVA_CLIENT_ID')
     client_secret = os.getenv('STRAVA_CLIENT_SECRET')
     """Refresh Strava access token. Returns new access token."""
-    token_url = "https://www.strava.com/oauth/token"
     payload = {
         'client_id': client_id,
         'client_secret': client_secret,
@@ -79,7 +239,7 @@ def refresh_access_token(user_id, refresh_token):
         'refresh_token': refresh_token
     }
     
-    response = requests.post(token_url, data=payload)
+    response = client.post_token(payload)
     response.raise_for_status()
     data = response.json()
 
@@ -89,41 +249,190 @@ def refresh_access_token(user_id, refresh_token):
         data['refresh_token'],
         data['expires_at']
     )
+    cache.tokens.put(user_id, data['access_token'], data['expires_at'], cache.tokens.generation(user_id))
+    metrics.tokens_refreshed.inc()
 
     return data['access_token']
 
-def fetch_and_save_user_data(user_id):
-    seconds_in_30_days = 2592000
+def activity_to_row(user_id, activity):
+    """Convert a Strava activity into a DailyMileage row dict (distance in miles).
 
-    try:
-        token = get_valid_access_token(user_id)
+    Details Strava leaves out (e.g. heart rate without a monitor) come through as None.
+    """
+    return {
+        'user_id': user_id,
+        'date': activity['start_date_local'].split('T')[0],
+        'distance': round(activity['distance'] * 0.000621371, 2),
+        'activity_id': activity['id'],
+        'activity_title': activity.get('name'),
+        'moving_time': activity.get('moving_time'),
+        'elapsed_time': activity.get('elapsed_time'),
+        'elevation_gain': activity.get('total_elevation_gain'),
+        'average_heartrate': activity.get('average_heartrate'),
+        'activity_type': activity.get('type'),
+    }
+
+def activity_start_time(activity):
+    """Get an activity's UTC start time as epoch seconds."""
+    started = datetime.datetime.strptime(activity['start_date'], "%Y-%m-%dT%H:%M:%SZ")
+    return int(started.replace(tzinfo=datetime.timezone.utc).timestamp())
 
-        start_date = int(time.time()) - seconds_in_30_days
+# Strava's maximum page size
+PAGE_SIZE = 200
 
-        url = "https://www.strava.com/api/v3/athlete/activities"
-        headers = {"Authorization": f"Bearer {token}"}
-        params = {"after": start_date, "per_page": 50}
+def iter_activity_pages(token, after, per_page=None, stats=None):
+    """Yield pages of activities that started after `after`, oldest first.
 
-        response = requests.get(url,headers=headers, params=params)
+    Only one page is held in memory at a time. If a stats dict is passed, its
+    'api_calls' count is incremented for every request made.
+    """
+    per_page = per_page or PAGE_SIZE
+    page = 1
+    while True:
+        params = {"after": after, "per_page": per_page, "page": page}
+        response = client.list_activities(token, params)
+        if stats is not None:
+            stats['api_calls'] += 1
         response.raise_for_status()
         activities = response.json()
+        if not activities:
+            return
+        yield activities
+        if len(activities) < per_page:
+            return
+        page += 1
+
+# How far before the high-water mark each sync re-reads, so recent edits are picked up
+SYNC_OVERLAP_SECONDS = 2 * 24 * 60 * 60
+# Window used for a user's very first sync
+INITIAL_SYNC_SECONDS = 30 * 24 * 60 * 60
+
+# Running totals across every sync this process has done. Batch syncs run on
+# several threads at once, so updates hold _sync_totals_lock.
+sync_totals = {'syncs': 0, 'api_calls': 0, 'rows_fetched': 0, 'rows_written': 0}
+_sync_totals_lock = threading.Lock()
 
-        count = 0
-        for activity in activities:
-            miles = round(activity['distance'] * 0.000621371, 2)
-            date_str = activity['start_date_local'].split('T')[0]
-            activity_id = activity['id']
+def fetch_and_save_user_data(user_id):
+    """Sync activities newer than the user's high-water mark (minus an overlap window).
+
+    Returns a stats dict with the API calls made and the rows fetched and written,
+    or None if the sync failed.
+    """
+    stats = {'api_calls': 0, 'rows_fetched': 0, 'rows_written': 0}
+
+    try:
+        token = get_valid_access_token(user_id)
 
-            database.create_activity(
-                user_id=user_id,
-                date=date_str,
-                distance=miles,
-                activity_id=activity_id
+        high_water_mark = database.get_last_activity_time(user_id)
+        if high_water_mark:
+            after = high_water_mark - SYNC_OVERLAP_SECONDS
+        else:
+            after = int(time.time()) - INITIAL_SYNC_SECONDS
 
+        newest = high_water_mark
+        for activities in iter_activity_pages(token, after, stats=stats):
+            stats['rows_fetched'] += len(activities)
+            stats['rows_written'] += database.create_activities_bulk(
+                activity_to_row(user_id, activity) for activity in activities
             )
-            count += 1
+            newest = max(newest, max(activity_start_time(activity) for activity in activities))
+
+        if newest > high_water_mark:
+            database.update_last_activity_time(user_id, newest)
 
-        print(f"Imported {count} activities for User: {user_id}")
+        with _sync_totals_lock:
+            sync_totals['syncs'] += 1
+            for key, value in stats.items():
+                sync_totals[key] += value
+
+        window_days = (time.time() - after) / 86400
+        print(
+            f"Synced User {user_id}: {stats['api_calls']} API calls, "
+            f"{stats['rows_fetched']} fetched, {stats['rows_written']} written "
+            f"({window_days:.1f} day window instead of {INITIAL_SYNC_SECONDS // 86400})"
+        )
+        return stats
 
     except Exception as e:
-        print(f"Error for User {user_id}: {e}")
\ No newline at end of file
+        print(f"Error for User {user_id}: {e}")
+        return None
+
+def backfill_user_data(user_id):
+    """Import a user's entire Strava history, one page at a time.
+
+    Progress is saved as a cursor after every page, so an interrupted backfill
+    picks up where it stopped. Returns the number of new activities saved.
+    """
+    token = get_valid_access_token(user_id)
+    cursor = database.get_backfill_cursor(user_id)
+
+    count = 0
+    # Step back a second so activities sharing the cursor's start time aren't skipped
+    for activities in iter_activity_pages(token, max(cursor - 1, 0)):
+        count += database.create_activities_bulk(
+            activity_to_row(user_id, activity) for activity in activities
+        )
+        cursor = max(cursor, max(activity_start_time(activity) for activity in activities))
+        database.set_backfill_cursor(user_id, cursor)
+        database.update_last_activity_time(user_id, cursor)
+
+    print(f"Backfilled {count} activities for User: {user_id}")
+    return count
+
+def apply_webhook_event(event):
+    """Apply one stored Strava webhook event to DailyMileage.
+
+    The activity is fetched on its own (one API call) whatever the event says,
+    so a forged event can't change anything: it is upserted only if Strava
+    returns it as the event owner's own activity (the owner's token can also
+    fetch other athletes' public ones), and removed only if Strava answers 404.
+    Events for athletes who aren't connected, and non-activity events, are ignored.
+    Returns what was done: 'saved', 'deleted' or 'ignored'.
+    """
+    user_id = database.get_user_id_for_athlete(event['owner_id'])
+    if event['object_type'] != 'activity' or user_id is None:
+        return 'ignored'
+
+    token = get_valid_access_token(user_id)
+    response = client.get_activity(token, event['object_id'])
+    # A deleted activity, or one made private, comes back as 404
+    if response.status_code == 404:
+        database.delete_activity(user_id, event['object_id'])
+        return 'deleted'
+    response.raise_for_status()
+    activity = response.json()
+    if activity.get('athlete', {}).get('id') != event['owner_id']:
+        return 'ignored'
+    database.create_activities_bulk([activity_to_row(user_id, activity)])
+    return 'saved'
+
+def create_webhook_subscription(callback_url):
+    """Register callback_url with Strava for push events. Returns the subscription ID.
+
+    Strava calls the URL with a GET handshake first, so the app must already be
+    serving /strava/webhook with the same STRAVA_WEBHOOK_VERIFY_TOKEN.
+    """
+    response = client.create_push_subscription({
+        'client_id': os.getenv("STRAVA_CLIENT_ID"),
+        'client_secret': os.getenv("STRAVA_CLIENT_SECRET"),
+        'callback_url': callback_url,
+        'verify_token': os.getenv("STRAVA_WEBHOOK_VERIFY_TOKEN"),
+    })
+    response.raise_for_status()
+    return response.json()['id']
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Strava collector")
+    parser.add_argument("command", choices=["sync", "backfill", "subscribe"])
+    parser.add_argument("target", help="user ID, or the webhook callback URL for subscribe")
+    args = parser.parse_args()
+
+    if args.command == "subscribe":
+        print(f"Subscribed: {create_webhook_subscription(args.target)}")
+    elif args.command == "backfill":
+        backfill_user_data(int(args.target))
+    else:
+        fetch_and_save_user_data(int(args.target))
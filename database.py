@@ -1,92 +1,337 @@
 import os
-import sqlite3
+import sys
+import base64
+import binascii
+import threading
 import datetime
 import time
-from werkzeug.security import generate_password_hash, check_password_hash
 from dotenv import load_dotenv
-from cryptography.fernet import Fernet
+import cache
+import metrics
+import passwords
+import storage
+import vault
 
 DB_NAME = "MileageTracker.db"
 
+# SQLite on DB_NAME unless DATABASE_URL names a server database (see storage.py)
+backend = storage.from_env()
+
 load_dotenv()
 
 #ENCRYPTION/DECRYPTION STUFF
 
-key = os.getenv("ENCRYPTION_KEY")
-if not key:
-    raise ValueError("ENCRYPTION_KEY not found in .env")
-cipher = Fernet(key)
+# Keys come from ENCRYPTION_KEYS, newest first (see vault.py for rotating them)
+token_vault = vault.Vault(vault.keys_from_env())
 
 def encrypt_token(token):
-    if not token:
-        return None
-    return cipher.encrypt(token.encode()).decode()
+    return token_vault.encrypt(token)
 
 def decrypt_token(token):
-    if not token:
-        return None
-    try:
-        return cipher.decrypt(token.encode()).decode()
-    except Exception as e:
-        print(f"Error With Encryption: {e}")
-        return None
+    return token_vault.decrypt(token)
     
 
 
+# SCHEMA MIGRATIONS
+#The schema version lives in the database (PRAGMA user_version on SQLite). init_db applies every
+#migration newer than that version, in order, each in its own transaction.
+#Existing data is never dropped. To change the schema, append a new migration
+#and never edit one that has shipped.
+
+def _add_column(conn, table, column, declaration):
+    # Databases built by older init_db versions may already have the column
+    if column not in backend.column_names(conn, table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+
+def _migration_1_base_schema(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS Users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username VARCHAR(50) UNIQUE NOT NULL,
+        password_hash VARCHAR(128) NOT NULL,
+                   
+        strava_athlete_id INTEGER UNIQUE,
+        strava_access_token TEXT,
+        strava_refresh_token TEXT,
+        token_expiration INTEGER,
+        last_sync_time INTEGER DEFAULT 0
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS  Athletes (
+        user_id INTEGER PRIMARY KEY,
+        mileage_goal REAL,
+        long_run_goal REAL,
+        FOREIGN KEY (user_id) REFERENCES Users(id)
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS  DailyMileage (
+        user_id INTEGER,
+        activity_id INTEGER PRIMARY KEY,
+        date DATE,
+        distance REAL,
+        activity_title VARCHAR(100),
+        FOREIGN KEY (user_id) REFERENCES Users(id),
+        UNIQUE(user_id, date, activity_id)
+    )
+    """)
+
+
+def _migration_2_sync_tracking(conn):
+    _add_column(conn, "Users", "last_activity_time", "INTEGER DEFAULT 0")
+    _add_column(conn, "Users", "backfill_cursor", "INTEGER DEFAULT 0")
+    _add_column(conn, "Athletes", "goal_version", "INTEGER DEFAULT 0")
+    # SyncJobs table - one row per user waiting for (or running) a background sync
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS SyncJobs (
+        user_id INTEGER PRIMARY KEY,
+        status TEXT NOT NULL DEFAULT 'pending',
+        requested_at INTEGER NOT NULL,
+        claimed_by TEXT,
+        claimed_at INTEGER,
+        FOREIGN KEY (user_id) REFERENCES Users(id)
+    )
+    """)
+
+
+def _migration_3_indexes(conn):
+    # DailyMileage's UNIQUE(user_id, date, activity_id) duplicated the primary key and its
+    # index couldn't cover the hot queries. SQLite can't drop a constraint, so rebuild the table.
+    conn.execute("""
+    CREATE TABLE DailyMileage_new (
+        user_id INTEGER,
+        activity_id INTEGER PRIMARY KEY,
+        date DATE,
+        distance REAL,
+        activity_title VARCHAR(100),
+        FOREIGN KEY (user_id) REFERENCES Users(id)
+    )
+    """)
+    conn.execute("""
+    INSERT INTO DailyMileage_new (user_id, activity_id, date, distance, activity_title)
+    SELECT user_id, activity_id, date, distance, activity_title FROM DailyMileage
+    """)
+    conn.execute("DROP TABLE DailyMileage")
+    conn.execute("ALTER TABLE DailyMileage_new RENAME TO DailyMileage")
+    # Covers activity listings (newest first) and weekly sums.
+    # activity_id is the rowid, so every index carries it already.
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_dailymileage_user_date
+    ON DailyMileage (user_id, date, distance, activity_title)
+    """)
+    # Only Strava-connected users are ever swept for syncing
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_users_strava_last_sync
+    ON Users (last_sync_time) WHERE strava_access_token IS NOT NULL
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_syncjobs_requested ON SyncJobs (requested_at)")
+
+
+def _migration_4_keyset_index(conn):
+    # Put activity_id right after date so (date, activity_id) keyset pages
+    # come straight off the index without a sort
+    conn.execute("DROP INDEX IF EXISTS idx_dailymileage_user_date")
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_dailymileage_user_date_id
+    ON DailyMileage (user_id, date, activity_id, distance, activity_title)
+    """)
+
+
+def _migration_5_webhook_events(conn):
+    # WebhookEvents table - Strava push events waiting to be applied, oldest first
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS WebhookEvents (
+        event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        object_type TEXT NOT NULL,
+        object_id INTEGER NOT NULL,
+        aspect_type TEXT NOT NULL,
+        owner_id INTEGER NOT NULL,
+        event_time INTEGER NOT NULL,
+        received_at INTEGER NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        claimed_by TEXT,
+        claimed_at INTEGER
+    )
+    """)
+
+
+def _migration_6_activity_details(conn):
+    # Per-activity details kept for analytics. Times in seconds, elevation gain in meters.
+    # activity_type is Strava's type ('Run', 'Ride', ...). NULL for rows synced before this.
+    _add_column(conn, "DailyMileage", "moving_time", "INTEGER")
+    _add_column(conn, "DailyMileage", "elapsed_time", "INTEGER")
+    _add_column(conn, "DailyMileage", "elevation_gain", "REAL")
+    _add_column(conn, "DailyMileage", "average_heartrate", "REAL")
+    _add_column(conn, "DailyMileage", "activity_type", "TEXT")
+
+    # ActivityColumns table - each user's analytics fields packed column by column into
+    # one blob (see analytics.py). Dropped whenever the user's activities change and
+    # rebuilt on the next read, so loading ten years of history is a single-row read.
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS ActivityColumns (
+        user_id INTEGER PRIMARY KEY,
+        row_count INTEGER NOT NULL,
+        columns BLOB NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES Users(id)
+    )
+    """)
+
+
+def _migration_7_activity_version(conn):
+    # Bumped in the same transaction as every change to a user's activities, so
+    # any process can tell whether results it built earlier are still current
+    _add_column(conn, "Users", "activity_version", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _migration_8_leaderboards(conn):
+    # LeaderboardEntries - each user's total distance and longest run per week and month.
+    # LeaderboardCounts - a Fenwick tree per board over those values, for rank lookups.
+    # Both are kept current on ingest; see the LEADERBOARDS section.
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS LeaderboardEntries (
+        period TEXT NOT NULL,
+        period_start DATE NOT NULL,
+        metric TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        value REAL NOT NULL,
+        PRIMARY KEY (period, period_start, metric, user_id),
+        FOREIGN KEY (user_id) REFERENCES Users(id)
+    ) WITHOUT ROWID
+    """)
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_leaderboard_ranking
+    ON LeaderboardEntries (period, period_start, metric, value DESC, user_id)
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS LeaderboardCounts (
+        period TEXT NOT NULL,
+        period_start DATE NOT NULL,
+        metric TEXT NOT NULL,
+        node INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (period, period_start, metric, node)
+    ) WITHOUT ROWID
+    """)
+    _rebuild_leaderboards(conn)
+
+
+MIGRATIONS = [
+    _migration_1_base_schema,
+    _migration_2_sync_tracking,
+    _migration_3_indexes,
+    _migration_4_keyset_index,
+    _migration_5_webhook_events,
+    _migration_6_activity_details,
+    _migration_7_activity_version,
+    _migration_8_leaderboards,
+]
+
+
+def get_schema_version():
+    return backend.get_schema_version(get_connection())
+
+
+def migrate():
+    """Bring the database up to the newest schema. Returns the resulting version.
+
+    Safe to run from several processes at once: each migration re-checks the
+    version while holding the write lock.
+    """
+    conn = get_connection()
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        if get_schema_version() >= version:
+            continue
+        backend.begin_write(conn)
+        try:
+            if backend.get_schema_version(conn) < version:
+                migration(conn)
+                backend.set_schema_version(conn, version)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return get_schema_version()
+
+
 def init_db():
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        #Resetting the tables each time collector is run to maintain known state
-        #these 3 lines will be commented out when we are done testing
-        cursor.execute("DROP TABLE IF EXISTS Users")
-        cursor.execute("DROP TABLE IF EXISTS DailyMileage")
-        cursor.execute("DROP TABLE IF EXISTS Athletes")
-    
-        # User table
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS Users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username VARCHAR(50) UNIQUE NOT NULL,
-            password_hash VARCHAR(128) NOT NULL,
-                       
-            strava_athlete_id INTEGER UNIQUE,
-            strava_access_token TEXT,
-            strava_refresh_token TEXT,
-            token_expiration INTEGER,
-            last_sync_time INTEGER DEFAULT 0
-        )
-        """)
-        # Athlete table
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS  Athletes (
-            user_id INTEGER PRIMARY KEY,
-            mileage_goal REAL,
-            long_run_goal REAL,
-            FOREIGN KEY (user_id) REFERENCES Users(id)
-        )
-        """)
-        # DailyMileage table
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS  DailyMileage (
-            user_id INTEGER,
-            activity_id INTEGER PRIMARY KEY,
-            date DATE,
-            distance REAL,
-            activity_title VARCHAR(100),
-            FOREIGN KEY (user_id) REFERENCES Users(id),
-            UNIQUE(user_id, date, activity_id)
-        )
-        """)
-        conn.commit()
+    """Create or upgrade the tables. Existing data is kept."""
+    migrate()
+
+
+# CONNECTION MANAGEMENT
+#Each thread keeps one long-lived connection instead of opening a new one per query.
+#SQLite's PRAGMAs are applied once when the connection is opened. With a pooled server
+#backend, release_connection hands it back between requests.
+
+# Seconds a pooled connection can sit idle before it is pinged on checkout
+HEALTH_CHECK_INTERVAL = 30
+
+_local = threading.local()
+
+
+@metrics.db_connect_seconds.time()
+def _open_connection():
+    """Open a new tuned connection to DB_NAME (or check one out of the server backend's pool)."""
+    return backend.connect(DB_NAME)
+
+
+def _is_healthy(conn):
+    try:
+        conn.execute("SELECT 1").fetchone()
+        return True
+    except backend.Error:
+        return False
 
 
 def get_connection():
+    """Get this thread's pooled connection, opening or replacing it if needed."""
+    pooled = getattr(_local, 'pooled', None)
+    now = time.monotonic()
+
+    if pooled is not None:
+        conn, db_name, pid, last_used = pooled
+        #A forked gunicorn worker or a changed DB_NAME can't reuse the old connection
+        stale = db_name != DB_NAME or pid != os.getpid()
+        if not stale and now - last_used > HEALTH_CHECK_INTERVAL:
+            stale = not _is_healthy(conn)
+        if not stale:
+            if conn.in_transaction:
+                conn.rollback()
+            _local.pooled = (conn, db_name, pid, now)
+            return conn
+        close_connection()
+
     try:
-        conn = sqlite3.connect(DB_NAME)
-        conn.row_factory = sqlite3.Row
-        return conn
+        conn = _open_connection()
     except Exception as e:
-        print(f"Unable to establish connection to {DB_NAME}")
+        print(f"Unable to establish connection to {DB_NAME}: {e}")
+        raise
+    _local.pooled = (conn, DB_NAME, os.getpid(), now)
+    return conn
+
+
+def close_connection():
+    """Close and forget this thread's pooled connection, if any."""
+    pooled = getattr(_local, 'pooled', None)
+    _local.pooled = None
+    if pooled is None:
+        return
+    try:
+        pooled[0].close()
+    except backend.Error:
+        pass
+
+
+def release_connection():
+    """Return this thread's connection to the pool at the end of a request, for pooled backends.
+
+    SQLite connections are cheap to keep open and stay with their thread.
+    """
+    if backend.pooled:
+        close_connection()
+
 
 # USER MANAGEMENT METHODS
 
@@ -99,46 +344,101 @@ def update_last_sync_time(user_id):
         (current_time, user_id)
     )
     conn.commit()
-    conn.close()
+    cache.users.invalidate(user_id)
+
+
+def get_last_activity_time(user_id):
+    """Get the start time (epoch seconds) of the newest activity synced for a user."""
+    conn = get_connection()
+    row = conn.execute("SELECT last_activity_time FROM Users WHERE id = ?", (user_id,)).fetchone()
+    return (row['last_activity_time'] or 0) if row else 0
 
 
+def update_last_activity_time(user_id, start_time):
+    """Move a user's high-water mark forward. Older times are ignored."""
+    conn = get_connection()
+    conn.execute(
+        f"UPDATE Users SET last_activity_time = {backend.greatest('COALESCE(last_activity_time, 0)', '?')} WHERE id = ?",
+        (start_time, user_id)
+    )
+    conn.commit()
+
+def get_backfill_cursor(user_id):
+    """Get the start time (epoch seconds) of the newest activity a backfill has saved."""
+    conn = get_connection()
+    row = conn.execute("SELECT backfill_cursor FROM Users WHERE id = ?", (user_id,)).fetchone()
+    return (row['backfill_cursor'] or 0) if row else 0
+
+
+def set_backfill_cursor(user_id, cursor):
+    conn = get_connection()
+    conn.execute("UPDATE Users SET backfill_cursor = ? WHERE id = ?", (cursor, user_id))
+    conn.commit()
+
 def get_user_by_id(user_id):
     """Get user by ID. Returns row dict or None."""
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM Users WHERE id = ?", (user_id,))
     row = cursor.fetchone()
-    conn.close()
     return dict(row) if row else None
 
 
+def get_user_summary(user_id):
+    """Get what a logged-in request needs about a user, without the encrypted tokens.
+
+    Returns a dict with id, username, last_sync_time, has_strava, mileage_goal and
+    long_run_goal, or None.
+    """
+    conn = get_connection()
+    row = conn.execute(
+        """SELECT u.id, u.username, u.last_sync_time,
+                  u.strava_access_token IS NOT NULL AS has_strava,
+                  a.mileage_goal, a.long_run_goal
+           FROM Users u
+           LEFT JOIN Athletes a ON a.user_id = u.id
+           WHERE u.id = ?""",
+        (user_id,)
+    ).fetchone()
+    if not row:
+        return None
+    summary = dict(row)
+    summary['has_strava'] = bool(summary['has_strava'])
+    return summary
+
+def get_strava_user_ids():
+    """Get the IDs of every user who has connected Strava, least recently synced first."""
+    conn = get_connection()
+    rows = conn.execute(
+        "SELECT id FROM Users WHERE strava_access_token IS NOT NULL ORDER BY last_sync_time"
+    ).fetchall()
+    return [row['id'] for row in rows]
+
 def get_user_by_username(username):
     """Get user by username. Returns row dict or None."""
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM Users WHERE username = ?", (username,))
     row = cursor.fetchone()
-    conn.close()
     return dict(row) if row else None
 
 
 def create_user(username, password):
     """Create a new user. Returns the new user's ID."""
     # Hash the password using werkzeug's secure hashing
-    password_hash = generate_password_hash(password, method='pbkdf2:sha256')
+    password_hash = passwords.hash_password(password)
     conn = get_connection()
     cursor = conn.cursor()
     try:
         cursor.execute(
-            "INSERT INTO Users (username, password_hash) VALUES (?, ?)",
+            "INSERT INTO Users (username, password_hash) VALUES (?, ?) RETURNING id",
             (username, password_hash)
         )
-        user_id = cursor.lastrowid
+        user_id = cursor.fetchone()[0]
         conn.commit()
-        conn.close()
         return user_id
-    except sqlite3.IntegrityError as e:
-        conn.close()
+    except backend.IntegrityError as e:
+        conn.rollback()
         # Handle race condition: two simultaneous requests could both pass existence check
         # The second INSERT will fail with IntegrityError due to UNIQUE constraint
         if 'UNIQUE constraint failed' in str(e) or 'username' in str(e).lower():
@@ -151,10 +451,14 @@ def create_user(username, password):
 def validate_password(username, password):
     """Login a user. Returns True/False."""
     user_row = get_user_by_username(username)
-    if user_row and check_password_hash(user_row['password_hash'], password):
-        return True
-    else:
-        return False
+    return passwords.verify(user_row['password_hash'] if user_row else None, password)
+
+
+def update_password_hash(user_id, password_hash):
+    """Replace a user's stored password hash (used to upgrade old hashing parameters)."""
+    conn = get_connection()
+    conn.execute("UPDATE Users SET password_hash = ? WHERE id = ?", (password_hash, user_id))
+    conn.commit()
     
 
 def user_has_strava(user_id):
@@ -166,26 +470,50 @@ def user_has_strava(user_id):
         [user_id]
     )
     row = cursor.fetchone()
-    conn.close()
     return row is not None and row[0] is not None
 
 
 def get_user_tokens(user_id):
+    """Get a user's Strava tokens and expiry, or None.
+
+    Each token is only decrypted when it is read, so checking the access token
+    doesn't pay to decrypt the refresh token too.
+    """
     conn = get_connection()
     row = conn.execute(
         "SELECT strava_access_token, strava_refresh_token, token_expiration FROM Users WHERE id = ?", 
         (user_id,)
     ).fetchone()
-    conn.close()
     if row:
-        return {
-            'strava_access_token' : decrypt_token(row['strava_access_token']),
-            'strava_refresh_token' : decrypt_token(row['strava_refresh_token']),
-            'token_expiration' : row['token_expiration']
-        }
+        return vault.SealedTokens(token_vault, row)
     return row
 
 
+def get_access_tokens(user_ids):
+    """Get many users' decrypted access tokens, for a batch sync.
+
+    Reads them with one IN (...) query per 500 users instead of a query per
+    user, and decrypts only the access tokens. Returns
+    {user_id: (access_token, token_expiration)} for those with tokens.
+    """
+    conn = get_connection()
+    rows = []
+    user_ids = list(user_ids)
+    for start in range(0, len(user_ids), 500):
+        batch = user_ids[start:start + 500]
+        rows.extend(conn.execute(
+            f"""SELECT id, strava_access_token, token_expiration FROM Users
+                WHERE id IN ({','.join('?' * len(batch))}) AND strava_access_token IS NOT NULL""",
+            batch
+        ).fetchall())
+    access_tokens = {}
+    for row in rows:
+        access_token = token_vault.decrypt(row['strava_access_token'])
+        if access_token:
+            access_tokens[row['id']] = (access_token, row['token_expiration'])
+    return access_tokens
+
+
 def update_user_tokens(user_id, access_token, refresh_token, expires_at):
 
     conn = get_connection()
@@ -198,7 +526,8 @@ def update_user_tokens(user_id, access_token, refresh_token, expires_at):
         (encrypt_token(access_token), encrypt_token(refresh_token), expires_at, user_id)
     )
     conn.commit()
-    conn.close()
+    cache.tokens.invalidate(user_id)
+    cache.users.invalidate(user_id)
 
 
 def save_user_tokens_and_info(user_id, access_token, refresh_token, expires_at, strava_id):
@@ -218,24 +547,152 @@ def save_user_tokens_and_info(user_id, access_token, refresh_token, expires_at,
     # The athlete record should already exist from registration with goals
     # We don't need to update it here - just ensure it exists
     cursor.execute(
-        """INSERT OR IGNORE INTO Athletes (user_id, mileage_goal, long_run_goal)
-           VALUES (?, 0, 0)""",
+        """INSERT INTO Athletes (user_id, mileage_goal, long_run_goal)
+           VALUES (?, 0, 0)
+           ON CONFLICT DO NOTHING""",
         (user_id,)
     )
     conn.commit()
-    conn.close()
+    cache.tokens.invalidate(user_id)
+    cache.users.invalidate(user_id)
     print(f"Tokens and profile info saved for User ID: {user_id}")
 
 
+def rotate_token_keys(after_id=0, limit=500):
+    """Re-encrypt the stored tokens of up to limit users after after_id under the newest key.
+
+    Call again with the returned ID until it is None. Returns (last user ID
+    checked or None when done, users re-encrypted). A row whose tokens change
+    in the meantime is left alone, since they were written with the newest key.
+    """
+    conn = get_connection()
+    rows = conn.execute(
+        """SELECT id, strava_access_token, strava_refresh_token FROM Users
+           WHERE id > ? AND strava_access_token IS NOT NULL ORDER BY id LIMIT ?""",
+        (after_id, limit)
+    ).fetchall()
+    updates = []
+    for row in rows:
+        try:
+            access_token = token_vault.rotate(row['strava_access_token'])
+            refresh_token = token_vault.rotate(row['strava_refresh_token'])
+        except vault.InvalidToken:
+            print(f"Can't re-encrypt tokens for User {row['id']}: no key in ENCRYPTION_KEYS matches")
+            continue
+        if access_token or refresh_token:
+            updates.append((access_token or row['strava_access_token'], refresh_token or row['strava_refresh_token'],
+                            row['id'], row['strava_access_token'], row['strava_refresh_token']))
+    with conn:
+        rotated = conn.executemany(
+            """UPDATE Users SET strava_access_token = ?, strava_refresh_token = ?
+               WHERE id = ? AND strava_access_token = ? AND strava_refresh_token IS ?""",
+            updates
+        ).rowcount if updates else 0
+    return (rows[-1]['id'] if len(rows) == limit else None), rotated
+
+
 def create_activity(user_id, date, distance, activity_id):
     #will be called when an activity is grabbed by the collector (so info is just passed in)
     conn = get_connection()
-    conn.execute(
-        "INSERT OR IGNORE INTO DailyMileage (user_id, date, distance, activity_id) VALUES (?, ?, ?, ?)", 
-        (user_id, date, distance, activity_id)
-    )
-    conn.commit()
-    conn.close()
+    with conn:
+        backend.begin_write(conn, [user_id])
+        cursor = conn.execute(
+            "INSERT INTO DailyMileage (user_id, date, distance, activity_id) VALUES (?, ?, ?, ?) ON CONFLICT DO NOTHING",
+            (user_id, date, distance, activity_id)
+        )
+        if cursor.rowcount:
+            _refresh_leaderboards(conn, {(user_id, week_start_of(date))})
+            _mark_activities_changed(conn, {user_id})
+    if cursor.rowcount:
+        cache.trends.invalidate_group(user_id)
+    metrics.rows_ingested.inc(cursor.rowcount)
+
+# Rows per commit for very large imports
+BULK_CHUNK_SIZE = 5000
+
+
+# Activity fields beyond user_id/date/distance/activity_id. They are optional:
+# a row without one (None) keeps whatever value is already stored.
+ACTIVITY_DETAIL_FIELDS = ('activity_title', 'moving_time', 'elapsed_time',
+                          'elevation_gain', 'average_heartrate', 'activity_type')
+
+_UPSERT_ACTIVITY_SQL = f"""
+    INSERT INTO DailyMileage (user_id, date, distance, activity_id, {', '.join(ACTIVITY_DETAIL_FIELDS)})
+    VALUES ({', '.join('?' * (4 + len(ACTIVITY_DETAIL_FIELDS)))})
+    ON CONFLICT(activity_id) DO UPDATE
+    SET date = excluded.date, distance = excluded.distance,
+        {', '.join(f'{field} = COALESCE(excluded.{field}, DailyMileage.{field})' for field in ACTIVITY_DETAIL_FIELDS)}
+    WHERE DailyMileage.date IS NOT excluded.date OR DailyMileage.distance IS NOT excluded.distance
+        {' '.join(f'OR DailyMileage.{field} IS NOT COALESCE(excluded.{field}, DailyMileage.{field})' for field in ACTIVITY_DETAIL_FIELDS)}
+"""
+
+
+def create_activities_bulk(activities, chunk_size=BULK_CHUNK_SIZE):
+    """Upsert many activities with executemany, committing every chunk_size rows.
+
+    activities is any iterable of dicts with user_id, date, distance and activity_id
+    keys (the same arguments create_activity takes), plus any of ACTIVITY_DETAIL_FIELDS.
+    Existing activities are only rewritten when something changed. Returns the number of rows written.
+    """
+    conn = get_connection()
+    written = 0
+    chunk = []
+    try:
+        for activity in activities:
+            chunk.append((activity['user_id'], activity['date'], activity['distance'], activity['activity_id'],
+                          *[activity.get(field) for field in ACTIVITY_DETAIL_FIELDS]))
+            if len(chunk) >= chunk_size:
+                written += _insert_activity_chunk(conn, chunk)
+                chunk = []
+        if chunk:
+            written += _insert_activity_chunk(conn, chunk)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        metrics.rows_ingested.inc(written)
+    return written
+
+
+def _insert_activity_chunk(conn, rows):
+    """Upsert one chunk and refresh the leaderboards it touched, in one transaction."""
+    with conn:
+        weeks = {(row[0], week_start_of(row[1])) for row in rows}
+        user_ids = {user_id for user_id, _ in weeks}
+        # Locked before the reads below, which the leaderboard deltas are worked out from
+        backend.begin_write(conn, user_ids)
+        # An edit can move an activity to another week, so the old week's boards need refreshing too
+        activity_ids = [row[3] for row in rows]
+        for start in range(0, len(activity_ids), 500):
+            batch = activity_ids[start:start + 500]
+            existing = conn.execute(
+                f"SELECT user_id, date FROM DailyMileage WHERE activity_id IN ({','.join('?' * len(batch))})",
+                batch
+            )
+            weeks.update((row['user_id'], week_start_of(row['date'])) for row in existing)
+
+        before = conn.total_changes
+        # In activity_id order (stable, so a repeated activity's last version wins),
+        # so concurrent writers on a server backend lock rows in the same order
+        conn.executemany(_UPSERT_ACTIVITY_SQL, sorted(rows, key=lambda row: row[3]))
+        written = conn.total_changes - before
+        if written:
+            _refresh_leaderboards(conn, weeks)
+            _mark_activities_changed(conn, user_ids)
+    if written:
+        for user_id in user_ids:
+            cache.trends.invalidate_group(user_id)
+    return written
+
+
+# WEEKS
+
+def week_start_of(date):
+    """Get the ISO week's Monday (as YYYY-MM-DD) for a YYYY-MM-DD date string or date."""
+    if isinstance(date, str):
+        date = datetime.date.fromisoformat(date)
+    return (date - datetime.timedelta(days=date.weekday())).isoformat()
+
 
 def create_athlete_with_goals(user_id, mileage_goal, long_run_goal):
     """Create an athlete record with goals. Returns None."""
@@ -246,14 +703,14 @@ def create_athlete_with_goals(user_id, mileage_goal, long_run_goal):
         (user_id, mileage_goal, long_run_goal)
     )
     conn.commit()
-    conn.close()
+    cache.users.invalidate(user_id)
+    cache.trends.invalidate_group(user_id)
 
 def get_row_from_athletes_table(user_id):
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM Athletes WHERE user_id = ?", (user_id,))
     row = cursor.fetchone()
-    conn.close()
     return dict(row) if row else None
 
 
@@ -261,31 +718,729 @@ def set_long_run_goal(username, long_run_goal):
     user_row = get_row_from_athletes_table(username)
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("UPDATE Athletes SET long_run_goal = ? WHERE user_id = ?", (long_run_goal, user_row['user_id']))
+    cursor.execute(
+        "UPDATE Athletes SET long_run_goal = ?, goal_version = goal_version + 1 WHERE user_id = ?",
+        (long_run_goal, user_row['user_id'])
+    )
     conn.commit()
-    conn.close()
+    cache.users.invalidate(user_row['user_id'])
+    cache.trends.invalidate_group(user_row['user_id'])
 
 
 def set_mileage_goal(username, mileage_goal):
     user_row = get_row_from_athletes_table(username)
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("UPDATE Athletes SET mileage_goal = ? WHERE user_id = ?", (mileage_goal, user_row['user_id']))
+    cursor.execute(
+        "UPDATE Athletes SET mileage_goal = ?, goal_version = goal_version + 1 WHERE user_id = ?",
+        (mileage_goal, user_row['user_id'])
+    )
     conn.commit()
-    conn.close()
+    cache.users.invalidate(user_row['user_id'])
+    cache.trends.invalidate_group(user_row['user_id'])
+
+
+def get_activities_for_user(user_id, since=None, until=None, limit=None):
+    """Get a user's activities, newest first. Returns list of dicts.
 
+    since/until are optional inclusive YYYY-MM-DD bounds and limit caps the row count.
+    Use get_activities_page to walk through history in pages.
+    """
+    return get_activities_page(user_id, since=since, until=until, limit=limit)[0]
 
-def get_activities_for_user(user_id):
-    """Get all activities for a user. Returns list of dicts."""
+
+def get_activities_page(user_id, since=None, until=None, limit=None, cursor=None):
+    """Get one page of a user's activities, newest first.
+
+    Pages are keyed on (date, activity_id), so each one is an index range read no
+    matter how deep into history it is. Returns (activities, next_cursor);
+    next_cursor is None on the last page.
+    """
+    where, params = _activity_filters(since, until, cursor)
     conn = get_connection()
+    rows = conn.execute(
+        f"""SELECT activity_id, date, distance, activity_title 
+            FROM DailyMileage 
+            WHERE user_id = ? {where}
+            ORDER BY date DESC, activity_id DESC
+            {_page_limit(limit)}""",
+        (user_id, *params)
+    ).fetchall()
+    activities = [dict(row) for row in rows]
+    return _split_page(activities, limit)
+
+
+EXPORT_BATCH_SIZE = 1000
+
+
+def iter_activities(user_id, since=None, until=None, batch_size=EXPORT_BATCH_SIZE):
+    """Yield every activity for a user as (activity_id, date, distance, activity_title) rows, newest first.
+
+    Rows come off one cursor batch_size at a time, so memory stays flat however
+    long the history is. The cursor gets its own connection because the caller
+    (a streaming response) may keep it open after the request handler has moved on.
+    """
+    where, params = _activity_filters(since, until, None)
+    conn = _open_connection()
+    try:
+        cursor = backend.stream(
+            conn,
+            f"""SELECT activity_id, date, distance, activity_title 
+                FROM DailyMileage 
+                WHERE user_id = ? {where}
+                ORDER BY date DESC, activity_id DESC""",
+            (user_id, *params)
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        conn.close()
+
+
+# Strava activity types counted as runs. Rows from before activity_type was stored
+# (NULL) are counted too, since nearly all of them are runs. Weekly mileage, goals,
+# trends and leaderboards all count runs only; /api/activities lists everything.
+RUN_TYPES = ('Run', 'TrailRun', 'VirtualRun')
+
+
+def _run_filter():
+    # SQL condition for run rows; bind *RUN_TYPES for its placeholders
+    return f"(activity_type IS NULL OR activity_type IN ({', '.join('?' * len(RUN_TYPES))}))"
+
+
+def get_activity_history(user_id):
+    """Get every activity's analytics fields for a user, oldest first, as plain tuples.
+
+    Each tuple is (date, distance, moving_time, elevation_gain, average_heartrate, is_run).
+    Tuples rather than dicts because analytics.py loads them straight into arrays.
+    """
+    return _activity_history(get_connection(), user_id)
+
+
+def _activity_history(conn, user_id):
     cursor = conn.cursor()
-    cursor.execute(
-        """SELECT activity_id, date, distance, activity_title 
-           FROM DailyMileage 
-           WHERE user_id = ? 
-           ORDER BY date DESC""",
-        (user_id,)
+    cursor.row_factory = None
+    return cursor.execute(
+        f"""SELECT date, distance, moving_time, elevation_gain, average_heartrate,
+                   activity_type IS NULL OR activity_type IN ({', '.join('?' * len(RUN_TYPES))})
+            FROM DailyMileage
+            WHERE user_id = ?
+            ORDER BY date, activity_id""",
+        (*RUN_TYPES, user_id)
+    ).fetchall()
+
+
+def get_activity_columns(user_id, pack):
+    """Get a user's packed analytics columns (bytes) from ActivityColumns.
+
+    On a miss, pack(get_activity_history rows) builds them. The history is read and
+    the result stored in one write transaction, so an ingest can't slip in between
+    and leave stale columns behind.
+    """
+    conn = get_connection()
+    row = conn.execute("SELECT columns FROM ActivityColumns WHERE user_id = ?", (user_id,)).fetchone()
+    if row:
+        return row['columns']
+
+    backend.begin_write(conn, [user_id])
+    try:
+        rows = _activity_history(conn, user_id)
+        columns = pack(rows)
+        conn.execute(
+            """INSERT INTO ActivityColumns (user_id, row_count, columns) VALUES (?, ?, ?)
+               ON CONFLICT (user_id) DO UPDATE SET row_count = excluded.row_count, columns = excluded.columns""",
+            (user_id, len(rows), columns)
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return columns
+
+
+def _mark_activities_changed(conn, user_ids):
+    # Bump the users' activity_version and drop their packed columns. The caller
+    # commits, then invalidates cache.trends once the change is visible. Users is
+    # updated first: get_activity_columns locks the same row before rebuilding.
+    params = [(user_id,) for user_id in sorted(user_ids)]
+    conn.executemany("UPDATE Users SET activity_version = activity_version + 1 WHERE id = ?", params)
+    conn.executemany("DELETE FROM ActivityColumns WHERE user_id = ?", params)
+
+
+def encode_cursor(date, activity_id):
+    return base64.urlsafe_b64encode(f"{date}|{activity_id}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decode a page cursor into (date, activity_id). Raises ValueError if it is malformed."""
+    try:
+        date, activity_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        datetime.date.fromisoformat(date)
+        return date, int(activity_id)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        raise ValueError("Invalid cursor")
+
+
+def _activity_filters(since, until, cursor, table=''):
+    """Build the extra WHERE clauses (each starting with AND) for date bounds and a page cursor."""
+    prefix = f"{table}." if table else ''
+    clauses = []
+    params = []
+    if since:
+        clauses.append(f"AND {prefix}date >= ?")
+        params.append(since)
+    if until:
+        clauses.append(f"AND {prefix}date <= ?")
+        params.append(until)
+    if cursor:
+        clauses.append(f"AND ({prefix}date, {prefix}activity_id) < (?, ?)")
+        params.extend(decode_cursor(cursor))
+    return ' '.join(clauses), params
+
+
+def _page_limit(limit):
+    # One extra row tells whether another page follows. limit is an int checked by the caller.
+    return f"LIMIT {int(limit) + 1}" if limit else ""
+
+
+def _split_page(activities, limit):
+    # One extra row was fetched to tell whether another page follows
+    if limit and len(activities) > limit:
+        activities = activities[:limit]
+        last = activities[-1]
+        return activities, encode_cursor(last['date'], last['activity_id'])
+    return activities, None
+
+
+# LEADERBOARDS
+#Weekly and monthly rankings of every user's runs (RUN_TYPES) by total distance and by longest run.
+#A board is one (period, period_start, metric). LeaderboardEntries holds each user's value on
+#each board and is refreshed in the same transaction as every ingest, for just the users and
+#periods it touched. LeaderboardCounts is a Fenwick (binary indexed) tree per board counting
+#users by value, rounded to LEADERBOARD_RESOLUTION miles, so a user's rank comes from about
+#log2(LEADERBOARD_BUCKETS) rows however many users are ranked. Users with equal (rounded)
+#values share a rank.
+
+LEADERBOARD_PERIODS = ('week', 'month')
+LEADERBOARD_METRICS = ('distance', 'long_run')
+LEADERBOARD_RESOLUTION = 0.01
+# A power of two, so the last node of the tree holds the board's total.
+# Values above 2621.43 miles share the top bucket.
+LEADERBOARD_BUCKETS = 1 << 18
+
+
+def leaderboard_period_of(period, date):
+    """Get the (start, end) YYYY-MM-DD dates of the week (Monday to Sunday) or month containing a date."""
+    if isinstance(date, str):
+        date = datetime.date.fromisoformat(date)
+    if period == 'week':
+        start = date - datetime.timedelta(days=date.weekday())
+        return start.isoformat(), (start + datetime.timedelta(days=6)).isoformat()
+    start = date.replace(day=1)
+    next_month = (start + datetime.timedelta(days=31)).replace(day=1)
+    return start.isoformat(), (next_month - datetime.timedelta(days=1)).isoformat()
+
+
+def _leaderboard_bucket(value):
+    # 1-based Fenwick index of a value
+    return min(int(round(value / LEADERBOARD_RESOLUTION)), LEADERBOARD_BUCKETS - 1) + 1
+
+
+def _fenwick_deltas(bucket_deltas):
+    # Turn per-(board, bucket) changes into per-(board, node) changes. Buckets are
+    # summed first, so users moving in and out of the same bucket cost nothing.
+    deltas = {}
+    for (*board, index), amount in bucket_deltas.items():
+        if not amount:
+            continue
+        while index <= LEADERBOARD_BUCKETS:
+            key = (*board, index)
+            deltas[key] = deltas.get(key, 0) + amount
+            index += index & -index
+    return deltas
+
+
+def _fenwick_prefix_nodes(index):
+    nodes = []
+    while index > 0:
+        nodes.append(index)
+        index -= index & -index
+    return nodes
+
+
+def _refresh_leaderboards(conn, weeks):
+    """Recompute the leaderboard entries (and tree counts) for a set of (user_id, week_start) pairs."""
+    boards = {}
+    for user_id, week_start in weeks:
+        week_end = (datetime.date.fromisoformat(week_start) + datetime.timedelta(days=6)).isoformat()
+        boards.setdefault(('week', week_start, week_end), set()).add(user_id)
+        # A week can span two months
+        for day in (week_start, week_end):
+            boards.setdefault(('month', *leaderboard_period_of('month', day)), set()).add(user_id)
+
+    bucket_deltas = {}
+    upserts = []
+    deletes = []
+    for (period, start, end), user_ids in boards.items():
+        user_ids = sorted(user_ids)
+        for offset in range(0, len(user_ids), 500):
+            batch = user_ids[offset:offset + 500]
+            marks = ','.join('?' * len(batch))
+            new = {}
+            for row in conn.execute(
+                f"""SELECT user_id, SUM(distance), MAX(distance)
+                    FROM DailyMileage
+                    WHERE user_id IN ({marks}) AND date BETWEEN ? AND ? AND {_run_filter()}
+                    GROUP BY user_id""",
+                (*batch, start, end, *RUN_TYPES)
+            ):
+                new[(row[0], 'distance')] = row[1]
+                new[(row[0], 'long_run')] = row[2]
+            old = {
+                (row['user_id'], row['metric']): row['value']
+                for row in conn.execute(
+                    f"""SELECT user_id, metric, value FROM LeaderboardEntries
+                        WHERE period = ? AND period_start = ? AND metric IN ('distance', 'long_run')
+                        AND user_id IN ({marks})""",
+                    (period, start, *batch)
+                )
+            }
+
+            for user_id, metric in new.keys() | old.keys():
+                before, after = old.get((user_id, metric)), new.get((user_id, metric))
+                if before == after:
+                    continue
+                board = (period, start, metric)
+                if before is not None:
+                    key = (*board, _leaderboard_bucket(before))
+                    bucket_deltas[key] = bucket_deltas.get(key, 0) - 1
+                if after is None:
+                    deletes.append((*board, user_id))
+                else:
+                    key = (*board, _leaderboard_bucket(after))
+                    bucket_deltas[key] = bucket_deltas.get(key, 0) + 1
+                    upserts.append((*board, user_id, after))
+
+    conn.executemany(
+        "DELETE FROM LeaderboardEntries WHERE period = ? AND period_start = ? AND metric = ? AND user_id = ?",
+        sorted(deletes)
     )
-    rows = cursor.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+    conn.executemany(
+        """INSERT INTO LeaderboardEntries (period, period_start, metric, user_id, value) VALUES (?, ?, ?, ?, ?)
+           ON CONFLICT (period, period_start, metric, user_id) DO UPDATE SET value = excluded.value""",
+        sorted(upserts)
+    )
+    _apply_leaderboard_counts(conn, _fenwick_deltas(bucket_deltas))
+
+
+def _apply_leaderboard_counts(conn, deltas):
+    conn.executemany(
+        """INSERT INTO LeaderboardCounts (period, period_start, metric, node, count) VALUES (?, ?, ?, ?, ?)
+           ON CONFLICT (period, period_start, metric, node) DO UPDATE SET count = LeaderboardCounts.count + excluded.count""",
+        sorted((*key, amount) for key, amount in deltas.items() if amount)
+    )
+
+
+def rebuild_leaderboards():
+    """Rebuild both leaderboard tables from scratch from DailyMileage. Returns the number of entries written."""
+    conn = get_connection()
+    with conn:
+        return _rebuild_leaderboards(conn)
+
+
+def _rebuild_leaderboards(conn):
+    conn.execute("DELETE FROM LeaderboardEntries")
+    conn.execute("DELETE FROM LeaderboardCounts")
+    written = 0
+    for period, period_start in (('week', backend.week_start('date')), ('month', "substr(date, 1, 7) || '-01'")):
+        cursor = conn.execute(
+            f"""INSERT INTO LeaderboardEntries (period, period_start, metric, user_id, value)
+                SELECT ?, period_start, metric, user_id, CASE metric WHEN 'distance' THEN total ELSE longest END
+                FROM (SELECT user_id, {period_start} AS period_start, SUM(distance) AS total, MAX(distance) AS longest
+                      FROM DailyMileage
+                      WHERE {_run_filter()}
+                      GROUP BY user_id, period_start) AS periods
+                CROSS JOIN (SELECT 'distance' AS metric UNION ALL SELECT 'long_run') AS metrics""",
+            (period, *RUN_TYPES)
+        )
+        written += cursor.rowcount
+
+    bucket_deltas = {}
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    for period, period_start, metric, value in cursor.execute(
+            "SELECT period, period_start, metric, value FROM LeaderboardEntries"):
+        key = (period, period_start, metric, _leaderboard_bucket(value))
+        bucket_deltas[key] = bucket_deltas.get(key, 0) + 1
+    _apply_leaderboard_counts(conn, _fenwick_deltas(bucket_deltas))
+    return written
+
+
+def get_leaderboard(period, period_start, metric, limit=10):
+    """Get the top of one board, best first, as dicts with rank, user_id, username and value.
+
+    A range read on the (board, value DESC) index, so it costs the same with 10 or 100k users.
+    """
+    conn = get_connection()
+    rows = conn.execute(
+        """SELECT e.user_id, u.username, e.value
+           FROM LeaderboardEntries e
+           JOIN Users u ON u.id = e.user_id
+           WHERE e.period = ? AND e.period_start = ? AND e.metric = ?
+           ORDER BY e.value DESC, e.user_id
+           LIMIT ?""",
+        (period, period_start, metric, limit)
+    ).fetchall()
+
+    leaders = []
+    previous_bucket = rank = None
+    for position, row in enumerate(rows, start=1):
+        bucket = _leaderboard_bucket(row['value'])
+        if bucket != previous_bucket:
+            rank, previous_bucket = position, bucket
+        leaders.append({'rank': rank, 'user_id': row['user_id'],
+                        'username': row['username'], 'value': round(row['value'], 2)})
+    return leaders
+
+
+def get_leaderboard_rank(user_id, period, period_start, metric):
+    """Get one user's place on a board as {'rank', 'value', 'ranked'}.
+
+    ranked is how many users are on the board. rank is None if the user isn't
+    on it (no runs that period). Reads one entry and one path through the tree.
+    """
+    conn = get_connection()
+    entry = conn.execute(
+        """SELECT value FROM LeaderboardEntries
+           WHERE period = ? AND period_start = ? AND metric = ? AND user_id = ?""",
+        (period, period_start, metric, user_id)
+    ).fetchone()
+    # Users at or below the user's bucket, plus the root node, which counts everyone
+    nodes = _fenwick_prefix_nodes(_leaderboard_bucket(entry['value'])) if entry else []
+    counts = dict(conn.execute(
+        f"""SELECT node, count FROM LeaderboardCounts
+            WHERE period = ? AND period_start = ? AND metric = ? AND node IN ({','.join('?' * (len(nodes) + 1))})""",
+        (period, period_start, metric, LEADERBOARD_BUCKETS, *nodes)
+    ).fetchall())
+    ranked = counts.get(LEADERBOARD_BUCKETS, 0)
+    if entry is None:
+        return {'rank': None, 'value': 0, 'ranked': ranked}
+    at_or_below = sum(counts.get(node, 0) for node in nodes)
+    return {'rank': ranked - at_or_below + 1, 'value': round(entry['value'], 2), 'ranked': ranked}
+
+
+# SYNC JOB QUEUE
+#Shared by every gunicorn worker through the database, so a user is never synced twice at once.
+
+def enqueue_sync_job(user_id):
+    """Queue a background sync for a user. Returns False if one is already queued or running."""
+    conn = get_connection()
+    cursor = conn.execute(
+        "INSERT INTO SyncJobs (user_id, requested_at) VALUES (?, ?) ON CONFLICT DO NOTHING",
+        (user_id, int(time.time()))
+    )
+    conn.commit()
+    return cursor.rowcount == 1
+
+
+def enqueue_stale_users(max_age):
+    """Queue a sync for every Strava-connected user not synced in max_age seconds. Returns how many were queued."""
+    now = int(time.time())
+    conn = get_connection()
+    cursor = conn.execute(
+        """INSERT INTO SyncJobs (user_id, requested_at)
+           SELECT id, ? FROM Users
+           WHERE strava_access_token IS NOT NULL AND last_sync_time < ?
+           ON CONFLICT DO NOTHING""",
+        (now, now - max_age)
+    )
+    conn.commit()
+    return cursor.rowcount
+
+
+def claim_sync_job(worker_id, lease_seconds):
+    """Atomically claim the oldest pending job, or one whose lease has expired.
+
+    Returns the claimed user_id, or None if there is nothing to do.
+    """
+    now = int(time.time())
+    conn = get_connection()
+    row = conn.execute(
+        f"""UPDATE SyncJobs
+           SET status = 'running', claimed_by = ?, claimed_at = ?
+           WHERE user_id = (
+               SELECT user_id FROM SyncJobs
+               WHERE status = 'pending' OR claimed_at < ?
+               ORDER BY requested_at
+               LIMIT 1{backend.skip_locked}
+           )
+           RETURNING user_id""",
+        (worker_id, now, now - lease_seconds)
+    ).fetchone()
+    conn.commit()
+    return row['user_id'] if row else None
+
+
+def claim_sync_job_for_user(user_id, worker_id, lease_seconds):
+    """Claim one user's job for worker_id, queueing it first if needed.
+
+    Returns False if another worker is already running it (and its lease hasn't expired).
+    """
+    now = int(time.time())
+    conn = get_connection()
+    row = conn.execute(
+        """INSERT INTO SyncJobs (user_id, requested_at, status, claimed_by, claimed_at)
+           VALUES (?, ?, 'running', ?, ?)
+           ON CONFLICT (user_id) DO UPDATE
+           SET status = 'running', claimed_by = excluded.claimed_by, claimed_at = excluded.claimed_at
+           WHERE SyncJobs.status = 'pending' OR SyncJobs.claimed_at < ?
+           RETURNING user_id""",
+        (user_id, now, worker_id, now, now - lease_seconds)
+    ).fetchone()
+    conn.commit()
+    return row is not None
+
+
+def finish_sync_job(user_id, worker_id):
+    """Remove a finished job, unless another worker has since taken over its lease."""
+    conn = get_connection()
+    conn.execute(
+        "DELETE FROM SyncJobs WHERE user_id = ? AND claimed_by = ?",
+        (user_id, worker_id)
+    )
+    conn.commit()
+
+
+# WEBHOOK EVENT QUEUE
+#Strava push events are stored as soon as they arrive and applied later by the scheduler.
+
+def enqueue_webhook_event(object_type, object_id, aspect_type, owner_id, event_time):
+    """Store a Strava webhook event. Returns its event_id."""
+    conn = get_connection()
+    cursor = conn.execute(
+        """INSERT INTO WebhookEvents (object_type, object_id, aspect_type, owner_id, event_time, received_at)
+           VALUES (?, ?, ?, ?, ?, ?)
+           RETURNING event_id""",
+        (object_type, object_id, aspect_type, owner_id, event_time, int(time.time()))
+    )
+    event_id = cursor.fetchone()[0]
+    conn.commit()
+    return event_id
+
+
+def claim_webhook_event(worker_id, lease_seconds):
+    """Atomically claim the oldest unclaimed event, or one whose lease has expired.
+
+    Returns the event as a dict (attempts includes this claim), or None if the queue is empty.
+    """
+    now = int(time.time())
+    conn = get_connection()
+    row = conn.execute(
+        f"""UPDATE WebhookEvents
+           SET claimed_by = ?, claimed_at = ?, attempts = attempts + 1
+           WHERE event_id = (
+               SELECT event_id FROM WebhookEvents
+               WHERE claimed_at IS NULL OR claimed_at < ?
+               ORDER BY event_id
+               LIMIT 1{backend.skip_locked}
+           )
+           RETURNING *""",
+        (worker_id, now, now - lease_seconds)
+    ).fetchone()
+    conn.commit()
+    return dict(row) if row else None
+
+
+def finish_webhook_event(event_id, worker_id):
+    """Remove an applied event, unless another worker has since taken over its lease."""
+    conn = get_connection()
+    conn.execute(
+        "DELETE FROM WebhookEvents WHERE event_id = ? AND claimed_by = ?",
+        (event_id, worker_id)
+    )
+    conn.commit()
+
+
+def get_user_id_for_athlete(strava_athlete_id):
+    """Get the user connected to a Strava athlete ID, or None."""
+    conn = get_connection()
+    row = conn.execute(
+        "SELECT id FROM Users WHERE strava_athlete_id = ?", (strava_athlete_id,)
+    ).fetchone()
+    return row['id'] if row else None
+
+
+def delete_activity(user_id, activity_id):
+    """Delete one activity and refresh its week's leaderboards. Returns True if it existed."""
+    conn = get_connection()
+    with conn:
+        backend.begin_write(conn, [user_id])
+        row = conn.execute(
+            "DELETE FROM DailyMileage WHERE activity_id = ? AND user_id = ? RETURNING date",
+            (activity_id, user_id)
+        ).fetchone()
+        if row is None:
+            return False
+        _refresh_leaderboards(conn, {(user_id, week_start_of(row['date']))})
+        _mark_activities_changed(conn, {user_id})
+    cache.trends.invalidate_group(user_id)
+    return True
+
+
+# ACTIVITIES API
+
+def get_activities_version(user_id):
+    """Get a cheap key that changes whenever the /api/activities payload would.
+
+    Built from the activity change counter (bumped by every insert, edit and
+    delete), last_sync_time, whether Strava is connected and the goal change
+    counter. Returns None for an unknown user.
+    """
+    conn = get_connection()
+    row = conn.execute(
+        """SELECT u.activity_version, u.last_sync_time,
+                  u.strava_access_token IS NOT NULL AS has_strava,
+                  COALESCE(a.goal_version, -1) AS goal_version
+           FROM Users u
+           LEFT JOIN Athletes a ON a.user_id = u.id
+           WHERE u.id = ?""",
+        (user_id,)
+    ).fetchone()
+    if not row:
+        return None
+    return _version_key(user_id, row['activity_version'], row['last_sync_time'],
+                        row['has_strava'], row['goal_version'])
+
+
+def get_trends_state(user_id):
+    """Get the goals /api/trends compares against and a key that changes with them or the activities.
+
+    Returns {'version', 'mileage_goal', 'long_run_goal'}, or None for an unknown user.
+    """
+    conn = get_connection()
+    row = conn.execute(
+        """SELECT u.activity_version, COALESCE(a.goal_version, -1) AS goal_version,
+                  a.mileage_goal, a.long_run_goal
+           FROM Users u
+           LEFT JOIN Athletes a ON a.user_id = u.id
+           WHERE u.id = ?""",
+        (user_id,)
+    ).fetchone()
+    if not row:
+        return None
+    return {
+        'version': f"{user_id}-{row['activity_version']}-{row['goal_version']}",
+        'mileage_goal': row['mileage_goal'] or 0,
+        'long_run_goal': row['long_run_goal'] or 0,
+    }
+
+
+def _version_key(user_id, activity_version, last_sync_time, has_strava, goal_version):
+    return f"{user_id}-{activity_version}-{last_sync_time or 0}-{int(bool(has_strava))}-{goal_version}"
+
+
+def get_activities_payload(user_id, since=None, until=None, limit=None, cursor=None):
+    """Get one page of what /api/activities returns, plus the version key, in one joined query.
+
+    Takes the same filters as get_activities_page. The version key is the one
+    get_activities_version returns: it covers all of the user's activities, not just this page.
+    """
+    where, params = _activity_filters(since, until, cursor, table='d')
+    conn = get_connection()
+    rows = conn.execute(
+        f"""SELECT u.activity_version, u.last_sync_time,
+                   u.strava_access_token IS NOT NULL AS has_strava,
+                   a.mileage_goal, a.long_run_goal,
+                   COALESCE(a.goal_version, -1) AS goal_version,
+                   d.activity_id, d.date, d.distance, d.activity_title
+            FROM Users u
+            LEFT JOIN Athletes a ON a.user_id = u.id
+            LEFT JOIN DailyMileage d ON d.user_id = u.id {where}
+            WHERE u.id = ?
+            ORDER BY d.date DESC, d.activity_id DESC
+            {_page_limit(limit)}""",
+        (*params, user_id)
+    ).fetchall()
+    if not rows:
+        return None
+
+    first = rows[0]
+    activities = [
+        {'activity_id': row['activity_id'], 'date': row['date'],
+         'distance': row['distance'], 'activity_title': row['activity_title']}
+        for row in rows if row['activity_id'] is not None
+    ]
+    activities, next_cursor = _split_page(activities, limit)
+    return {
+        'activities': activities,
+        'next_cursor': next_cursor,
+        'mileage_goal': first['mileage_goal'] or 0,
+        'long_run_goal': first['long_run_goal'] or 0,
+        'has_strava': bool(first['has_strava']),
+        'version': _version_key(user_id, first['activity_version'], first['last_sync_time'],
+                                first['has_strava'], first['goal_version']),
+    }
+
+
+DAY_NAMES = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+
+def get_week_summary(user_id, week_start):
+    """Summarize one Monday-to-Sunday week of a user's runs with a GROUP BY over DailyMileage.
+
+    week_start is a datetime.date for the Monday. Returns per-day mileage, the
+    week's total, what is left of mileage_goal, and the longest run against
+    long_run_goal. Rides, swims etc. aren't counted (see RUN_TYPES).
+    """
+    week_end = week_start + datetime.timedelta(days=6)
+    conn = get_connection()
+    rows = conn.execute(
+        f"""SELECT date, SUM(distance) AS total, MAX(distance) AS longest
+            FROM DailyMileage
+            WHERE user_id = ? AND date BETWEEN ? AND ? AND {_run_filter()}
+            GROUP BY date""",
+        (user_id, week_start.isoformat(), week_end.isoformat(), *RUN_TYPES)
+    ).fetchall()
+    goals = conn.execute(
+        "SELECT mileage_goal, long_run_goal FROM Athletes WHERE user_id = ?", (user_id,)
+    ).fetchone()
+
+    daily_mileage = dict.fromkeys(DAY_NAMES, 0)
+    longest_run = 0
+    for row in rows:
+        day = datetime.date.fromisoformat(row['date'])
+        daily_mileage[DAY_NAMES[day.weekday()]] = round(row['total'], 2)
+        longest_run = max(longest_run, row['longest'])
+
+    mileage_goal = (goals['mileage_goal'] or 0) if goals else 0
+    long_run_goal = (goals['long_run_goal'] or 0) if goals else 0
+    total = round(sum(daily_mileage.values()), 2)
+    return {
+        'week_start': week_start.isoformat(),
+        'daily_mileage': daily_mileage,
+        'total': total,
+        'goal': mileage_goal,
+        'remaining': round(max(0, mileage_goal - total), 2),
+        'longest_run': longest_run,
+        'long_run_goal': long_run_goal,
+        'long_run_remaining': round(max(0, long_run_goal - longest_run), 2),
+    }
+
+
+def get_queue_depths():
+    """Count the sync jobs and webhook events waiting (or running). Used by /metrics."""
+    conn = get_connection()
+    row = conn.execute(
+        """SELECT (SELECT COUNT(*) FROM SyncJobs) AS sync_jobs,
+                  (SELECT COUNT(*) FROM WebhookEvents) AS webhook_events"""
+    ).fetchone()
+    return dict(row)
+
+
+# Time every public function above for /metrics (does nothing when metrics are disabled).
+# Pure helpers that run once per row are left out
+metrics.instrument_module(sys.modules[__name__], metrics.db_call_seconds,
+                          skip=('week_start_of', 'leaderboard_period_of', 'encode_cursor', 'decode_cursor'))
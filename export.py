@@ -0,0 +1,70 @@
+"""
+export.py - Streaming encoders for /api/activities/export.
+
+Each encoder takes an iterator of activity rows from database.iter_activities
+and yields text chunks, one per batch of rows, so an export of any size runs in
+constant memory and the first bytes go out as soon as the first batch is read.
+"""
+import csv
+import io
+import json
+import zlib
+
+FIELDS = ('activity_id', 'date', 'distance', 'activity_title')
+
+# Rows encoded per yielded chunk
+CHUNK_ROWS = 1000
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def _batches(rows, size=CHUNK_ROWS):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def ndjson_chunks(rows):
+    """Yield one JSON object per line."""
+    for batch in _batches(rows):
+        yield ''.join(json.dumps(dict(zip(FIELDS, row))) + '\n' for row in batch)
+
+
+def csv_chunks(rows):
+    """Yield a header line and then the rows as CSV."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    yield buffer.getvalue()
+
+    for batch in _batches(rows):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(tuple(row) for row in batch)
+        yield buffer.getvalue()
+
+
+def encode(rows, format):
+    """Yield rows encoded as format ('ndjson' or 'csv')."""
+    if format == 'csv':
+        return csv_chunks(rows)
+    return ndjson_chunks(rows)
+
+
+def gzip_chunks(chunks, level=6):
+    """gzip a stream of text chunks without holding more than one chunk in memory."""
+    # wbits=31 writes the gzip header and trailer instead of a raw zlib stream
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,19 @@
+# import_archive.py
+import argparse
+import database
+import importer
+
+
+parser = argparse.ArgumentParser(description="Import a Strava bulk export into a user's mileage history")
+parser.add_argument("username", help="MileageTracker user to import into")
+parser.add_argument("archive", help="the export zip, or the activities.csv inside it")
+args = parser.parse_args()
+
+user = database.get_user_by_username(args.username)
+if user is None:
+    raise SystemExit(f"No user named {args.username}")
+
+print(f"Importing {args.archive} for {args.username}...")
+stats = importer.import_archive(user['id'], args.archive)
+print(f"Done. {stats['rows_written']} of {stats['rows_read']} activities written "
+      f"({stats['skipped']} unreadable) in {stats['seconds']:.1f}s.")
@@ -0,0 +1,132 @@
+"""
+importer.py - Offline import of a Strava bulk export (Settings > My Account >
+Download or Delete Your Account).
+
+The export is a zip holding activities.csv plus one GPX/FIT file per activity.
+Only activities.csv is read: it has the ID, start time and distance of every
+activity, which is all DailyMileage stores. Rows are parsed one at a time and
+written with database.create_activities_bulk, so years of history go in with a
+handful of large transactions and no Strava API calls.
+"""
+import contextlib
+import csv
+import datetime
+import io
+import time
+import zipfile
+
+import collector
+import database
+
+# "Activity Date" in activities.csv, e.g. "Mar 5, 2024, 6:02:11 PM" (UTC)
+ARCHIVE_DATE_FORMAT = "%b %d, %Y, %I:%M:%S %p"
+
+# activities.csv columns for the Strava API fields activity_to_row reads. Optional:
+# older exports lack some of them. Where a name repeats, the first column is used.
+DETAIL_COLUMNS = {
+    'name': ('Activity Name', str),
+    'type': ('Activity Type', str),
+    'moving_time': ('Moving Time', lambda value: int(float(value))),
+    'elapsed_time': ('Elapsed Time', lambda value: int(float(value))),
+    'total_elevation_gain': ('Elevation Gain', float),
+    'average_heartrate': ('Average Heart Rate', float),
+}
+
+# Rows per transaction; larger than the API sync's chunks since nothing else is waiting on them
+IMPORT_CHUNK_SIZE = 20000
+
+
+@contextlib.contextmanager
+def open_archive(file, filename=''):
+    """Open activities.csv from an export zip or a bare CSV as a text stream.
+
+    file is a path or a binary file object. Used as a context manager, which
+    closes the zip, its member and any file it opened itself; a file object
+    passed in is left open. Raises ValueError if a zip has no activities.csv.
+    """
+    name = filename or (file if isinstance(file, str) else '')
+    with contextlib.ExitStack() as stack:
+        if isinstance(file, str):
+            file = stack.enter_context(open(file, 'rb'))
+        if name.lower().endswith('.zip') or zipfile.is_zipfile(file):
+            file.seek(0)
+            archive = stack.enter_context(zipfile.ZipFile(file))
+            members = [member for member in archive.namelist() if member.rsplit('/', 1)[-1] == 'activities.csv']
+            if not members:
+                raise ValueError("No activities.csv in the archive")
+            file = stack.enter_context(archive.open(members[0]))
+        else:
+            file.seek(0)
+        lines = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+        try:
+            yield lines
+        finally:
+            # Closing is left to the stack, so a caller's file isn't closed with the wrapper
+            lines.detach()
+
+
+def iter_archive_activities(user_id, lines, stats=None):
+    """Yield a DailyMileage row dict for each activity in an activities.csv stream.
+
+    Rows without a usable ID, date or distance are skipped and counted in stats['skipped'].
+    Activities repeated within the file are only yielded once.
+    """
+    stats = stats if stats is not None else {}
+    stats.setdefault('rows_read', 0)
+    stats.setdefault('skipped', 0)
+
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if not header or 'Activity ID' not in header or 'Distance' not in header:
+        raise ValueError("Not a Strava activities.csv file")
+    id_column = header.index('Activity ID')
+    date_column = header.index('Activity Date')
+    # The first Distance column is in the athlete's display units; the last one is in meters
+    distance_column = len(header) - 1 - header[::-1].index('Distance')
+    detail_columns = [
+        (field, header.index(column), parse)
+        for field, (column, parse) in DETAIL_COLUMNS.items() if column in header
+    ]
+
+    seen = set()
+    for row in reader:
+        stats['rows_read'] += 1
+        try:
+            activity_id = int(row[id_column])
+            started = datetime.datetime.strptime(row[date_column], ARCHIVE_DATE_FORMAT)
+            meters = float(row[distance_column])
+        except (ValueError, IndexError):
+            stats['skipped'] += 1
+            continue
+        if activity_id in seen:
+            continue
+        seen.add(activity_id)
+
+        activity = {
+            'id': activity_id,
+            'start_date_local': started.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            'distance': meters,
+        }
+        for field, column, parse in detail_columns:
+            try:
+                activity[field] = parse(row[column]) if row[column] else None
+            except (ValueError, IndexError):
+                activity[field] = None
+
+        # Same conversion as an API sync. The export only has the UTC start
+        # time, so runs near midnight can land on a different day than the API puts them.
+        yield collector.activity_to_row(user_id, activity)
+
+
+def import_archive(user_id, file, filename=''):
+    """Import a Strava bulk export (zip) or its activities.csv for a user.
+
+    Returns a stats dict with rows_read, rows_written, skipped and seconds.
+    """
+    stats = {}
+    started = time.perf_counter()
+    with open_archive(file, filename) as lines:
+        rows = iter_archive_activities(user_id, lines, stats)
+        stats['rows_written'] = database.create_activities_bulk(rows, chunk_size=IMPORT_CHUNK_SIZE)
+    stats['seconds'] = time.perf_counter() - started
+    return stats
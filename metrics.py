@@ -0,0 +1,195 @@
+"""
+metrics.py - In-process latency histograms and counters, served at /metrics in
+Prometheus text format.
+
+Recorded: every Flask route, every public database function (plus the time to
+open a connection), every Strava endpoint, activity rows ingested and tokens
+refreshed. Stats the modules already keep (cache hit rates, sync totals, rate
+limiting) are read at scrape time.
+
+Set METRICS_ENABLED=0 to turn it all off. Nothing is wrapped or hooked then, and
+the remaining inc()/observe() calls return on their first line.
+
+Like cache.py, each gunicorn worker has its own numbers, and a scrape sees
+whichever worker answered it.
+"""
+import functools
+import inspect
+import os
+import threading
+import time
+
+ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+
+# Seconds; Prometheus client defaults with a finer low end for SQLite queries
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+_gauges = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, *labels):
+        if not ENABLED:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.label_names, labels)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts..., sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, seconds, *labels):
+        if not ENABLED:
+            return
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += seconds
+            series[-1] += 1
+
+    def count(self, *labels):
+        series = self._series.get(labels)
+        return series[-1] if series else 0
+
+    def time(self, *labels):
+        """Decorator that observes how long each call to a function takes."""
+        def decorator(function):
+            if not ENABLED:
+                return function
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - started, *labels)
+            return wrapper
+        return decorator
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                # Buckets are stored per range and reported cumulatively
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_labels(self.label_names, labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, labels, [('le', '+Inf')])} {series[-1]}")
+                lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {_number(series[-2])}")
+                lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {series[-1]}")
+        return lines
+
+
+def gauge(name, help, labels, read, kind='gauge'):
+    """Register a metric whose values come from read() at scrape time.
+
+    read returns a dict of label-value tuples to numbers. kind is 'counter' for
+    running totals another module already keeps.
+    """
+    _gauges.append((name, help, tuple(labels), read, kind))
+
+
+def _render_gauges():
+    lines = []
+    for name, help, label_names, read, kind in _gauges:
+        lines.extend([f"# HELP {name} {help}", f"# TYPE {name} {kind}"])
+        try:
+            values = read()
+        except Exception as e:
+            print(f"Metrics gauge {name} failed: {e}")
+            continue
+        for labels, value in sorted(values.items()):
+            lines.append(f"{name}{_labels(label_names, labels)} {_number(value)}")
+    return lines
+
+
+def render():
+    """All metrics in Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    lines.extend(_render_gauges())
+    return '\n'.join(lines) + '\n'
+
+
+def instrument_module(module, histogram, skip=()):
+    """Time every public function defined in a module with histogram, labelled by function name.
+
+    Generator functions are left alone, since a call only creates the generator.
+    """
+    if not ENABLED:
+        return
+    for name, function in list(vars(module).items()):
+        if (name.startswith('_') or name in skip or not inspect.isfunction(function)
+                or function.__module__ != module.__name__ or inspect.isgeneratorfunction(function)):
+            continue
+        setattr(module, name, histogram.time(name)(function))
+
+
+http_request_seconds = Histogram(
+    'http_request_duration_seconds', "Time spent handling each Flask route.", ['route', 'method'])
+http_requests = Counter(
+    'http_requests_total', "Requests handled, by route and response status.", ['route', 'method', 'status'])
+db_call_seconds = Histogram(
+    'db_call_duration_seconds', "Time spent in each database.py function.", ['function'])
+db_connect_seconds = Histogram(
+    'db_connect_duration_seconds', "Time to open and configure a new SQLite connection.")
+strava_request_seconds = Histogram(
+    'strava_request_duration_seconds', "Strava API call latency, by endpoint.", ['endpoint'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+strava_requests = Counter(
+    'strava_requests_total', "Strava API calls, by endpoint and response status.", ['endpoint', 'status'])
+rows_ingested = Counter(
+    'activity_rows_ingested_total', "DailyMileage rows inserted or updated.")
+tokens_refreshed = Counter(
+    'strava_tokens_refreshed_total', "Strava access tokens refreshed.")
+login_stage_seconds = Histogram(
+    'login_stage_duration_seconds', "Time spent in each stage of a login.", ['stage'])
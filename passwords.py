@@ -0,0 +1,141 @@
+"""
+passwords.py - Password hashing for logins and registration.
+
+PBKDF2 is deliberately slow (~0.3s of CPU per check), so checks run on a small
+dedicated thread pool. At most HASH_WORKERS hashes run at once, leaving CPU for
+other requests, and once MAX_PENDING checks are waiting new ones are turned away
+with HashingBusy instead of piling up. Hashes made with older parameters than
+PASSWORD_METHOD are upgraded after the next successful login.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+import metrics
+
+# Current hashing parameters. Stored hashes start with the method they were made
+# with (e.g. "pbkdf2:sha256:260000$..."), so old ones can be spotted and upgraded.
+PASSWORD_METHOD = 'pbkdf2:sha256:600000'
+
+HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+MAX_PENDING = HASH_WORKERS * 8
+HASH_TIMEOUT_SECONDS = 10
+
+_executor = ThreadPoolExecutor(HASH_WORKERS, thread_name_prefix="password-hash")
+_pending = threading.BoundedSemaphore(MAX_PENDING)
+
+# Checked against when the username doesn't exist, so unknown and known
+# usernames take the same time to reject. Made on first use rather than at
+# import, since it costs a full hash.
+_dummy_hash = None
+
+_latency = {}
+_lock = threading.Lock()
+
+
+class HashingBusy(Exception):
+    """Raised when too many password checks are already waiting, or one takes too long."""
+
+
+def hash_password(password):
+    return generate_password_hash(password, method=PASSWORD_METHOD)
+
+
+def needs_rehash(password_hash):
+    """True if a stored hash was made with different parameters than PASSWORD_METHOD."""
+    return password_hash.split('$', 1)[0] != PASSWORD_METHOD
+
+
+def _get_dummy_hash():
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = hash_password('not-a-password')
+    return _dummy_hash
+
+
+def _run(function, *args):
+    # Runs function on the hashing pool. Returns (result, seconds queued, seconds running).
+    pending = _pending
+    if not pending.acquire(blocking=False):
+        raise HashingBusy("Too many password checks in progress")
+    submitted = time.perf_counter()
+
+    def timed():
+        started = time.perf_counter()
+        return function(*args), started - submitted, time.perf_counter() - started
+
+    try:
+        future = _executor.submit(timed)
+    except Exception:
+        pending.release()
+        raise
+    # The slot is held until the hash actually finishes, not just until we stop
+    # waiting for it, so timed-out checks still count against MAX_PENDING
+    future.add_done_callback(lambda _: pending.release())
+    try:
+        return future.result(timeout=HASH_TIMEOUT_SECONDS)
+    except TimeoutError:
+        raise HashingBusy("Password check timed out")
+
+
+def verify(password_hash, password):
+    """Check a password against a stored hash (or None for an unknown user) on the hashing pool.
+
+    Returns True/False. Raises HashingBusy if the pool is saturated or the check times out.
+    """
+    valid, queued, hashing = _run(check_password_hash, password_hash or _get_dummy_hash(), password)
+    record('hash_queue', queued)
+    record('hash_check', hashing)
+    return valid and password_hash is not None
+
+
+def rehash_in_background(password, save):
+    """Hash password with the current parameters on the hashing pool and pass the result to save.
+
+    Takes a pending slot like a check does. If none is free the upgrade is
+    skipped; it will be tried again on the user's next login.
+    """
+    # Imported here because database imports this module
+    import database
+
+    pending = _pending
+    if not pending.acquire(blocking=False):
+        return
+
+    def rehash():
+        try:
+            save(hash_password(password))
+        except Exception as e:
+            print(f"Password rehash failed: {e}")
+        finally:
+            # save ran on a hashing-pool thread; give its pooled connection back
+            database.release_connection()
+
+    try:
+        future = _executor.submit(rehash)
+    except Exception:
+        pending.release()
+        raise
+    future.add_done_callback(lambda _: pending.release())
+
+
+def record(stage, seconds):
+    """Add one timing to a login stage's latency stats."""
+    metrics.login_stage_seconds.observe(seconds, stage)
+    with _lock:
+        stats = _latency.setdefault(stage, {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+        stats['count'] += 1
+        stats['total_seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+
+def latency_stats():
+    """Per-stage login counts and average/max latency in seconds."""
+    with _lock:
+        return {
+            stage: dict(stats, avg_seconds=stats['total_seconds'] / stats['count'])
+            for stage, stats in _latency.items()
+        }
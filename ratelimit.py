@@ -0,0 +1,126 @@
+"""
+ratelimit.py - Client-side pacing for the Strava API.
+
+Strava allows a fixed number of requests per 15 minutes (windows reset at :00,
+:15, :30 and :45) and per UTC day. It reports both in every response:
+
+    X-RateLimit-Limit: 600,30000
+    X-RateLimit-Usage: 12,540
+
+StravaRateLimiter reads those headers and spreads whatever is left of the
+15-minute window (capped by what is left of the day) over the time until that
+window resets. Batch syncs can then run as fast
+as the quota allows without getting 429s.
+"""
+import threading
+import time
+
+SHORT_WINDOW_SECONDS = 15 * 60
+
+# Strava's default application limits, used until the first response arrives
+DEFAULT_SHORT_LIMIT = 200
+DEFAULT_DAILY_LIMIT = 2000
+
+
+class TokenBucket:
+    """Thread-safe token bucket. rate is tokens per second, capacity the burst size."""
+
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def configure(self, rate=None, capacity=None, tokens=None):
+        with self._lock:
+            self._refill()
+            if rate is not None:
+                self.rate = rate
+            if capacity is not None:
+                self.capacity = capacity
+            if tokens is not None:
+                self.tokens = tokens
+            self.tokens = min(self.tokens, self.capacity)
+
+    def acquire(self):
+        """Take one token, sleeping until one is available. Returns seconds waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                if self.rate > 0:
+                    delay = (1 - self.tokens) / self.rate
+                else:
+                    delay = 1.0
+            self._sleep(delay)
+            waited += delay
+
+
+def _seconds_until_reset(now, window):
+    return window - (now % window)
+
+
+class StravaRateLimiter:
+    """Paces Strava requests using the limit and usage headers on each response."""
+
+    def __init__(self, short_limit=DEFAULT_SHORT_LIMIT, daily_limit=DEFAULT_DAILY_LIMIT,
+                 clock=time.time, sleep=time.sleep):
+        self._clock = clock
+        self.short_limit = short_limit
+        self.daily_limit = daily_limit
+        self.throttled = 0
+        self.bucket = TokenBucket(self._rate(short_limit, daily_limit), capacity=1, sleep=sleep)
+        # Allow a small burst up front; the first response tells us the real budget
+        self.bucket.configure(capacity=min(short_limit, 10), tokens=min(short_limit, 10))
+
+    def _rate(self, short_remaining, daily_remaining):
+        allowed = max(min(short_remaining, daily_remaining), 0)
+        return allowed / _seconds_until_reset(self._clock(), SHORT_WINDOW_SECONDS)
+
+    def acquire(self):
+        """Block until a request can be made."""
+        return self.bucket.acquire()
+
+    def update(self, response):
+        """Re-pace from a response's X-RateLimit headers. A 429 pauses until the window resets."""
+        limits = _parse_pair(response.headers.get('X-RateLimit-Limit'))
+        usage = _parse_pair(response.headers.get('X-RateLimit-Usage'))
+        if limits:
+            self.short_limit, self.daily_limit = limits
+
+        if response.status_code == 429:
+            self.throttled += 1
+            self.bucket.configure(rate=1 / _seconds_until_reset(self._clock(), SHORT_WINDOW_SECONDS), tokens=0)
+            return
+
+        if not usage:
+            return
+        short_remaining = max(self.short_limit - usage[0], 0)
+        daily_remaining = max(self.daily_limit - usage[1], 0)
+        burst = max(min(short_remaining, daily_remaining, 10), 1)
+        self.bucket.configure(
+            rate=self._rate(short_remaining, daily_remaining),
+            capacity=burst,
+            tokens=min(self.bucket.tokens, short_remaining, daily_remaining),
+        )
+
+
+def _parse_pair(header):
+    if not header:
+        return None
+    try:
+        short, daily = header.split(',')[:2]
+        return int(short), int(daily)
+    except (ValueError, TypeError, AttributeError):
+        return None
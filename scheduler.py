@@ -0,0 +1,256 @@
+"""
+scheduler.py - Background Strava sync.
+
+Requests never call Strava themselves. They queue a job in the SyncJobs table and
+return right away. Each gunicorn worker runs one SyncScheduler, which claims jobs
+from that table and syncs them on a small thread pool. A job is claimed with a
+single UPDATE, so two workers can never sync the same user at the same time. The
+scheduler also sweeps for connected users whose data is older than
+SYNC_INTERVAL_SECONDS and queues them.
+
+Strava webhook events (see /strava/webhook) are queued in the WebhookEvents
+table and applied on the same pool, one API call per changed activity. With a
+webhook subscription in place the sweep is only a safety net, so
+SYNC_INTERVAL_SECONDS can be raised to hours.
+
+While ENCRYPTION_KEYS lists an old key, each sweep also re-encrypts a batch of
+stored tokens under the newest one (see vault.py).
+"""
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import collector
+import database
+
+# Freshness policy: a user's data is re-synced once it is this old (15 minutes by default)
+SYNC_INTERVAL_SECONDS = int(os.getenv("SYNC_INTERVAL_SECONDS", "900"))
+# How often the queue is polled and how often stale users are swept up
+POLL_SECONDS = 2
+SWEEP_SECONDS = 60
+# A claimed job that isn't finished within this long is handed to another worker
+LEASE_SECONDS = 600
+# A webhook event is retried (after its lease expires) this many times before it is dropped
+WEBHOOK_MAX_ATTEMPTS = 5
+WEBHOOK_LEASE_SECONDS = 120
+
+MAX_WORKERS = int(os.getenv("SYNC_WORKERS", "2"))
+# Users whose tokens are re-encrypted per sweep while an old encryption key is still listed
+KEY_ROTATION_BATCH = 500
+
+
+class SyncScheduler:
+    def __init__(self, max_workers=MAX_WORKERS):
+        self.max_workers = max_workers
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{id(self)}"
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pool = None
+        self._last_sweep = 0
+        # Where the key rotation pass has got to (None once it's finished)
+        self._rotation_after = 0 if database.token_vault.rotating else None
+
+    def start(self):
+        """Start the background loop. Safe to call on every request."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            # Taken again here since gunicorn may fork after this module is imported
+            self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{id(self)}"
+            self._pool = ThreadPoolExecutor(self.max_workers, thread_name_prefix="strava-sync")
+            self._thread = threading.Thread(target=self._run, name="sync-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self, wait=True):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
+            self._pool = None
+
+    def request_sync(self, user_id):
+        """Queue a sync for a user and return immediately. Duplicate requests are ignored."""
+        queued = database.enqueue_sync_job(user_id)
+        self._wake.set()
+        return queued
+
+    def notify(self):
+        """Wake the loop now instead of at the next poll."""
+        self._wake.set()
+
+    def run_once(self):
+        """Sweep for stale users, then run every claimable job and webhook event in the calling thread.
+
+        Returns the number of jobs and events handled.
+        """
+        database.enqueue_stale_users(SYNC_INTERVAL_SECONDS)
+        handled = 0
+        while True:
+            event = database.claim_webhook_event(self.worker_id, WEBHOOK_LEASE_SECONDS)
+            if event is None:
+                break
+            self._apply_event(event)
+            handled += 1
+        while True:
+            user_id = database.claim_sync_job(self.worker_id, LEASE_SECONDS)
+            if user_id is None:
+                return handled
+            self._sync(user_id)
+            handled += 1
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if time.time() - self._last_sweep >= SWEEP_SECONDS:
+                    database.enqueue_stale_users(SYNC_INTERVAL_SECONDS)
+                    self._rotate_keys()
+                    self._last_sweep = time.time()
+                self._dispatch()
+            except Exception as e:
+                print(f"Sync scheduler error: {e}")
+            self._wake.wait(POLL_SECONDS)
+            self._wake.clear()
+
+    def _rotate_keys(self):
+        # Tokens written from now on already use the newest key, so one pass over the table is enough
+        if self._rotation_after is None:
+            return
+        self._rotation_after, rotated = database.rotate_token_keys(self._rotation_after, KEY_ROTATION_BATCH)
+        if rotated:
+            print(f"Re-encrypted tokens for {rotated} users under the newest key")
+        if self._rotation_after is None:
+            print("Token key rotation finished; old keys can be removed from ENCRYPTION_KEYS")
+
+    def _dispatch(self):
+        # Only claim work when a pool thread is free to run it. Webhook events
+        # go first since each one is a single cheap API call.
+        while self._slots.acquire(blocking=False):
+            event = database.claim_webhook_event(self.worker_id, WEBHOOK_LEASE_SECONDS)
+            if event is not None:
+                self._pool.submit(self._run_job, self._apply_event, event)
+                continue
+            user_id = database.claim_sync_job(self.worker_id, LEASE_SECONDS)
+            if user_id is None:
+                self._slots.release()
+                return
+            self._pool.submit(self._run_job, self._sync, user_id)
+
+    def _run_job(self, work, item):
+        try:
+            work(item)
+        finally:
+            database.release_connection()
+            self._slots.release()
+            self._wake.set()
+
+    def _apply_event(self, event):
+        try:
+            collector.apply_webhook_event(event)
+        except Exception as e:
+            print(f"Webhook event {event['event_id']} failed (attempt {event['attempts']}): {e}")
+            if event['attempts'] < WEBHOOK_MAX_ATTEMPTS:
+                # Left claimed, so it is retried once the lease expires
+                return
+            print(f"Dropping webhook event {event['event_id']}")
+        database.finish_webhook_event(event['event_id'], self.worker_id)
+
+    def _sync(self, user_id):
+        try:
+            user_row = database.get_user_by_id(user_id)
+            last_sync = (user_row['last_sync_time'] or 0) if user_row else 0
+            if user_row and time.time() - last_sync >= SYNC_INTERVAL_SECONDS:
+                # A failed sync stays stale, so the next sweep retries it
+                if collector.fetch_and_save_user_data(user_id) is not None:
+                    database.update_last_sync_time(user_id)
+        except Exception as e:
+            print(f"Background sync failed for User {user_id}: {e}")
+        finally:
+            database.finish_sync_job(user_id, self.worker_id)
+
+
+_scheduler = SyncScheduler()
+
+
+def sync_all_users(max_workers=8):
+    """Sync every Strava-connected user now, several at a time.
+
+    All threads share collector's pooled HTTP session and rate limiter, so the
+    batch runs as fast as Strava's quota allows. Each user is claimed through
+    SyncJobs like a scheduler job, so users a scheduler is already syncing are
+    skipped. Returns a summary dict.
+    """
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:batch"
+    user_ids = database.get_strava_user_ids()
+    started = time.perf_counter()
+    collector.prime_access_tokens(user_ids)
+
+    def sync_one(user_id):
+        if not database.claim_sync_job_for_user(user_id, worker_id, LEASE_SECONDS):
+            return 'skipped'
+        try:
+            stats = collector.fetch_and_save_user_data(user_id)
+            if stats is not None:
+                database.update_last_sync_time(user_id)
+            return stats
+        finally:
+            database.finish_sync_job(user_id, worker_id)
+            database.release_connection()
+
+    with ThreadPoolExecutor(max_workers, thread_name_prefix="strava-batch") as pool:
+        results = list(pool.map(sync_one, user_ids))
+
+    elapsed = time.perf_counter() - started
+    skipped = results.count('skipped')
+    synced = [stats for stats in results if stats is not None and stats != 'skipped']
+    summary = {
+        'users': len(user_ids),
+        'synced': len(synced),
+        'skipped': skipped,
+        'failed': len(user_ids) - len(synced) - skipped,
+        'api_calls': sum(stats['api_calls'] for stats in synced),
+        'rows_written': sum(stats['rows_written'] for stats in synced),
+        'throttled': collector.client.rate_limiter.throttled,
+        'seconds': elapsed,
+    }
+    print(f"Batch sync: {summary['synced']}/{summary['users']} users in {elapsed:.1f}s")
+    return summary
+
+
+def start():
+    """Start this process's scheduler unless SYNC_SCHEDULER_ENABLED is 0."""
+    if os.getenv("SYNC_SCHEDULER_ENABLED", "1") != "0":
+        _scheduler.start()
+
+
+def request_sync(user_id):
+    return _scheduler.request_sync(user_id)
+
+
+def notify():
+    """Wake the scheduler so newly queued webhook events are applied right away."""
+    _scheduler.notify()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Background Strava sync")
+    parser.add_argument("command", choices=["sync-all", "run-once"])
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    if args.command == "sync-all":
+        sync_all_users(args.workers)
+    else:
+        SyncScheduler().run_once()
@@ -1,8 +1,27 @@
 # setup_db.py
+import argparse
 import database
 
 
-# Run the setup function
-print("Creating tables...")
-database.init_db()
-print("Done.")
\ No newline at end of file
+parser = argparse.ArgumentParser(description="Set up or maintain the MileageTracker database")
+parser.add_argument("--rebuild-leaderboards", action="store_true",
+                    help="rebuild the weekly and monthly leaderboards from DailyMileage")
+parser.add_argument("--rotate-keys", action="store_true",
+                    help="re-encrypt stored Strava tokens under the first key in ENCRYPTION_KEYS")
+args = parser.parse_args()
+
+if args.rebuild_leaderboards:
+    print("Rebuilding leaderboards...")
+    print(f"Done. {database.rebuild_leaderboards()} entries written.")
+elif args.rotate_keys:
+    print("Re-encrypting tokens...")
+    after, total = 0, 0
+    while after is not None:
+        after, rotated = database.rotate_token_keys(after)
+        total += rotated
+    print(f"Done. Tokens for {total} users re-encrypted.")
+else:
+    # Run the setup function
+    print("Creating tables...")
+    database.init_db()
+    print("Done.")
@@ -13,3 +13,42 @@ root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 if root_dir not in sys.path:
     sys.path.insert(0, root_dir)
 
+
+import pytest
+from cryptography.fernet import Fernet
+
+# database.py refuses to import without a key; tests don't need a real one
+os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
+os.environ.setdefault("FLASK_SECRET_KEY", "test-secret")
+# Tests drive the scheduler by hand instead of letting app.py start its thread
+os.environ.setdefault("SYNC_SCHEDULER_ENABLED", "0")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "sqlite_only: test inspects SQLite itself; skipped when DATABASE_URL is set")
+
+
+def pytest_collection_modifyitems(config, items):
+    # DATABASE_URL=postgresql://... runs the suite against PostgreSQL
+    if os.getenv("DATABASE_URL"):
+        skip = pytest.mark.skip(reason="SQLite-specific")
+        for item in items:
+            if "sqlite_only" in item.keywords:
+                item.add_marker(skip)
+
+
+@pytest.fixture(autouse=True)
+def temp_database(tmp_path, monkeypatch):
+    """Point every test at its own throwaway database file (or an emptied server database)."""
+    import cache
+    import database
+    monkeypatch.setattr(database, "DB_NAME", str(tmp_path / "MileageTracker.db"))
+    if database.backend.pooled:
+        conn = database.get_connection()
+        conn.execute("DROP SCHEMA public CASCADE")
+        conn.execute("CREATE SCHEMA public")
+    yield database.DB_NAME
+    database.close_connection()
+    cache.tokens.clear()
+    cache.users.clear()
+    cache.trends.clear()
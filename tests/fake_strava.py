@@ -0,0 +1,191 @@
+"""
+fake_strava.py - A local stand-in for the Strava API, for tests and benchmarks.
+
+Serves the endpoints collector.py uses on a random localhost port. Access tokens
+have the form "athlete-<id>" so every request can be tied to an athlete. The
+server also enforces a 15-minute/daily request quota and sends Strava's
+X-RateLimit headers.
+
+    with FakeStrava(activities_per_athlete=120) as strava:
+        collector.client = collector.StravaClient(base_url=strava.url)
+"""
+import datetime
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+EPOCH = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def make_activity(athlete_id, index):
+    """Build the index-th activity for an athlete, one per day from 2020-01-01."""
+    started = EPOCH + datetime.timedelta(days=index, hours=12)
+    return {
+        'id': athlete_id * 1_000_000 + index + 1,
+        'athlete': {'id': athlete_id},
+        'name': f"Run {index + 1}",
+        'type': 'Run',
+        'distance': 5000.0 + (index % 10) * 1000,
+        'moving_time': 1500 + (index % 10) * 300,
+        'elapsed_time': 1600 + (index % 10) * 300,
+        'total_elevation_gain': float(index % 50),
+        'average_heartrate': 140.0 + index % 20,
+        'start_date': started.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        'start_date_local': started.strftime("%Y-%m-%dT%H:%M:%SZ"),
+    }
+
+
+class FakeStrava:
+    def __init__(self, activities_per_athlete=10, latency=0.0, short_limit=100000, daily_limit=1000000):
+        self.activities_per_athlete = activities_per_athlete
+        self.latency = latency
+        self.short_limit = short_limit
+        self.daily_limit = daily_limit
+        self.requests = 0
+        self.rejected = 0
+        self.deleted = set()
+        # Activity IDs any athlete can fetch by ID, like other athletes' public activities
+        self.public = set()
+        # Answer this many upcoming requests with 503, to exercise client retries
+        self.fail_next = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        fake = self
+
+        class Handler(FakeStravaHandler):
+            strava = fake
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def count_request(self):
+        """Count a request against the quota. Returns (allowed, usage header)."""
+        with self._lock:
+            self.requests += 1
+            allowed = self.requests <= self.short_limit and self.requests <= self.daily_limit
+            if not allowed:
+                self.rejected += 1
+            return allowed, f"{self.requests},{self.requests}"
+
+    def activities(self, athlete_id):
+        for index in range(self.activities_per_athlete):
+            activity = make_activity(athlete_id, index)
+            if activity['id'] not in self.deleted:
+                yield activity
+
+
+class FakeStravaHandler(BaseHTTPRequestHandler):
+    strava = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, usage=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('X-RateLimit-Limit', f"{self.strava.short_limit},{self.strava.daily_limit}")
+        if usage:
+            self.send_header('X-RateLimit-Usage', usage)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _athlete_id(self):
+        token = self.headers.get('Authorization', '').removeprefix('Bearer ')
+        if not token.startswith('athlete-'):
+            return None
+        return int(token.split('-')[1])
+
+    def _begin(self):
+        if self.strava.latency:
+            time.sleep(self.strava.latency)
+        with self.strava._lock:
+            failing = self.strava.fail_next > 0
+            self.strava.fail_next -= int(failing)
+        if failing:
+            self._send(503, {'message': 'Service Unavailable'})
+            return None
+        allowed, usage = self.strava.count_request()
+        if not allowed:
+            self._send(429, {'message': 'Rate Limit Exceeded'}, usage)
+            return None
+        return usage
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        form = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+        usage = self._begin()
+        if usage is None:
+            return
+        if urlparse(self.path).path != '/oauth/token':
+            return self._send(404, {'message': 'Not Found'}, usage)
+
+        # Codes and refresh tokens both carry the athlete ID, e.g. "code-7" / "refresh-7"
+        grant = form.get('code') or form.get('refresh_token') or ''
+        athlete_id = int(grant.rsplit('-', 1)[-1])
+        self._send(200, {
+            'access_token': f"athlete-{athlete_id}",
+            'refresh_token': f"refresh-{athlete_id}",
+            'expires_at': int(time.time()) + 6 * 3600,
+            'athlete': {'id': athlete_id, 'firstname': 'Fake', 'lastname': f"Runner{athlete_id}"},
+        }, usage)
+
+    def do_GET(self):
+        usage = self._begin()
+        if usage is None:
+            return
+        athlete_id = self._athlete_id()
+        if athlete_id is None:
+            return self._send(401, {'message': 'Authorization Error'}, usage)
+
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if url.path == '/api/v3/athlete/activities':
+            after = int(query.get('after', 0))
+            per_page = int(query.get('per_page', 30))
+            page = int(query.get('page', 1))
+            newer = [
+                activity for activity in self.strava.activities(athlete_id)
+                if datetime.datetime.strptime(activity['start_date'], "%Y-%m-%dT%H:%M:%SZ")
+                .replace(tzinfo=datetime.timezone.utc).timestamp() > after
+            ]
+            start = (page - 1) * per_page
+            return self._send(200, newer[start:start + per_page], usage)
+
+        if url.path.startswith('/api/v3/activities/'):
+            activity_id = int(url.path.rsplit('/', 1)[-1])
+            for activity in self.strava.activities(athlete_id):
+                if activity['id'] == activity_id:
+                    return self._send(200, activity, usage)
+            if activity_id in self.strava.public:
+                owner, index = divmod(activity_id - 1, 1_000_000)
+                return self._send(200, make_activity(owner, index), usage)
+            return self._send(404, {'message': 'Record Not Found'}, usage)
+
+        self._send(404, {'message': 'Not Found'}, usage)
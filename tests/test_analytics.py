@@ -0,0 +1,112 @@
+import math
+
+import numpy as np
+
+import analytics
+import database
+
+
+def add_runs(user_id, runs):
+    database.create_activities_bulk(
+        {'user_id': user_id, 'activity_id': i + 1, 'date': date, 'distance': miles,
+         'moving_time': seconds, 'activity_type': kind}
+        for i, (date, miles, seconds, kind) in enumerate(runs)
+    )
+
+
+def test_load_history_keeps_runs_and_details():
+    """Test that one query loads runs (including untyped legacy rows) into arrays, oldest first."""
+    database.init_db()
+    user_id = database.create_user('runner', 'password')
+    add_runs(user_id, [
+        ('2025-03-02', 5.0, 2400, 'Run'),
+        ('2025-03-01', 20.0, 3600, 'Ride'),
+        ('2025-03-01', 3.0, None, None),
+    ])
+
+    history = analytics.load_history(user_id)
+    assert list(history.dates.astype(str)) == ['2025-03-01', '2025-03-02']
+    assert list(history.distance) == [3.0, 5.0]
+    assert math.isnan(history.moving_time[0])
+    assert len(analytics.load_history(user_id, runs_only=False)) == 3
+    assert len(analytics.load_history(database.create_user('nobody', 'password'))) == 0
+
+
+def test_training_load_rolling_windows_and_acwr():
+    """Test 7/28-day rolling load and ACWR against hand-computed values."""
+    database.init_db()
+    user_id = database.create_user('runner', 'password')
+    # 4 miles every day for four weeks, then a 10-mile day
+    runs = [(str(np.datetime64('2025-02-01') + day), 4.0, 2000, 'Run') for day in range(28)]
+    runs.append(('2025-03-01', 10.0, 5000, 'Run'))
+    add_runs(user_id, runs)
+
+    load = analytics.training_load(analytics.load_history(user_id), start='2025-02-28', end='2025-03-02')
+    assert list(load['days'].astype(str)) == ['2025-02-28', '2025-03-01', '2025-03-02']
+    assert list(load['daily']) == [4.0, 10.0, 0.0]
+    assert list(load['acute']) == [28.0, 34.0, 30.0]
+    assert list(load['chronic']) == [28.0, 29.5, 28.5]
+    assert np.allclose(load['acwr'], [1.0, 34 / 29.5, 30 / 28.5])
+
+    early = analytics.training_load(analytics.load_history(user_id), start='2025-01-01', end='2025-01-02')
+    assert np.isnan(early['acwr']).all()
+
+
+def test_pace_trend_weights_by_distance_and_finds_slope():
+    """Test that rolling pace is time over distance and the slope shows getting faster."""
+    database.init_db()
+    user_id = database.create_user('runner', 'password')
+    add_runs(user_id, [
+        ('2025-03-01', 2.0, 1200, 'Run'),   # 600 s/mile
+        ('2025-03-02', 6.0, 3000, 'Run'),   # 500 s/mile
+        ('2025-03-31', 4.0, 1800, 'Run'),   # 450 s/mile
+    ])
+
+    trend = analytics.pace_trend(analytics.load_history(user_id), window=7, end='2025-03-31')
+    assert trend['pace'][0] == 600.0
+    assert trend['pace'][1] == 4200 / 8
+    assert np.isnan(trend['pace'][15])
+    assert trend['pace'][-1] == 450.0
+    assert trend['slope_per_30_days'] < 0
+
+
+def test_packed_columns_are_rebuilt_after_ingest():
+    """Test that ActivityColumns is reused between loads and dropped when activities change."""
+    database.init_db()
+    user_id = database.create_user('runner', 'password')
+    add_runs(user_id, [('2025-03-01', 3.0, 1500, 'Run')])
+    assert len(analytics.load_history(user_id)) == 1
+
+    conn = database.get_connection()
+    assert conn.execute("SELECT row_count FROM ActivityColumns WHERE user_id = ?", (user_id,)).fetchone()[0] == 1
+    database.create_activity(user_id, '2025-03-02', 4.0, 50)
+    assert len(analytics.load_history(user_id)) == 2
+    database.delete_activity(user_id, 50)
+    assert list(analytics.load_history(user_id).distance) == [3.0]
+
+
+def test_weekly_trends_rolling_mileage_goals_and_streaks():
+    """Test weekly totals, long run progression, goal hit rate and streaks against hand-computed values."""
+    database.init_db()
+    user_id = database.create_user('runner', 'password')
+    add_runs(user_id, [
+        ('2025-02-01', 12.0, 6000, 'Run'),   # before the range: sets the longest run so far
+        ('2025-03-03', 10.0, 5000, 'Run'),   # week of 03-03: 20 miles
+        ('2025-03-04', 10.0, 5000, 'Run'),
+        ('2025-03-10', 25.0, 9000, 'Run'),   # week of 03-10: 25 miles
+        ('2025-03-17', 5.0, 2500, 'Run'),    # week of 03-17: 5 miles
+        ('2025-03-24', 8.0, 4000, 'Run'),    # week of 03-24: unfinished
+    ])
+
+    trends = analytics.weekly_trends(analytics.load_history(user_id), '2025-03-05', '2025-03-25',
+                                     mileage_goal=20, long_run_goal=12, today='2025-03-26')
+    assert (trends['since'], trends['until']) == ('2025-03-03', '2025-03-30')
+    weeks = trends['weeks']
+    assert [week['total'] for week in weeks] == [20.0, 25.0, 5.0, 8.0]
+    assert [week['rolling_average'] for week in weeks] == [5.0, 11.25, 12.5, 14.5]
+    assert [week['longest_run'] for week in weeks] == [10.0, 25.0, 5.0, 8.0]
+    assert [week['longest_to_date'] for week in weeks] == [12.0, 25.0, 25.0, 25.0]
+    # The unfinished week hasn't met the goal yet, so it isn't counted against it
+    assert trends['goal_hit_rate'] == {'mileage': round(2 / 3, 4), 'long_run': round(1 / 3, 4)}
+    assert trends['streaks']['mileage_goal_weeks'] == {'current': 0, 'longest': 2}
+    assert trends['streaks']['running_days'] == {'current': 0, 'longest': 2}
@@ -0,0 +1,301 @@
+import csv
+import gzip
+import io
+import json
+from unittest.mock import patch
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+import analytics
+import cache
+import database
+import metrics
+import passwords
+from app import app
+
+
+@pytest.fixture
+def client():
+    database.init_db()
+    app.config['TESTING'] = True
+    return app.test_client()
+
+
+def log_in(client, username='runner', mileage_goal=30, long_run_goal=10):
+    user_id = database.create_user(username, 'password')
+    database.create_athlete_with_goals(user_id, mileage_goal, long_run_goal)
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+    return user_id
+
+
+def test_warm_user_cache_makes_no_queries(client):
+    """Test that an authenticated page view on a warm cache never touches the database."""
+    log_in(client)
+    assert client.get('/').status_code == 200
+
+    with patch('database.get_connection') as mock_connection:
+        assert client.get('/').status_code == 200
+    mock_connection.assert_not_called()
+    assert cache.users.stats()['hits'] >= 1
+
+
+def test_user_cache_invalidated_on_goal_update(client):
+    """Test that a goal change is visible on the next request."""
+    user_id = log_in(client)
+    assert client.get('/api/activities').get_json()['mileage_goal'] == 30
+
+    database.set_mileage_goal(user_id, 45)
+    assert client.get('/api/activities').get_json()['mileage_goal'] == 45
+
+
+def test_activities_etag_returns_304_until_data_changes(client):
+    """Test that /api/activities answers 304 for an unchanged ETag and 200 once data changes."""
+    user_id = log_in(client)
+    database.create_activity(user_id, '2025-01-01', 5.0, 1)
+
+    first = client.get('/api/activities')
+    assert first.status_code == 200
+    assert first.get_json()['activities'] == [
+        {'activity_id': 1, 'date': '2025-01-01', 'distance': 5.0, 'activity_title': None}
+    ]
+    etag = first.headers['ETag']
+
+    with patch('database.get_activities_payload') as mock_payload:
+        repeat = client.get('/api/activities', headers={'If-None-Match': etag})
+    assert repeat.status_code == 304
+    assert repeat.data == b''
+    mock_payload.assert_not_called()
+
+    database.create_activity(user_id, '2025-01-02', 3.0, 2)
+    changed = client.get('/api/activities', headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert len(changed.get_json()['activities']) == 2
+
+    # An edit in place keeps the newest activity_id and the count the same
+    database.create_activities_bulk([{'user_id': user_id, 'activity_id': 2, 'date': '2025-01-03', 'distance': 4.0}])
+    edited = client.get('/api/activities', headers={'If-None-Match': changed.headers['ETag']})
+    assert edited.status_code == 200
+    assert edited.get_json()['activities'][0] == {
+        'activity_id': 2, 'date': '2025-01-03', 'distance': 4.0, 'activity_title': None
+    }
+
+    database.set_long_run_goal(user_id, 12)
+    assert client.get('/api/activities', headers={'If-None-Match': edited.headers['ETag']}).status_code == 200
+
+
+def test_activities_endpoint_pages_with_cursor(client):
+    """Test that /api/activities pages with limit/cursor, filters by date and rejects bad args."""
+    user_id = log_in(client)
+    for day in range(1, 6):
+        database.create_activity(user_id, f'2025-02-{day:02d}', 3.0, day)
+
+    first = client.get('/api/activities?limit=2&since=2025-02-02')
+    data = first.get_json()
+    assert [a['activity_id'] for a in data['activities']] == [5, 4]
+    second = client.get(f"/api/activities?limit=2&since=2025-02-02&cursor={data['next_cursor']}").get_json()
+    assert [a['activity_id'] for a in second['activities']] == [3, 2]
+    assert second['next_cursor'] is None
+    assert client.get('/api/activities?limit=2&since=2025-02-02&cursor=' + data['next_cursor']).headers['ETag'] != first.headers['ETag']
+
+    assert client.get('/api/activities?limit=0').status_code == 400
+    assert client.get('/api/activities?since=Feb').status_code == 400
+    assert client.get('/api/activities?cursor=bogus').status_code == 400
+
+
+def test_export_streams_ndjson_csv_and_gzip(client):
+    """Test that /api/activities/export streams every activity in each format."""
+    user_id = log_in(client)
+    database.create_activity(user_id, '2025-02-01', 3.0, 1)
+    database.create_activity(user_id, '2025-02-02', 5.5, 2)
+    with database.get_connection() as conn:
+        conn.execute("UPDATE DailyMileage SET activity_title = 'Easy, slow' WHERE activity_id = 1")
+
+    response = client.get('/api/activities/export')
+    assert response.is_streamed
+    assert response.headers['Content-Disposition'] == 'attachment; filename="activities.ndjson"'
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert lines == [
+        {'activity_id': 2, 'date': '2025-02-02', 'distance': 5.5, 'activity_title': None},
+        {'activity_id': 1, 'date': '2025-02-01', 'distance': 3.0, 'activity_title': 'Easy, slow'},
+    ]
+
+    text = client.get('/api/activities/export?format=csv&since=2025-02-02').get_data(as_text=True)
+    assert list(csv.reader(io.StringIO(text))) == [
+        ['activity_id', 'date', 'distance', 'activity_title'],
+        ['2', '2025-02-02', '5.5', ''],
+    ]
+    assert 'Easy, slow' in client.get('/api/activities/export?format=csv').get_data(as_text=True)
+
+    compressed = client.get('/api/activities/export?format=csv&gzip=1')
+    assert compressed.mimetype == 'application/gzip'
+    assert gzip.decompress(compressed.data).decode().count('\n') == 3
+
+    assert client.get('/api/activities/export?format=xml').status_code == 400
+
+
+def test_import_endpoint_accepts_activities_csv(client):
+    """Test that uploading activities.csv imports it and a bad upload gets a 400."""
+    user_id = log_in(client)
+    archive = (b"Activity ID,Activity Date,Distance,Distance\n"
+               b"7,\"Mar 3, 2025, 6:02:11 PM\",5.00,5000.0\n")
+
+    response = client.post('/api/activities/import', data={'archive': (io.BytesIO(archive), 'activities.csv')})
+    assert response.get_json()['rows_written'] == 1
+    assert database.get_activities_for_user(user_id)[0]['distance'] == 3.11
+
+    bad = client.post('/api/activities/import', data={'archive': (io.BytesIO(b"name,age\n"), 'people.csv')})
+    assert bad.status_code == 400
+    assert client.post('/api/activities/import').status_code == 400
+
+
+def test_strava_webhook_handshake_and_event_queue(client, monkeypatch):
+    """Test the subscription handshake and that events are queued without calling Strava."""
+    monkeypatch.setenv('STRAVA_WEBHOOK_VERIFY_TOKEN', 'secret-token')
+    ok = client.get('/strava/webhook?hub.mode=subscribe&hub.verify_token=secret-token&hub.challenge=abc')
+    assert ok.get_json() == {'hub.challenge': 'abc'}
+    assert client.get('/strava/webhook?hub.mode=subscribe&hub.verify_token=wrong&hub.challenge=abc').status_code == 403
+
+    event = {'object_type': 'activity', 'object_id': 42, 'aspect_type': 'create',
+             'owner_id': 7, 'event_time': 1700000000, 'subscription_id': 1, 'updates': {}}
+    # Refused until the app knows which subscription is its own
+    assert client.post('/strava/webhook', json=event).status_code == 403
+    monkeypatch.setenv('STRAVA_WEBHOOK_SUBSCRIPTION_ID', '1')
+    assert client.post('/strava/webhook', json=dict(event, subscription_id=2)).status_code == 403
+    with patch('collector.client') as mock_client:
+        assert client.post('/strava/webhook', json=event).status_code == 200
+    mock_client.request.assert_not_called()
+    queued = database.claim_webhook_event('worker', 60)
+    assert (queued['object_id'], queued['aspect_type'], queued['owner_id']) == (42, 'create', 7)
+
+    assert client.post('/strava/webhook', json={'object_type': 'activity', 'subscription_id': 1}).status_code == 400
+
+
+def test_login_fetches_user_once_and_upgrades_old_hash(client):
+    """Test that login makes one user lookup and transparently rehashes outdated hashes."""
+    user_id = database.create_user('runner', 'password')
+    old_hash = generate_password_hash('password', method='pbkdf2:sha256:1000')
+    database.update_password_hash(user_id, old_hash)
+
+    with patch('database.get_user_by_username', wraps=database.get_user_by_username) as lookup, \
+         patch('passwords.rehash_in_background', side_effect=lambda password, save: save(passwords.hash_password(password))):
+        response = client.post('/login', data={'username': 'runner', 'password': 'password'})
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/')
+    lookup.assert_called_once_with('runner')
+    new_hash = database.get_user_by_id(user_id)['password_hash']
+    assert new_hash.startswith(passwords.PASSWORD_METHOD + '$')
+
+    bad = client.post('/login', data={'username': 'runner', 'password': 'wrong'})
+    assert bad.headers['Location'].endswith('/login')
+    with patch('passwords.verify', side_effect=passwords.HashingBusy):
+        assert client.post('/login', data={'username': 'runner', 'password': 'password'}).status_code == 503
+
+
+def test_metrics_endpoint_reports_routes_queries_and_ingest(client):
+    """Test that /metrics exposes route and database timings and the ingest counter."""
+    user_id = log_in(client)
+    requests_before = metrics.http_request_seconds.count('/api/weeks', 'GET')
+    ingested_before = metrics.rows_ingested.value()
+    database.create_activity(user_id, '2025-03-03', 4.0, 1)
+    client.get('/api/weeks?start=2025-03-03')
+    assert metrics.http_request_seconds.count('/api/weeks', 'GET') == requests_before + 1
+    assert metrics.rows_ingested.value() == ingested_before + 1
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'http_request_duration_seconds_count{route="/api/weeks",method="GET"}' in text
+    assert 'db_call_duration_seconds_count{function="get_week_summary"}' in text
+    assert 'activity_rows_ingested_total ' in text
+    assert 'sync_queue_depth{queue="sync_jobs"} 0' in text
+
+
+def test_weeks_endpoint_groups_one_week(client):
+    """Test that /api/weeks totals each day's runs in the requested week and compares against goals."""
+    user_id = log_in(client, mileage_goal=20, long_run_goal=8)
+    database.create_activity(user_id, '2025-03-03', 4.0, 1)   # Monday
+    database.create_activity(user_id, '2025-03-03', 2.5, 2)   # Monday double
+    database.create_activity(user_id, '2025-03-08', 9.0, 3)   # Saturday
+    database.create_activity(user_id, '2025-03-10', 7.0, 4)   # next week
+    database.create_activities_bulk([                          # not a run
+        {'user_id': user_id, 'date': '2025-03-04', 'distance': 30.0, 'activity_id': 5, 'activity_type': 'Ride'}])
+
+    data = client.get('/api/weeks?start=2025-03-05').get_json()
+    assert data['week_start'] == '2025-03-03'
+    assert data['daily_mileage']['Monday'] == 6.5
+    assert data['daily_mileage']['Tuesday'] == 0
+    assert data['daily_mileage']['Saturday'] == 9.0
+    assert data['daily_mileage']['Sunday'] == 0
+    assert data['total'] == 15.5
+    assert data['remaining'] == 4.5
+    assert data['longest_run'] == 9.0
+    assert data['long_run_remaining'] == 0
+
+    assert client.get('/api/weeks?start=March').status_code == 400
+
+
+def test_trends_endpoint_memoizes_until_data_or_goals_change(client):
+    """Test that /api/trends is served from cache.trends and recomputed after an ingest or goal change."""
+    user_id = log_in(client, mileage_goal=10, long_run_goal=6)
+    database.create_activity(user_id, '2025-03-03', 8.0, 1)
+    url = '/api/trends?since=2025-03-03&until=2025-03-16'
+
+    with patch('analytics.weekly_trends', wraps=analytics.weekly_trends) as compute:
+        first = client.get(url)
+        assert first.status_code == 200
+        assert [week['total'] for week in first.get_json()['weeks']] == [8.0, 0.0]
+        assert client.get(url).get_data() == first.get_data()
+        assert compute.call_count == 1
+        assert client.get(url, headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+
+        database.create_activity(user_id, '2025-03-10', 12.0, 2)
+        data = client.get(url).get_json()
+        assert [week['total'] for week in data['weeks']] == [8.0, 12.0]
+        assert [week['longest_to_date'] for week in data['weeks']] == [8.0, 12.0]
+        assert compute.call_count == 2
+
+        database.set_mileage_goal(user_id, 5)
+        data = client.get(url).get_json()
+        assert data['mileage_goal'] == 5
+        assert data['goal_hit_rate']['mileage'] == 1.0
+        assert compute.call_count == 3
+    assert cache.trends.stats()['hits'] >= 1
+
+
+def test_trends_notices_writes_from_other_processes(client):
+    """Test that a cached trends response is rebuilt when activity_version moves without a local invalidation."""
+    user_id = log_in(client)
+    url = '/api/trends?since=2025-03-03&until=2025-03-09'
+    assert client.get(url).get_json()['weeks'][0]['total'] == 0.0
+
+    with patch('cache.trends.invalidate_group'):
+        database.create_activity(user_id, '2025-03-04', 6.0, 1)
+    assert client.get(url).get_json()['weeks'][0]['total'] == 6.0
+
+
+def test_trends_endpoint_rejects_bad_ranges(client):
+    """Test that /api/trends answers 400 for unparseable, reversed or oversized ranges."""
+    log_in(client)
+    assert client.get('/api/trends?since=March').status_code == 400
+    assert client.get('/api/trends?since=2025-03-10&until=2025-03-01').status_code == 400
+    assert client.get('/api/trends?since=1900-01-01&until=2025-03-01').status_code == 400
+    assert len(client.get('/api/trends').get_json()['weeks']) == 26
+
+
+def test_leaderboard_endpoint_returns_top_and_my_rank(client):
+    """Test that /api/leaderboard ranks every user for the requested period and includes the caller's place."""
+    user_id = log_in(client)
+    rivals = [database.create_user(f'rival{i}', 'password') for i in range(3)]
+    for i, rival in enumerate(rivals):
+        database.create_activity(rival, '2025-03-04', 10.0 + i, 100 + i)
+    database.create_activity(user_id, '2025-03-05', 10.5, 1)
+
+    data = client.get('/api/leaderboard?period=week&metric=distance&date=2025-03-07&limit=2').get_json()
+    assert (data['period_start'], data['period_end']) == ('2025-03-03', '2025-03-09')
+    assert [leader['username'] for leader in data['leaders']] == ['rival2', 'rival1']
+    assert data['me'] == {'rank': 3, 'value': 10.5, 'ranked': 4}
+
+    month = client.get('/api/leaderboard?period=month&date=2025-03-31').get_json()
+    assert (month['period_start'], month['period_end']) == ('2025-03-01', '2025-03-31')
+    assert client.get('/api/leaderboard?period=year').status_code == 400
+    assert client.get('/api/leaderboard?limit=0').status_code == 400
@@ -0,0 +1,87 @@
+import asyncio
+
+import httpx
+from flask_login.utils import encode_cookie
+
+import collector
+import database
+from app import app
+from asgi import AsyncApp
+from fake_strava import FakeStrava
+
+
+def session_cookie(user_id, **extra):
+    serializer = app.session_interface.get_signing_serializer(app)
+    return serializer.dumps({'_user_id': str(user_id), **extra})
+
+
+def run_requests(asgi_app, *requests):
+    async def go():
+        asgi_app.http = httpx.AsyncClient()
+        transport = httpx.ASGITransport(app=asgi_app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://testserver') as client:
+            responses = []
+            for url, headers in requests:
+                client.cookies.clear()
+                responses.append(await client.get(url, headers=headers))
+        await asgi_app.http.aclose()
+        return responses
+    return asyncio.run(go())
+
+
+def test_async_strava_callback_saves_tokens_and_queues_sync(monkeypatch):
+    """Test that the native async callback exchanges the code, saves tokens and flashes via the session."""
+    database.init_db()
+    user_id = database.create_user('runner', 'password')
+    asgi_app = AsyncApp(app)
+
+    with FakeStrava() as strava:
+        monkeypatch.setattr(collector, 'client', collector.StravaClient(base_url=strava.url))
+        callback, anonymous, page = run_requests(
+            asgi_app,
+            ('/strava/callback?code=code-7', {'Cookie': f'session={session_cookie(user_id)}'}),
+            ('/strava/callback?code=code-7', {}),
+            ('/login', {}),
+        )
+    asgi_app.executor.shutdown()
+
+    assert callback.status_code == 302
+    assert callback.headers['location'] == '/'
+    serializer = app.session_interface.get_signing_serializer(app)
+    assert serializer.loads(callback.cookies['session'])['_flashes'] == [
+        ('message', "Connected! Syncing your runs now...")
+    ]
+    assert database.get_user_tokens(user_id)['strava_access_token'] == 'athlete-7'
+    assert database.get_user_id_for_athlete(7) == user_id
+    assert database.claim_sync_job('worker', 600) == user_id
+
+    assert anonymous.headers['location'] == '/login'
+    assert strava.requests == 1
+    assert page.status_code == 200
+
+
+def test_async_strava_callback_keeps_flask_login_behaviour(monkeypatch):
+    """Test that remember-me logins are honoured and a permanent session stays permanent."""
+    database.init_db()
+    user_id = database.create_user('runner', 'password')
+    asgi_app = AsyncApp(app)
+    with app.app_context():
+        remember = encode_cookie(str(user_id))
+
+    with FakeStrava() as strava:
+        monkeypatch.setattr(collector, 'client', collector.StravaClient(base_url=strava.url))
+        remembered, permanent = run_requests(
+            asgi_app,
+            ('/strava/callback?code=code-7', {'Cookie': f'remember_token={remember}'}),
+            ('/strava/callback?error=access_denied',
+             {'Cookie': f'session={session_cookie(user_id, _permanent=True)}'}),
+        )
+    asgi_app.executor.shutdown()
+
+    assert remembered.headers['location'] == '/'
+    serializer = app.session_interface.get_signing_serializer(app)
+    assert serializer.loads(remembered.cookies['session'])['_user_id'] == str(user_id)
+    assert database.get_user_id_for_athlete(7) == user_id
+
+    assert 'Expires=' in permanent.headers['set-cookie']
+    assert serializer.loads(permanent.cookies['session'])['_flashes'] == [('message', "Connection cancelled")]
@@ -0,0 +1,40 @@
+import cache
+
+
+def test_lru_cache_evicts_least_recently_used_within_budget():
+    """Test that the LRU cache stays under its byte budget, evicting the least recently used entry first."""
+    lru = cache.LRUCache(max_bytes=100)
+    lru.put((1, 'a'), 'first', 40)
+    lru.put((2, 'a'), 'second', 40)
+    assert lru.get((1, 'a')) == 'first'   # now (2, 'a') is the oldest
+
+    lru.put((3, 'a'), 'third', 40)
+    assert lru.get((2, 'a')) is None
+    assert lru.get((1, 'a')) == 'first'
+    assert lru.stats()['size_bytes'] == 80
+    assert lru.stats()['evictions'] == 1
+
+    lru.put((4, 'a'), 'too big', 101)
+    assert lru.get((4, 'a')) is None
+
+
+def test_lru_cache_invalidates_a_whole_group():
+    """Test that invalidate_group drops every entry for one user and leaves the rest."""
+    lru = cache.LRUCache(max_bytes=1000)
+    lru.put((1, '2025-01-01'), 'a', 10)
+    lru.put((1, '2025-02-01'), 'b', 10)
+    lru.put((2, '2025-01-01'), 'c', 10)
+
+    lru.invalidate_group(1)
+    assert lru.get((1, '2025-01-01')) is None
+    assert lru.get((1, '2025-02-01')) is None
+    assert lru.get((2, '2025-01-01')) == 'c'
+    assert lru.stats()['size_bytes'] == 10
+
+
+def test_token_cache_locks_are_a_fixed_set():
+    """Test that a user always gets the same refresh lock and the lock count doesn't grow with users."""
+    tokens = cache.TokenCache()
+    assert tokens.lock_for(7) is tokens.lock_for(7)
+    locks = {id(tokens.lock_for(user_id)) for user_id in range(10000)}
+    assert len(locks) == cache.TOKEN_LOCK_STRIPES
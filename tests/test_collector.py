@@ -120,4 +120,168 @@ from unittest.mock import patch, MagicMock
     
 #     # Verify
 #     assert result == 'new_access_token_123'
-#     mock_post.assert_called_once()
\ No newline at end of file
+#     mock_post.assert_called_once()
+
+@pytest.fixture
+def strava_user():
+    import database
+    database.init_db()
+    return database.create_user('runner', 'password')
+
+
+def fake_response(json_body):
+    response = MagicMock()
+    response.status_code = 200
+    response.headers = {}
+    response.json.return_value = json_body
+    return response
+
+
+def fake_activity(activity_id, day, meters=5000):
+    return {
+        'id': activity_id,
+        'distance': meters,
+        'start_date': f'2025-01-{day:02d}T12:00:00Z',
+        'start_date_local': f'2025-01-{day:02d}T07:00:00Z',
+    }
+
+
+@patch('collector.client.session.request')
+@patch('collector.get_valid_access_token', return_value='token')
+def test_fetch_and_save_user_data_bulk_inserts(mock_token, mock_get, strava_user):
+    """Test that fetched activities are converted to miles and saved in one batch."""
+    import database
+    mock_get.return_value = fake_response([fake_activity(1, 5), fake_activity(2, 6, meters=10000)])
+
+    with patch('database.create_activity') as mock_create:
+        collector.fetch_and_save_user_data(strava_user)
+        mock_create.assert_not_called()
+
+    rows = database.get_activities_for_user(strava_user)
+    assert [(r['activity_id'], r['date'], r['distance']) for r in rows] == [
+        (2, '2025-01-06', 6.21),
+        (1, '2025-01-05', 3.11),
+    ]
+
+
+@patch('collector.get_valid_access_token', return_value='token')
+def test_backfill_resumes_from_cursor(mock_token, strava_user):
+    """Test that an interrupted backfill restarts after the last saved page."""
+    import database
+    history = [fake_activity(i, i) for i in range(1, 6)]
+    requested_after = []
+
+    def fake_get(method, url, headers=None, params=None, timeout=None):
+        assert url.endswith('/api/v3/athlete/activities')
+        requested_after.append(params['after'])
+        newer = [a for a in history if collector.activity_start_time(a) > params['after']]
+        start = (params['page'] - 1) * params['per_page']
+        if len(requested_after) == 3:
+            raise ConnectionError("network dropped")
+        return fake_response(newer[start:start + params['per_page']])
+
+    with patch('collector.client.session.request', side_effect=fake_get), patch('collector.PAGE_SIZE', 2):
+        with pytest.raises(ConnectionError):
+            collector.backfill_user_data(strava_user)
+        assert len(database.get_activities_for_user(strava_user)) == 4
+        cursor = database.get_backfill_cursor(strava_user)
+        assert cursor == collector.activity_start_time(history[3])
+
+        assert collector.backfill_user_data(strava_user) == 1
+
+    assert requested_after[3] == cursor - 1
+    assert len(database.get_activities_for_user(strava_user)) == 5
+
+
+@patch('collector.get_valid_access_token', return_value='token')
+def test_incremental_sync_uses_high_water_mark(mock_token, strava_user):
+    """Test that a sync only asks for activities after the high-water mark and saves edits."""
+    import database
+    mock_response = fake_response([fake_activity(1, 5), fake_activity(2, 6)])
+    with patch('collector.client.session.request', return_value=mock_response):
+        first = collector.fetch_and_save_user_data(strava_user)
+    assert first == {'api_calls': 1, 'rows_fetched': 2, 'rows_written': 2}
+    high_water_mark = database.get_last_activity_time(strava_user)
+    assert high_water_mark == collector.activity_start_time(fake_activity(2, 6))
+
+    # Activity 2 was edited on Strava; activity 1 is unchanged
+    mock_response.json.return_value = [fake_activity(2, 6, meters=8000)]
+    with patch('collector.client.session.request', return_value=mock_response) as mock_get:
+        second = collector.fetch_and_save_user_data(strava_user)
+    assert mock_get.call_args.kwargs['params']['after'] == high_water_mark - collector.SYNC_OVERLAP_SECONDS
+    assert second == {'api_calls': 1, 'rows_fetched': 1, 'rows_written': 1}
+    distances = {r['activity_id']: r['distance'] for r in database.get_activities_for_user(strava_user)}
+    assert distances == {1: 3.11, 2: 4.97}
+
+
+def test_strava_client_retries_and_records_latency(monkeypatch):
+    """Test that the client retries GETs that hit a 5xx, but not POSTs or 429s, and times each endpoint."""
+    from fake_strava import FakeStrava
+    monkeypatch.setattr(collector.StravaClient, 'BACKOFF_FACTOR', 0)
+
+    with FakeStrava(activities_per_athlete=3) as strava:
+        client = collector.StravaClient(base_url=strava.url)
+        strava.fail_next = 2
+        response = client.list_activities('athlete-1', {'after': 0, 'per_page': 10, 'page': 1})
+        assert response.status_code == 200
+        assert len(response.json()) == 3
+        assert client.post_token({'grant_type': 'refresh_token', 'refresh_token': 'refresh-1'}).status_code == 200
+
+        # POSTs and 429s are handed back rather than resent
+        unretried = collector.StravaClient(base_url=strava.url)
+        strava.fail_next = 1
+        assert unretried.post_token({'grant_type': 'refresh_token', 'refresh_token': 'refresh-1'}).status_code == 503
+        requests_before = strava.requests
+        strava.short_limit = 0
+        assert unretried.list_activities('athlete-1', {'after': 0, 'per_page': 10, 'page': 1}).status_code == 429
+        assert strava.requests == requests_before + 1
+
+    stats = client.latency_stats()
+    assert stats['athlete_activities']['count'] == 1
+    assert stats['athlete_activities']['errors'] == 0
+    assert stats['oauth_token']['count'] == 1
+    assert stats['athlete_activities']['avg_seconds'] > 0
+
+
+def test_get_valid_access_token_refreshes_once_for_concurrent_callers(strava_user):
+    """Test that concurrent callers share one refresh and later calls are served from cache."""
+    import threading
+    import time
+    import database
+
+    database.save_user_tokens_and_info(strava_user, 'old-access', 'refresh-1', int(time.time()) - 10, 1)
+
+    def slow_refresh(payload):
+        time.sleep(0.2)
+        return fake_response({
+            'access_token': 'new-access', 'refresh_token': 'refresh-2', 'expires_at': int(time.time()) + 3600
+        })
+
+    results = []
+    with patch.object(collector.client, 'post_token', side_effect=slow_refresh) as mock_post, \
+         patch('database.get_user_tokens', wraps=database.get_user_tokens) as mock_read:
+        threads = [
+            threading.Thread(target=lambda: results.append(collector.get_valid_access_token(strava_user)))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert collector.get_valid_access_token(strava_user) == 'new-access'
+
+    assert results == ['new-access'] * 8
+    assert mock_post.call_count == 1
+    assert mock_read.call_count == 1
+    assert database.get_user_tokens(strava_user)['strava_refresh_token'] == 'refresh-2'
+
+
+def test_token_cache_invalidated_when_tokens_saved(strava_user):
+    """Test that writing new tokens drops the cached access token."""
+    import time
+    import database
+
+    database.save_user_tokens_and_info(strava_user, 'first', 'refresh', int(time.time()) + 3600, 1)
+    assert collector.get_valid_access_token(strava_user) == 'first'
+    database.update_user_tokens(strava_user, 'second', 'refresh', int(time.time()) + 3600)
+    assert collector.get_valid_access_token(strava_user) == 'second'
@@ -3,6 +3,7 @@ import os
 # Add parent directory to path so we can import collector
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+import analytics
 import database
 import pytest
 import datetime
@@ -15,6 +16,7 @@ from unittest.mock import patch, MagicMock
 #command to test- pytest tests/test_collector.py::test_init_db or pytest tests/ -v
 
 
+@pytest.mark.sqlite_only
 def test_init_db():
     """Test that init_db creates the database tables."""
     database.init_db()
@@ -41,6 +43,7 @@ def test_create_user():
     assert user_row is not None, "User should be created in database"
     assert database.get_user_by_username('testuser') is not None
 
+@pytest.mark.sqlite_only
 def test_create_duplicate_user():
     """Test that create_user creates a new user and prevents duplicates."""
     # Initialize database to ensure clean state
@@ -66,17 +69,20 @@ def test_create_duplicate_user():
         count = cursor.fetchone()[0]
         assert count == 1, "Should only have one user with this username"
         
-def test_check_if_user_exists():
-    """Test that check_if_user_exists returns True if user exists, False if not."""
-    assert database.check_if_user_exists('testuser') is True
-    assert database.check_if_user_exists('nonexistentuser') is False
+def test_get_user_by_username():
+    """Test that get_user_by_username finds an existing user and returns None for an unknown one."""
+    database.init_db()
+    user_id = database.create_user('testuser', 'testpassword')
+    assert database.get_user_by_username('testuser')['id'] == user_id
+    assert database.get_user_by_username('nonexistentuser') is None
 
-def test_user_login():
-    """Test that user_login returns True if user exists and password is correct, False if not."""
+def test_validate_password():
+    """Test that validate_password returns True for the right password and False otherwise."""
     database.init_db()
     database.create_user('testuser', 'testpassword')
-    assert database.user_login('testuser', 'testpassword') is True
-    assert database.user_login('testuser', 'wrongpassword') is False
+    assert database.validate_password('testuser', 'testpassword') is True
+    assert database.validate_password('testuser', 'wrongpassword') is False
+    assert database.validate_password('nonexistentuser', 'testpassword') is False
 
 def test_session_username_set():
     """Test that the session username is set correctly."""
@@ -84,36 +90,61 @@ def test_session_username_set():
     #might be a test for the app.py file
     pass
 
-def test_get_refresh_token_by_username():
-    """Test that the get_refresh_token_by_username function returns the correct refresh token."""
+def test_get_user_tokens():
+    """Test that saved Strava tokens come back decrypted, and are stored encrypted."""
     database.init_db()
-    database.create_user('testuser', 'testpassword')
-    assert database.get_refresh_token_by_username('testuser') == 'testrefresh'
+    user_id = database.create_user('testuser', 'testpassword')
+    assert database.user_has_strava(user_id) is False
+    database.update_user_tokens(user_id, 'testaccess', 'testrefresh', 1700000000)
+    tokens = database.get_user_tokens(user_id)
+    assert tokens['strava_refresh_token'] == 'testrefresh'
+    assert tokens['strava_access_token'] == 'testaccess'
+    assert tokens['token_expiration'] == 1700000000
+    assert database.get_user_by_id(user_id) is not None
+    stored = database.get_connection().execute(
+        "SELECT strava_refresh_token FROM Users WHERE id = ?", (user_id,)).fetchone()[0]
+    assert stored != 'testrefresh'
+    assert database.user_has_strava(user_id) is True
 
-def test_get_client_id_from_username():
-    """Test that the get_client_id_from_username function returns the correct client id."""
+def test_get_user_id_for_athlete():
+    """Test that a Strava athlete ID maps back to the user who connected it."""
     database.init_db()
-    database.create_user('testuser', 'testpassword')
-    assert database.get_client_id_from_username('testuser') == 1234567890
+    user_id = database.create_user('testuser', 'testpassword')
+    database.save_user_tokens_and_info(user_id, 'testaccess', 'testrefresh', 1700000000, 1234567890)
+    assert database.get_user_id_for_athlete(1234567890) == user_id
+    assert database.get_user_id_for_athlete(42) is None
 
-def test_get_most_recent_activity_date_by_username():
-    """Test that the get_most_recent_activity_date_by_username function returns the correct most recent activity date."""
+def test_most_recent_activity_comes_first():
+    """Test that a user's activities are listed newest first."""
     database.init_db()
-    database.create_user('testuser', 'testpassword')
-    database.create_activity(database.get_user_id_from_username('testuser'), '2025-01-01', 10.0, 'testactivity')
-    assert database.get_most_recent_activity_date_by_username('testuser') == '2025-01-01'
+    user_id = database.create_user('testuser', 'testpassword')
+    database.create_activity(user_id, '2024-12-31', 5.0, 1)
+    database.create_activity(user_id, '2025-01-01', 10.0, 2)
+    assert database.get_activities_for_user(user_id)[0]['date'] == '2025-01-01'
 
-def test_get_user_id_from_username():
-    """Test that the get_user_id_from_username function returns the correct user id."""
+def test_create_user_returns_id():
+    """Test that create_user returns the new user's ID."""
     database.init_db()
-    database.create_user('testuser', 'testpassword')
-    assert database.get_user_id_from_username('testuser') == 1
+    first = database.create_user('testuser', 'testpassword')
+    second = database.create_user('otheruser', 'testpassword')
+    assert database.get_user_by_username('testuser')['id'] == first
+    assert second != first
+
+def test_last_activity_time_only_moves_forward():
+    """Test that the sync high-water mark ignores older start times."""
+    database.init_db()
+    user_id = database.create_user('testuser', 'testpassword')
+    database.update_last_activity_time(user_id, 200)
+    database.update_last_activity_time(user_id, 100)
+    assert database.get_last_activity_time(user_id) == 200
+    database.update_last_activity_time(user_id, 300)
+    assert database.get_last_activity_time(user_id) == 300
 
 def test_create_activity():
     """Test that the create_activity function creates a new activity in the database."""
     database.init_db()
-    database.create_user('testuser', 'testpassword')
-    database.create_activity(database.get_user_id_from_username('testuser'), '2025-01-01', 10.0, 'testactivity')
+    user_id = database.create_user('testuser', 'testpassword')
+    database.create_activity(user_id, '2025-01-01', 10.0, 1)
     conn = database.get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM DailyMileage")
@@ -123,69 +154,313 @@ def test_create_activity():
 def test_get_row_from_atheletes_table():
     """Test that the get_row_from_athletes_table function returns the correct row from the athletes table."""
     database.init_db()
-    database.create_user('testuser', 'testpassword')
-    database.create_athlete_at_registration('testuser')
-    assert database.get_row_from_athletes_table('testuser') is not None
+    user_id = database.create_user('testuser', 'testpassword')
+    assert database.get_row_from_athletes_table(user_id) is None
+    database.create_athlete_with_goals(user_id, 30, 10)
+    assert database.get_row_from_athletes_table(user_id)['user_id'] == user_id
 
-def test_create_athlete_at_registration():
-    """Test that the create_athlete_at_registration function creates a new athlete in the database."""
+def test_create_athlete_with_goals():
+    """Test that create_athlete_with_goals stores the athlete's goals."""
     database.init_db()
-    database.create_user('testuser', 'testpassword')
-    database.create_athlete_at_registration('testuser')
-    conn = database.get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM Athletes")
-    athlete_row = cursor.fetchone()
-    assert athlete_row is not None, "Athlete should be created in database"
+    user_id = database.create_user('testuser', 'testpassword')
+    database.create_athlete_with_goals(user_id, 30, 10)
+    athlete_row = database.get_row_from_athletes_table(user_id)
+    assert (athlete_row['mileage_goal'], athlete_row['long_run_goal']) == (30, 10)
 
-def test_update_athlete_with_dummy_collector_info():
-    """Test that the update_athlete_with_collector_info function updates the athlete in the database."""
+def test_save_user_tokens_and_info_creates_athlete():
+    """Test that connecting Strava records the athlete ID and makes sure an Athletes row exists."""
     database.init_db()
-    database.create_user('testuser', 'testpassword')
-    database.create_athlete_at_registration('testuser')
+    user_id = database.create_user('testuser', 'testpassword')
     #will later be called when collector info is grabbed
-    database.update_athlete_with_collector_info('testuser', 'John', 'Doe', 'M')
-    assert database.get_row_from_athletes_table('testuser') is not None
-    assert database.get_row_from_athletes_table('testuser')['first_name'] == 'John'
-    assert database.get_row_from_athletes_table('testuser')['last_name'] == 'Doe'
-    assert database.get_row_from_athletes_table('testuser')['gender'] == 'M'
+    database.save_user_tokens_and_info(user_id, 'testaccess', 'testrefresh', 1700000000, 1234)
+    assert database.get_user_by_id(user_id)['strava_athlete_id'] == 1234
+    assert database.get_row_from_athletes_table(user_id)['mileage_goal'] == 0
+
+    # Goals set at registration are kept
+    other = database.create_user('otheruser', 'testpassword')
+    database.create_athlete_with_goals(other, 30, 10)
+    database.save_user_tokens_and_info(other, 'testaccess', 'testrefresh', 1700000000, 5678)
+    assert database.get_row_from_athletes_table(other)['mileage_goal'] == 30
 
 def test_set_long_run_goal():
     """Test that the set_long_run_goal function sets the long run goal in the database."""
     database.init_db()
-    database.create_user('testuser', 'testpassword')
-    database.create_athlete_at_registration('testuser')
-    database.set_long_run_goal('testuser', 100)
-    assert database.get_row_from_athletes_table('testuser') is not None
-    assert database.get_row_from_athletes_table('testuser')['long_run_goal'] == 100
+    user_id = database.create_user('testuser', 'testpassword')
+    database.create_athlete_with_goals(user_id, 30, 10)
+    database.set_long_run_goal(user_id, 100)
+    assert database.get_row_from_athletes_table(user_id) is not None
+    assert database.get_row_from_athletes_table(user_id)['long_run_goal'] == 100
 
 def test_set_mileage_goal():
     """Test that the set_mileage_goal function sets the mileage goal in the database."""
     database.init_db()
-    database.create_user('testuser', 'testpassword')
-    database.create_athlete_at_registration('testuser')
-    database.set_mileage_goal('testuser', 1000)
-    assert database.get_row_from_athletes_table('testuser') is not None
-    assert database.get_row_from_athletes_table('testuser')['mileage_goal'] == 1000
+    user_id = database.create_user('testuser', 'testpassword')
+    database.create_athlete_with_goals(user_id, 30, 10)
+    database.set_mileage_goal(user_id, 1000)
+    assert database.get_row_from_athletes_table(user_id) is not None
+    assert database.get_row_from_athletes_table(user_id)['mileage_goal'] == 1000
 
 def test_get_activity_distance_by_activity_id():
-    """Test that the get_activity_distance function returns the correct activity distance."""
+    """Test that an activity's distance can be read back by its activity_id."""
     database.init_db()
-    database.create_user('testuser', 'testpassword')
-    database.create_activity(database.get_user_id_from_username('testuser'), '2025-01-01', 10.0, 'testactivity')
-    assert database.get_activity_distance_by_activity_id(1) == 10.0
+    user_id = database.create_user('testuser', 'testpassword')
+    database.create_activity(user_id, '2025-01-01', 10.0, 1)
+    database.create_activity(user_id, '2025-01-02', 4.0, 2)
+    distances = {a['activity_id']: a['distance'] for a in database.get_activities_for_user(user_id)}
+    assert distances[1] == 10.0
 
 def test_get_activity_distance_by_date():
-    """Test that the get_activity_distance_by_date function returns the correct activity distance."""
+    """Test that filtering a user's activities to one date returns that day's distance."""
     database.init_db()
-    database.create_user('testuser', 'testpassword')
-    database.create_activity(database.get_user_id_from_username('testuser'), '2025-01-01', 10.0, 'testactivity')
-    assert database.get_activity_distance_by_date('2025-01-01') == 10.0
+    user_id = database.create_user('testuser', 'testpassword')
+    database.create_activity(user_id, '2025-01-01', 10.0, 1)
+    database.create_activity(user_id, '2025-01-02', 4.0, 2)
+    day = database.get_activities_for_user(user_id, since='2025-01-01', until='2025-01-01')
+    assert [a['distance'] for a in day] == [10.0]
 
 def test_activity_exists():
-    """Test that the activity_exists function returns True if the activity exists, False if not."""
+    """Test that creating an activity that already exists leaves the stored one alone."""
     database.init_db()
-    database.create_user('testuser', 'testpassword')
-    database.create_activity(database.get_user_id_from_username('testuser'), '2025-01-01', 10.0, 'testactivity')
-    assert database.activity_exists(database.get_user_id_from_username('testuser'), '2025-01-01', 10.0, 'testactivity') is True
-    assert database.activity_exists(database.get_user_id_from_username('testuser'), '2025-01-01', 10.0, 'testactivity2') is False
\ No newline at end of file
+    user_id = database.create_user('testuser', 'testpassword')
+    database.create_activity(user_id, '2025-01-01', 10.0, 1)
+    database.create_activity(user_id, '2025-01-01', 12.0, 1)
+    assert [a['distance'] for a in database.get_activities_for_user(user_id)] == [10.0]
+
+@pytest.mark.sqlite_only
+def test_get_connection_is_pooled_per_thread():
+    """Test that get_connection reuses one tuned connection per thread."""
+    import threading
+    database.init_db()
+    conn = database.get_connection()
+    assert database.get_connection() is conn
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1
+
+    other = []
+    thread = threading.Thread(target=lambda: other.append(database.get_connection()))
+    thread.start()
+    thread.join()
+    assert other[0] is not conn
+
+def test_get_connection_replaces_dead_connection():
+    """Test that a closed pooled connection is replaced on checkout."""
+    database.init_db()
+    conn = database.get_connection()
+    conn.close()
+    with patch.object(database, 'HEALTH_CHECK_INTERVAL', -1):
+        fresh = database.get_connection()
+    assert fresh is not conn
+    fresh.execute("SELECT 1")
+
+def test_create_activities_bulk():
+    """Test that create_activities_bulk inserts in chunks and skips duplicates."""
+    database.init_db()
+    user_id = database.create_user('testuser', 'testpassword')
+    activities = [
+        {'user_id': user_id, 'date': f'2025-01-{i % 28 + 1:02d}', 'distance': 3.1, 'activity_id': i}
+        for i in range(1, 26)
+    ]
+    assert database.create_activities_bulk(iter(activities), chunk_size=10) == 25
+    assert database.create_activities_bulk(activities[:5]) == 0
+    assert len(database.get_activities_for_user(user_id)) == 25
+
+def test_activity_pages_walk_history_with_cursor():
+    """Test that keyset pages cover every activity once, newest first, within the date range."""
+    database.init_db()
+    user_id = database.create_user('testuser', 'testpassword')
+    # Two runs a day so pages have to break ties on activity_id
+    database.create_activities_bulk(
+        {'user_id': user_id, 'date': f'2025-01-{i // 2 + 1:02d}', 'distance': 3.0, 'activity_id': i}
+        for i in range(20)
+    )
+
+    seen = []
+    cursor = None
+    while True:
+        page, cursor = database.get_activities_page(user_id, since='2025-01-02', until='2025-01-09',
+                                                    limit=3, cursor=cursor)
+        seen.extend(page)
+        if cursor is None:
+            break
+    assert [a['activity_id'] for a in seen] == list(range(17, 1, -1))
+    assert len(database.get_activities_for_user(user_id, limit=5)) == 5
+
+    with pytest.raises(ValueError):
+        database.get_activities_page(user_id, cursor='not-a-cursor')
+
+def test_sync_jobs_are_deduplicated_and_claimed_once():
+    """Test that a user has at most one queued sync and only one worker can claim it."""
+    database.init_db()
+    user_id = database.create_user('testuser', 'testpassword')
+    assert database.enqueue_sync_job(user_id) is True
+    assert database.enqueue_sync_job(user_id) is False
+
+    assert database.claim_sync_job('worker-a', lease_seconds=600) == user_id
+    assert database.claim_sync_job('worker-b', lease_seconds=600) is None
+    # An expired lease can be taken over
+    assert database.claim_sync_job('worker-b', lease_seconds=-1) == user_id
+
+    database.finish_sync_job(user_id, 'worker-a')
+    assert database.enqueue_sync_job(user_id) is False
+    database.finish_sync_job(user_id, 'worker-b')
+    assert database.enqueue_sync_job(user_id) is True
+
+def test_week_summary_follows_ingest_and_edits():
+    """Test that week summaries reflect inserts and edits that move a run to another week."""
+    database.init_db()
+    user_id = database.create_user('testuser', 'testpassword')
+    rows = [
+        {'user_id': user_id, 'date': '2025-03-03', 'distance': 4.0, 'activity_id': 1},
+        {'user_id': user_id, 'date': '2025-03-09', 'distance': 10.0, 'activity_id': 2},
+        {'user_id': user_id, 'date': '2025-03-10', 'distance': 5.0, 'activity_id': 3},
+    ]
+    assert database.create_activities_bulk(rows) == 3
+    database.create_activity(user_id, '2025-03-05', 6.0, 4)
+    weeks = [database.get_week_summary(user_id, datetime.date(2025, 3, day)) for day in (3, 10)]
+    assert [(w['total'], w['longest_run']) for w in weeks] == [(20.0, 10.0), (5.0, 5.0)]
+
+    # Moving the long run into the next week updates both weeks
+    database.create_activities_bulk([{'user_id': user_id, 'date': '2025-03-11', 'distance': 10.0, 'activity_id': 2}])
+    weeks = [database.get_week_summary(user_id, datetime.date(2025, 3, day)) for day in (3, 10)]
+    assert [(w['total'], w['longest_run']) for w in weeks] == [(10.0, 6.0), (15.0, 10.0)]
+
+def test_leaderboards_follow_ingest_and_rank_with_ties():
+    """Test that week and month boards update on ingest, edits and deletes, and ranks match a brute-force count."""
+    database.init_db()
+    users = [database.create_user(f'runner{i}', 'testpassword') for i in range(4)]
+    database.create_activities_bulk([
+        {'user_id': users[0], 'date': '2025-03-03', 'distance': 5.0, 'activity_id': 1},
+        {'user_id': users[0], 'date': '2025-03-04', 'distance': 7.0, 'activity_id': 2},
+        {'user_id': users[1], 'date': '2025-03-05', 'distance': 12.0, 'activity_id': 3},
+        {'user_id': users[2], 'date': '2025-03-06', 'distance': 3.0, 'activity_id': 4},
+        {'user_id': users[2], 'date': '2025-03-07', 'distance': 30.0, 'activity_id': 5, 'activity_type': 'Ride'},
+        {'user_id': users[3], 'date': '2025-02-28', 'distance': 20.0, 'activity_id': 6},
+    ])
+
+    leaders = database.get_leaderboard('week', '2025-03-03', 'distance')
+    assert [(l['rank'], l['user_id'], l['value']) for l in leaders] == [
+        (1, users[0], 12.0), (1, users[1], 12.0), (3, users[2], 3.0)]
+    assert database.get_leaderboard_rank(users[2], 'week', '2025-03-03', 'distance') == {
+        'rank': 3, 'value': 3.0, 'ranked': 3}
+    assert database.get_leaderboard_rank(users[3], 'week', '2025-03-03', 'distance') == {
+        'rank': None, 'value': 0, 'ranked': 3}
+    assert database.get_leaderboard('month', '2025-02-01', 'long_run')[0]['user_id'] == users[3]
+
+    # An edit and a delete move users up and down both boards
+    database.create_activities_bulk([{'user_id': users[2], 'date': '2025-03-06', 'distance': 15.0, 'activity_id': 4}])
+    database.delete_activity(users[1], 3)
+    assert database.get_leaderboard_rank(users[2], 'week', '2025-03-03', 'distance')['rank'] == 1
+    assert database.get_leaderboard_rank(users[0], 'month', '2025-03-01', 'long_run') == {
+        'rank': 2, 'value': 7.0, 'ranked': 2}
+    assert database.get_leaderboard_rank(users[1], 'week', '2025-03-03', 'distance')['rank'] is None
+
+    incremental = database.get_connection().execute(
+        "SELECT * FROM LeaderboardCounts WHERE count != 0 ORDER BY 1, 2, 3, 4").fetchall()
+    database.rebuild_leaderboards()
+    rebuilt = database.get_connection().execute("SELECT * FROM LeaderboardCounts ORDER BY 1, 2, 3, 4").fetchall()
+    assert [tuple(row) for row in incremental] == [tuple(row) for row in rebuilt]
+
+
+def test_concurrent_ingests_for_one_user_keep_leaderboards_consistent():
+    """Test that writers racing on one user's week leave the same leaderboard counts as a rebuild."""
+    import threading
+    database.init_db()
+    user_id = database.create_user('testuser', 'testpassword')
+    start = threading.Barrier(4)
+
+    def ingest(worker):
+        try:
+            start.wait()
+            for i in range(10):
+                database.create_activities_bulk([{'user_id': user_id, 'date': '2025-03-03',
+                                                  'distance': 1.0 + i, 'activity_id': worker * 100 + i}])
+        finally:
+            database.release_connection()
+    threads = [threading.Thread(target=ingest, args=(worker,)) for worker in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert database.get_leaderboard_rank(user_id, 'week', '2025-03-03', 'distance')['value'] == 220.0
+    incremental = database.get_connection().execute(
+        "SELECT * FROM LeaderboardCounts WHERE count != 0 ORDER BY 1, 2, 3, 4").fetchall()
+    database.rebuild_leaderboards()
+    rebuilt = database.get_connection().execute("SELECT * FROM LeaderboardCounts ORDER BY 1, 2, 3, 4").fetchall()
+    assert [tuple(row) for row in incremental] == [tuple(row) for row in rebuilt]
+
+
+@pytest.mark.sqlite_only
+def test_migrations_upgrade_existing_database_without_data_loss():
+    """Test that init_db upgrades a database built with the original schema and keeps its rows."""
+    import sqlite3
+    with sqlite3.connect(database.DB_NAME) as conn:
+        database._migration_1_base_schema(conn)
+        conn.execute("INSERT INTO Users (id, username, password_hash) VALUES (1, 'old', 'hash')")
+        conn.execute("INSERT INTO DailyMileage (user_id, activity_id, date, distance) VALUES (1, 7, '2025-03-04', 5.0)")
+    conn.close()
+
+    database.init_db()
+    assert database.get_schema_version() == len(database.MIGRATIONS)
+    assert database.get_user_by_username('old')['last_activity_time'] == 0
+    assert database.get_activities_for_user(1)[0]['activity_id'] == 7
+    assert database.get_week_summary(1, datetime.date(2025, 3, 3))['total'] == 5.0
+
+    # Running it again is a no-op
+    database.init_db()
+    assert len(database.get_activities_for_user(1)) == 1
+
+
+HOT_QUERY_CALLS = [
+    lambda user_id: database.get_user_summary(user_id),
+    lambda user_id: database.get_user_by_username('testuser'),
+    lambda user_id: database.get_activities_for_user(user_id),
+    lambda user_id: database.get_activities_version(user_id),
+    lambda user_id: database.get_activities_payload(user_id),
+    lambda user_id: database.get_activities_page(user_id, since='2025-03-01', limit=10,
+                                                 cursor=database.encode_cursor('2025-03-20', 20)),
+    lambda user_id: database.get_activities_payload(user_id, until='2025-03-25', limit=10,
+                                                    cursor=database.encode_cursor('2025-03-20', 20)),
+    lambda user_id: database.get_week_summary(user_id, datetime.date(2025, 3, 3)),
+    lambda user_id: database.enqueue_stale_users(900),
+    lambda user_id: database.get_strava_user_ids(),
+    lambda user_id: database.claim_sync_job('worker', 600),
+    lambda user_id: database.get_user_id_for_athlete(1234),
+    lambda user_id: database.delete_activity(user_id, 999),
+    lambda user_id: database.get_activity_columns(user_id, analytics.pack_columns),
+    lambda user_id: database.get_trends_state(user_id),
+    lambda user_id: database.get_leaderboard('week', '2025-03-03', 'distance'),
+    lambda user_id: database.get_leaderboard_rank(user_id, 'month', '2025-03-01', 'long_run'),
+]
+
+
+@pytest.mark.sqlite_only
+def test_hot_queries_use_indexes():
+    """Test that no hot query's EXPLAIN QUERY PLAN falls back to a full table scan or a temp sort."""
+    database.init_db()
+    user_id = database.create_user('testuser', 'testpassword')
+    database.create_athlete_with_goals(user_id, 30, 10)
+    database.create_activities_bulk(
+        {'user_id': user_id, 'date': f'2025-03-{day:02d}', 'distance': 5.0, 'activity_id': day}
+        for day in range(1, 29)
+    )
+    conn = database.get_connection()
+
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        for call in HOT_QUERY_CALLS:
+            call(user_id)
+    finally:
+        conn.set_trace_callback(None)
+
+    queries = [sql for sql in statements if sql.lstrip().upper().startswith(('SELECT', 'UPDATE', 'INSERT', 'DELETE'))]
+    assert len(queries) >= len(HOT_QUERY_CALLS)
+    for sql in queries:
+        plan = [row['detail'] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+        for step in plan:
+            full_scan = step.startswith('SCAN') and 'INDEX' not in step and 'CONSTANT ROW' not in step
+            assert not full_scan, f"full scan in {sql!r}: {plan}"
+            assert 'USE TEMP B-TREE' not in step, f"temp sort in {sql!r}: {plan}"
+            # Re-run for every output row
+            assert 'CORRELATED' not in step, f"correlated subquery in {sql!r}: {plan}"
@@ -0,0 +1,92 @@
+import csv
+import datetime
+import io
+import zipfile
+
+import pytest
+
+import database
+import importer
+
+# A trimmed activities.csv header; real exports have ~80 columns, including Distance twice
+HEADER = ['Activity ID', 'Activity Date', 'Activity Name', 'Activity Type',
+          'Elapsed Time', 'Distance', 'Moving Time', 'Distance', 'Elevation Gain']
+
+
+def archive_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(HEADER)
+    writer.writerows(rows)
+    return buffer.getvalue().encode('utf-8-sig')
+
+
+ROWS = [
+    [101, 'Mar 3, 2025, 6:02:11 PM', 'Easy, slow', 'Run', 1800, '5.00', 1750, '5000.0', '12'],
+    [102, 'Mar 8, 2025, 7:30:00 AM', 'Long run', 'Run', 5400, '16.09', 5300, '16093.4', '80'],
+    [102, 'Mar 8, 2025, 7:30:00 AM', 'Long run', 'Run', 5400, '16.09', 5300, '16093.4', '80'],
+    [103, 'not a date', 'Broken', 'Run', 60, '0.10', 60, '100.0', '0'],
+]
+
+
+def test_import_activities_csv_converts_and_dedupes():
+    """Test that activities.csv rows are converted like an API sync and imported once."""
+    database.init_db()
+    user_id = database.create_user('testuser', 'testpassword')
+
+    stats = importer.import_archive(user_id, io.BytesIO(archive_csv(ROWS)), 'activities.csv')
+    assert stats['rows_read'] == 4
+    assert stats['rows_written'] == 2
+    assert stats['skipped'] == 1
+    assert database.get_activities_for_user(user_id) == [
+        {'activity_id': 102, 'date': '2025-03-08', 'distance': 10.0, 'activity_title': 'Long run'},
+        {'activity_id': 101, 'date': '2025-03-03', 'distance': 3.11, 'activity_title': 'Easy, slow'},
+    ]
+    assert database.get_week_summary(user_id, datetime.date(2025, 3, 3))['total'] == 13.11
+
+    again = importer.import_archive(user_id, io.BytesIO(archive_csv(ROWS)), 'activities.csv')
+    assert again['rows_written'] == 0
+
+
+def test_import_reads_activities_csv_from_export_zip():
+    """Test that a full export zip is accepted and a zip without activities.csv is rejected."""
+    database.init_db()
+    user_id = database.create_user('testuser', 'testpassword')
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as export:
+        export.writestr('export_123/activities.csv', archive_csv(ROWS[:1]))
+        export.writestr('export_123/activities/101.gpx', '<gpx/>')
+    assert importer.import_archive(user_id, archive, 'export_123.zip')['rows_written'] == 1
+
+    empty = io.BytesIO()
+    with zipfile.ZipFile(empty, 'w') as export:
+        export.writestr('profile.csv', 'x')
+    with pytest.raises(ValueError):
+        importer.import_archive(user_id, empty, 'export.zip')
+
+
+def test_open_archive_closes_what_it_opened(tmp_path, monkeypatch):
+    """Test that the zip, its member and a file opened from a path are closed, and a caller's file isn't."""
+    path = tmp_path / 'export.zip'
+    with zipfile.ZipFile(path, 'w') as export:
+        export.writestr('activities.csv', archive_csv(ROWS[:1]))
+
+    opened = []
+    real_open = open
+
+    def recording_open(*args, **kwargs):
+        opened.append(real_open(*args, **kwargs))
+        return opened[-1]
+    monkeypatch.setattr('builtins.open', recording_open)
+    with importer.open_archive(str(path)) as lines:
+        member = lines.buffer
+        assert next(csv.reader(lines)) == HEADER
+    monkeypatch.undo()
+    assert member.closed
+    assert [file.closed for file in opened] == [True]
+
+    upload = io.BytesIO(path.read_bytes())
+    with importer.open_archive(upload, 'export.zip') as lines:
+        assert next(csv.reader(lines)) == HEADER
+    assert not upload.closed
@@ -0,0 +1,40 @@
+import metrics
+
+
+def test_histogram_renders_cumulative_prometheus_buckets():
+    """Test that a histogram renders cumulative buckets, sum and count per label set."""
+    histogram = metrics.Histogram('test_seconds', "Test histogram.", ['op'], buckets=(0.1, 1.0))
+    histogram.observe(0.05, 'read')
+    histogram.observe(0.5, 'read')
+    histogram.observe(5.0, 'read')
+
+    assert histogram.render() == [
+        '# HELP test_seconds Test histogram.',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{op="read",le="0.1"} 1',
+        'test_seconds_bucket{op="read",le="1.0"} 2',
+        'test_seconds_bucket{op="read",le="+Inf"} 3',
+        'test_seconds_sum{op="read"} 5.55',
+        'test_seconds_count{op="read"} 3',
+    ]
+
+
+def test_counter_escapes_label_values():
+    """Test that counters add up per label set and escape quotes in label values."""
+    counter = metrics.Counter('test_total', "Test counter.", ['route'])
+    counter.inc(1, '/a"b')
+    counter.inc(2, '/a"b')
+    assert counter.render()[-1] == 'test_total{route="/a\\"b"} 3'
+
+
+def test_disabled_metrics_leave_functions_unwrapped(monkeypatch):
+    """Test that with metrics disabled nothing is wrapped and observations are dropped."""
+    monkeypatch.setattr(metrics, 'ENABLED', False)
+    histogram = metrics.Histogram('disabled_seconds', "Disabled.")
+
+    def work():
+        return 42
+
+    assert histogram.time()(work) is work
+    histogram.observe(1.0)
+    assert histogram.count() == 0
@@ -0,0 +1,85 @@
+import threading
+from unittest.mock import patch
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+import passwords
+
+
+def test_verify_accepts_only_the_right_password():
+    """Test that verify checks against the stored hash and always rejects unknown users."""
+    stored = passwords.hash_password('secret')
+    assert passwords.verify(stored, 'secret') is True
+    assert passwords.verify(stored, 'wrong') is False
+    assert passwords.verify(None, 'not-a-password') is False
+    assert passwords.latency_stats()['hash_check']['count'] >= 3
+
+
+def test_needs_rehash_spots_old_parameters():
+    """Test that hashes made with other methods or iteration counts are flagged for upgrade."""
+    assert not passwords.needs_rehash(passwords.hash_password('secret'))
+    assert passwords.needs_rehash(generate_password_hash('secret', method='pbkdf2:sha256:1000'))
+    assert passwords.needs_rehash(generate_password_hash('secret', method='scrypt'))
+
+
+def test_verify_refuses_work_beyond_the_pending_limit():
+    """Test that a saturated hashing pool turns new checks away instead of queueing them."""
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_check():
+        started.set()
+        release.wait()
+
+    with patch.object(passwords, '_pending', threading.BoundedSemaphore(1)):
+        blocked = threading.Thread(target=passwords._run, args=(slow_check,))
+        blocked.start()
+        started.wait()
+        with pytest.raises(passwords.HashingBusy):
+            passwords.verify(passwords.hash_password('secret'), 'secret')
+        release.set()
+        blocked.join()
+
+
+def test_timed_out_check_is_busy_and_keeps_its_slot():
+    """Test that a timed-out check raises HashingBusy and holds its pending slot until the hash finishes."""
+    release = threading.Event()
+    pending = threading.BoundedSemaphore(1)
+
+    with patch.object(passwords, '_pending', pending), patch.object(passwords, 'HASH_TIMEOUT_SECONDS', 0.05):
+        with pytest.raises(passwords.HashingBusy):
+            passwords._run(release.wait)
+        # Still hashing, so the slot is still taken
+        with pytest.raises(passwords.HashingBusy):
+            passwords._run(lambda: None)
+        release.set()
+        assert pending.acquire(timeout=5)
+        pending.release()
+
+
+def test_dummy_hash_is_made_on_first_use():
+    """Test that the unknown-user hash isn't computed at import."""
+    with patch.object(passwords, '_dummy_hash', None):
+        assert passwords.verify(None, 'not-a-password') is False
+        assert not passwords.needs_rehash(passwords._dummy_hash)
+
+
+def test_rehash_takes_a_pending_slot_and_releases_its_connection():
+    """Test that background rehashes count against MAX_PENDING and hand back their database connection."""
+    saved = []
+    pending = threading.BoundedSemaphore(1)
+
+    with patch.object(passwords, '_pending', pending), \
+            patch('database.release_connection') as release_connection:
+        assert pending.acquire(blocking=False)
+        passwords.rehash_in_background('secret', saved.append)   # no free slot: skipped
+        pending.release()
+
+        passwords.rehash_in_background('secret', saved.append)
+        assert pending.acquire(timeout=5)
+        pending.release()
+
+    assert len(saved) == 1
+    assert not passwords.needs_rehash(saved[0])
+    release_connection.assert_called_once_with()
@@ -0,0 +1,54 @@
+from unittest.mock import MagicMock
+
+import ratelimit
+
+
+class FakeClock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def response(status=200, limit="600,30000", usage="0,0"):
+    mock = MagicMock()
+    mock.status_code = status
+    mock.headers = {'X-RateLimit-Limit': limit, 'X-RateLimit-Usage': usage}
+    return mock
+
+
+def test_token_bucket_waits_for_refill():
+    """Test that acquire blocks once the burst is spent and refills at the set rate."""
+    clock = FakeClock()
+    bucket = ratelimit.TokenBucket(rate=2, capacity=2, clock=clock, sleep=clock.sleep)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0.5
+    assert clock.now == 0.5
+
+
+def test_rate_limiter_spreads_remaining_quota_over_window():
+    """Test that the rate comes from the usage headers and the time left in the window."""
+    clock = FakeClock(now=600)  # 300s before the 15-minute window resets
+    limiter = ratelimit.StravaRateLimiter(clock=clock, sleep=clock.sleep)
+
+    limiter.update(response(usage="300,1000"))
+    assert limiter.bucket.rate == 1.0
+
+    # The daily quota caps what is left of the short window
+    limiter.update(response(usage="300,29970"))
+    assert limiter.bucket.rate == 0.1
+
+
+def test_rate_limiter_pauses_after_429():
+    """Test that a 429 empties the bucket until the window resets."""
+    clock = FakeClock(now=0)
+    limiter = ratelimit.StravaRateLimiter(clock=clock, sleep=clock.sleep)
+    limiter.update(response(status=429, usage="601,601"))
+    assert limiter.throttled == 1
+    assert limiter.bucket.tokens == 0
+    assert limiter.bucket.rate == 1 / 900
@@ -0,0 +1,168 @@
+import datetime
+import time
+from unittest.mock import patch
+
+import database
+import scheduler
+
+
+def connect_strava(user_id):
+    database.save_user_tokens_and_info(user_id, 'access', 'refresh', int(time.time()) + 3600, 1000 + user_id)
+
+
+def test_run_once_syncs_stale_users_only():
+    """Test that the sweep queues stale connected users and skips fresh or unconnected ones."""
+    database.init_db()
+    stale = database.create_user('stale', 'password')
+    fresh = database.create_user('fresh', 'password')
+    database.create_user('no_strava', 'password')
+    connect_strava(stale)
+    connect_strava(fresh)
+    database.update_last_sync_time(fresh)
+
+    with patch('collector.fetch_and_save_user_data') as mock_fetch:
+        assert scheduler.SyncScheduler().run_once() == 1
+    mock_fetch.assert_called_once_with(stale)
+    assert time.time() - database.get_user_by_id(stale)['last_sync_time'] < 5
+    assert database.claim_sync_job('anyone', scheduler.LEASE_SECONDS) is None
+
+
+def test_failed_sync_is_not_marked_fresh():
+    """Test that a sync that fails (fetch returns None) leaves the user stale for the next sweep."""
+    database.init_db()
+    user_id = database.create_user('runner', 'password')
+    connect_strava(user_id)
+
+    with patch('collector.fetch_and_save_user_data', return_value=None):
+        assert scheduler.SyncScheduler().run_once() == 1
+    assert database.get_user_by_id(user_id)['last_sync_time'] == 0
+    assert database.enqueue_stale_users(scheduler.SYNC_INTERVAL_SECONDS) == 1
+
+
+def test_background_worker_processes_requested_sync():
+    """Test that request_sync returns immediately and the worker pool runs the sync."""
+    database.init_db()
+    user_id = database.create_user('runner', 'password')
+    connect_strava(user_id)
+
+    worker = scheduler.SyncScheduler(max_workers=1)
+    with patch('collector.fetch_and_save_user_data') as mock_fetch, \
+         patch('database.enqueue_stale_users', return_value=0):
+        assert worker.request_sync(user_id) is True
+        assert worker.request_sync(user_id) is False
+        worker.start()
+        deadline = time.time() + 5
+        while not mock_fetch.called and time.time() < deadline:
+            time.sleep(0.05)
+        worker.stop()
+    mock_fetch.assert_called_once_with(user_id)
+
+
+def test_sync_all_users_against_fake_strava(monkeypatch):
+    """Test that a batch sync fetches every connected user's history concurrently."""
+    from fake_strava import FakeStrava
+    import collector
+
+    database.init_db()
+    user_ids = []
+    for athlete_id in range(1, 6):
+        user_id = database.create_user(f'runner{athlete_id}', 'password')
+        database.save_user_tokens_and_info(
+            user_id, f'athlete-{athlete_id}', f'refresh-{athlete_id}', int(time.time()) + 3600, athlete_id
+        )
+        database.update_last_activity_time(user_id, 1)
+        user_ids.append(user_id)
+
+    monkeypatch.setattr(collector, 'PAGE_SIZE', 50)
+    totals_before = dict(collector.sync_totals)
+    with FakeStrava(activities_per_athlete=120) as strava:
+        monkeypatch.setattr(collector, 'client', collector.StravaClient(base_url=strava.url))
+        summary = scheduler.sync_all_users(max_workers=4)
+
+    assert summary['synced'] == 5
+    assert summary['skipped'] == 0
+    assert summary['api_calls'] == 5 * 3
+    # The worker threads' updates to the process totals all land
+    assert collector.sync_totals['syncs'] - totals_before['syncs'] == 5
+    assert collector.sync_totals['api_calls'] - totals_before['api_calls'] == 5 * 3
+    assert strava.rejected == 0
+    for user_id in user_ids:
+        assert len(database.get_activities_for_user(user_id)) == 120
+
+
+def test_webhook_events_fetch_one_activity_and_apply_deletes(monkeypatch):
+    """Test that queued webhook events cost one API call per change and confirmed deletes remove the row."""
+    from fake_strava import FakeStrava, make_activity
+    import collector
+
+    database.init_db()
+    user_id = database.create_user('runner', 'password')
+    database.save_user_tokens_and_info(user_id, 'athlete-7', 'refresh-7', int(time.time()) + 3600, 7)
+    database.update_last_sync_time(user_id)
+    activity = make_activity(7, 3)
+
+    with FakeStrava(activities_per_athlete=10) as strava:
+        monkeypatch.setattr(collector, 'client', collector.StravaClient(base_url=strava.url))
+        database.enqueue_webhook_event('activity', activity['id'], 'create', 7, 1)
+        database.enqueue_webhook_event('activity', 123, 'create', 999, 1)   # not one of our athletes
+        assert scheduler.SyncScheduler().run_once() == 2
+        assert strava.requests == 1
+
+        assert [a['activity_id'] for a in database.get_activities_for_user(user_id)] == [activity['id']]
+
+        # Someone else's public activity, named in an event for our athlete, isn't saved
+        other = make_activity(8, 0)
+        strava.public.add(other['id'])
+        database.enqueue_webhook_event('activity', other['id'], 'create', 7, 1)
+        scheduler.SyncScheduler().run_once()
+        assert strava.requests == 2
+        assert [a['activity_id'] for a in database.get_activities_for_user(user_id)] == [activity['id']]
+        week = datetime.date.fromisoformat(database.week_start_of(activity['start_date_local'][:10]))
+        assert database.get_week_summary(user_id, week)['total'] > 0
+
+        # A delete is only applied once Strava confirms the activity is gone
+        database.enqueue_webhook_event('activity', activity['id'], 'delete', 7, 2)
+        scheduler.SyncScheduler().run_once()
+        assert strava.requests == 3
+        assert [a['activity_id'] for a in database.get_activities_for_user(user_id)] == [activity['id']]
+
+        strava.deleted.add(activity['id'])
+        database.enqueue_webhook_event('activity', activity['id'], 'delete', 7, 3)
+        scheduler.SyncScheduler().run_once()
+        assert strava.requests == 4
+
+    assert database.get_activities_for_user(user_id) == []
+    assert database.get_week_summary(user_id, week)['total'] == 0
+    assert database.claim_webhook_event('anyone', 0) is None
+
+
+def test_failed_webhook_event_is_retried_then_dropped():
+    """Test that a failing event stays queued for retry until it runs out of attempts."""
+    database.init_db()
+    database.enqueue_webhook_event('activity', 1, 'update', 7, 1)
+    worker = scheduler.SyncScheduler()
+
+    with patch('collector.apply_webhook_event', side_effect=RuntimeError("Strava down")):
+        for attempt in range(1, scheduler.WEBHOOK_MAX_ATTEMPTS + 1):
+            event = database.claim_webhook_event(worker.worker_id, -1)
+            assert event['attempts'] == attempt
+            worker._apply_event(event)
+    assert database.claim_webhook_event(worker.worker_id, -1) is None
+
+
+def test_sync_all_users_skips_running_jobs_and_keeps_failures_stale():
+    """Test that the batch leaves users a scheduler is syncing alone and doesn't mark failures synced."""
+    database.init_db()
+    running, failing = database.create_user('running', 'password'), database.create_user('failing', 'password')
+    connect_strava(running)
+    connect_strava(failing)
+    database.enqueue_sync_job(running)
+    assert database.claim_sync_job('scheduler', scheduler.LEASE_SECONDS) == running
+
+    with patch('collector.fetch_and_save_user_data', return_value=None) as mock_fetch:
+        summary = scheduler.sync_all_users(max_workers=2)
+    mock_fetch.assert_called_once_with(failing)
+    assert (summary['synced'], summary['skipped'], summary['failed']) == (0, 1, 1)
+    assert database.get_user_by_id(failing)['last_sync_time'] == 0
+    # The batch's claim is gone; the scheduler's is untouched
+    assert database.claim_sync_job('anyone', scheduler.LEASE_SECONDS) is None
@@ -0,0 +1,46 @@
+import pytest
+
+import storage
+
+
+def test_translate_rewrites_sqlite_dialect_for_postgresql():
+    """Test that translate converts placeholders, column types and NULL-safe comparisons."""
+    assert storage.translate("SELECT * FROM Users WHERE id = ? AND name LIKE '%a'") == \
+        "SELECT * FROM Users WHERE id = %s AND name LIKE '%%a'"
+
+    ddl = storage.translate("""CREATE TABLE IF NOT EXISTS T (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        day DATE NOT NULL,
+        distance REAL,
+        data BLOB
+    ) WITHOUT ROWID""")
+    assert "BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY" in ddl
+    assert "day TEXT NOT NULL" in ddl
+    assert "distance DOUBLE PRECISION" in ddl
+    assert "data BYTEA" in ddl
+    assert "WITHOUT ROWID" not in ddl
+
+    # Only DDL has its types rewritten; IS NULL and IS NOT NULL are left alone
+    assert storage.translate("SELECT CAST(x AS INTEGER) FROM T WHERE a IS NOT b AND c IS NOT NULL") == \
+        "SELECT CAST(x AS INTEGER) FROM T WHERE a IS DISTINCT FROM b AND c IS NOT NULL"
+    assert storage.translate("UPDATE T SET a = ? WHERE b IS ? AND c IS NULL") == \
+        "UPDATE T SET a = %s WHERE b IS NOT DISTINCT FROM %s AND c IS NULL"
+
+
+def test_from_env_picks_backend(monkeypatch):
+    """Test that SQLite is the default and unknown DATABASE_URL schemes are rejected."""
+    monkeypatch.delenv("DATABASE_URL", raising=False)
+    assert storage.from_env().name == 'sqlite'
+
+    monkeypatch.setenv("DATABASE_URL", "mysql://localhost/strava")
+    with pytest.raises(ValueError):
+        storage.from_env()
+
+
+def test_row_reads_by_position_and_name():
+    """Test that PostgreSQL rows can be read like sqlite3.Row."""
+    row = storage.Row((7, 'runner'), {'id': 0, 'username': 1})
+    assert row[0] == 7
+    assert row['username'] == 'runner'
+    assert row.keys() == ['id', 'username']
+    assert tuple(row) == (7, 'runner')
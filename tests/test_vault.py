@@ -0,0 +1,72 @@
+import time
+from unittest.mock import patch
+
+from cryptography.fernet import Fernet
+
+import database
+import vault
+
+
+def test_vault_decrypts_with_any_key_and_encrypts_with_the_newest():
+    """Test that tokens from an old key still decrypt and new ones use the first key."""
+    old_key, new_key = Fernet.generate_key(), Fernet.generate_key()
+    old_token = vault.Vault([old_key]).encrypt('access-1')
+
+    keys = vault.Vault([new_key, old_key])
+    assert keys.rotating
+    assert keys.decrypt(old_token) == 'access-1'
+    assert Fernet(new_key).decrypt(keys.encrypt('access-2').encode()) == b'access-2'
+    assert [keys.decrypt(token) for token in (old_token, None, 'garbage')] == ['access-1', None, None]
+
+    rotated = keys.rotate(old_token)
+    assert Fernet(new_key).decrypt(rotated.encode()) == b'access-1'
+    assert keys.rotate(rotated) is None
+
+
+def test_sealed_tokens_only_decrypt_fields_that_are_read():
+    """Test that reading the access token doesn't decrypt the refresh token."""
+    keys = vault.Vault([Fernet.generate_key()])
+    row = {'strava_access_token': keys.encrypt('access'), 'strava_refresh_token': keys.encrypt('refresh'),
+           'token_expiration': 123}
+    tokens = vault.SealedTokens(keys, row)
+
+    with patch.object(keys, 'decrypt', wraps=keys.decrypt) as decrypt:
+        assert tokens['strava_access_token'] == 'access'
+        assert tokens['strava_access_token'] == 'access'
+        assert tokens['token_expiration'] == 123
+        assert decrypt.call_count == 1
+        assert tokens['strava_refresh_token'] == 'refresh'
+        assert decrypt.call_count == 2
+
+
+def test_rotate_token_keys_reencrypts_every_user(monkeypatch):
+    """Test that a rotation pass moves every user's tokens to the newest key in batches."""
+    database.init_db()
+    expires_at = int(time.time()) + 3600
+    user_ids = []
+    for i in range(5):
+        user_id = database.create_user(f'runner{i}', 'password')
+        database.update_user_tokens(user_id, f'access-{i}', f'refresh-{i}', expires_at)
+        user_ids.append(user_id)
+
+    new_key = Fernet.generate_key()
+    monkeypatch.setattr(database, 'token_vault', vault.Vault([new_key] + vault.keys_from_env()))
+
+    after, total, passes = 0, 0, 0
+    while after is not None:
+        after, rotated = database.rotate_token_keys(after, limit=2)
+        total += rotated
+        passes += 1
+    assert total == 5
+    assert passes == 3
+    assert database.rotate_token_keys(0) == (None, 0)
+
+    # Only the new key is needed from now on
+    monkeypatch.setattr(database, 'token_vault', vault.Vault([new_key]))
+    for i, user_id in enumerate(user_ids):
+        tokens = database.get_user_tokens(user_id)
+        assert tokens['strava_access_token'] == f'access-{i}'
+        assert tokens['strava_refresh_token'] == f'refresh-{i}'
+    assert database.get_access_tokens(user_ids + [999]) == {
+        user_id: (f'access-{i}', expires_at) for i, user_id in enumerate(user_ids)
+    }
@@ -0,0 +1,116 @@
+"""
+vault.py - Encryption for the Strava tokens stored in the Users table.
+
+Tokens are Fernet tokens (AES-128-CBC with an HMAC-SHA256 check). ENCRYPTION_KEYS
+is a comma-separated list of keys, newest first; a single ENCRYPTION_KEY still
+works. New tokens are encrypted with the first key and any listed key can
+decrypt, so keys can be rotated without downtime:
+
+    1. Put a new key at the front of ENCRYPTION_KEYS and restart the app.
+    2. The sync scheduler re-encrypts stored tokens under it a batch at a time
+       (or run python setup_db.py --rotate-keys to do it all at once).
+    3. Once that has finished, remove the old key.
+
+Each decrypt costs tens of microseconds, so only what is used gets decrypted:
+SealedTokens decrypts one field on first access, and a batch sync reads just
+the access tokens (database.get_access_tokens).
+"""
+import os
+from collections.abc import Mapping
+
+from cryptography.fernet import Fernet, InvalidToken
+
+
+def keys_from_env():
+    """The keys in ENCRYPTION_KEYS (or ENCRYPTION_KEY), newest first."""
+    value = os.getenv("ENCRYPTION_KEYS") or os.getenv("ENCRYPTION_KEY")
+    keys = [key.strip() for key in (value or '').split(',') if key.strip()]
+    if not keys:
+        raise ValueError("ENCRYPTION_KEYS (or ENCRYPTION_KEY) not found in .env")
+    return keys
+
+
+class Vault:
+    def __init__(self, keys):
+        self._fernets = [Fernet(key) for key in keys]
+        self._primary = self._fernets[0]
+        # Which key decrypted last. Mid-rotation most stored tokens still use the
+        # old key, so it's tried first rather than failing the new key's HMAC
+        # check every time (what MultiFernet does).
+        self._last_hit = 0
+
+    @property
+    def rotating(self):
+        """True when there are old keys whose tokens may still need re-encrypting."""
+        return len(self._fernets) > 1
+
+    def encrypt(self, token):
+        if not token:
+            return None
+        return self._primary.encrypt(token.encode()).decode()
+
+    def _decrypt(self, token):
+        # Raises InvalidToken if no key can decrypt it
+        last_hit = self._last_hit
+        try:
+            return self._fernets[last_hit].decrypt(token)
+        except InvalidToken:
+            pass
+        for i, fernet in enumerate(self._fernets):
+            if i == last_hit:
+                continue
+            try:
+                plaintext = fernet.decrypt(token)
+            except InvalidToken:
+                continue
+            self._last_hit = i
+            return plaintext
+        raise InvalidToken
+
+    def decrypt(self, token):
+        """Decrypt a stored token. Returns None if it's empty or no key can decrypt it."""
+        if not token:
+            return None
+        try:
+            return self._decrypt(token).decode()
+        except InvalidToken:
+            print("Error With Encryption: token doesn't match any key in ENCRYPTION_KEYS")
+            return None
+
+    def rotate(self, token):
+        """Re-encrypt a stored token under the newest key.
+
+        Returns None if it's empty or already uses the newest key. Raises
+        InvalidToken if no key can decrypt it.
+        """
+        if not token:
+            return None
+        try:
+            self._primary.decrypt(token)
+            return None
+        except InvalidToken:
+            pass
+        return self._primary.encrypt(self._decrypt(token)).decode()
+
+
+class SealedTokens(Mapping):
+    """A Users row's token columns, with each encrypted field decrypted on first access."""
+
+    ENCRYPTED_FIELDS = ('strava_access_token', 'strava_refresh_token')
+
+    def __init__(self, vault, row):
+        self._vault = vault
+        self._values = dict(row)
+        self._sealed = {field for field in self.ENCRYPTED_FIELDS if field in self._values}
+
+    def __getitem__(self, field):
+        if field in self._sealed:
+            self._values[field] = self._vault.decrypt(self._values[field])
+            self._sealed.discard(field)
+        return self._values[field]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)